@@ -0,0 +1,28 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Builds (or refreshes) a SQLite database of the decoded contents of XD script files")
+	parser.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='*', type=str)
+	parser.add_argument("-o", "--output", help="Database file", type=str, default="scripts.sqlite")
+	parser.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	parser.add_argument("--prune", help="Remove the scripts which are not in files from the database", action="store_true")
+	parser.add_argument("-q", "--query", help="SQL query to run once the database is up to date (tab-separated output)", type=str)
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+
+	with AnalysisDB(args.output) as db:
+		if fnames or args.prune:
+			n = db.update(fnames, args.jobs, args.prune)
+			print("{0} script(s) loaded".format(n), file=sys.stderr)
+		if args.query:
+			for row in db.query(args.query):
+				print('\t'.join(str(col) for col in row))
@@ -0,0 +1,26 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Extracts the call graph of XD script files")
+	parser.add_argument("files", help="XD script files", nargs='+', type=str)
+	parser.add_argument("--format", help="Output format", choices=("dot", "graphml", "json"), default="dot")
+	parser.add_argument("--no-std", help="Omit the calls to standard functions (dot and graphml only)", action="store_true")
+	args = parser.parse_args()
+
+	for fname in args.files:
+		with open(fname, "rb") as f:
+			graph = getCallGraph(ScriptCtx(f.read()))
+		out_fname = os.path.splitext(fname)[0] + '.' + args.format
+		with open(out_fname, "w", encoding='utf-8') as out_f:
+			if args.format == "dot": out_f.write(graph.toDOT(not args.no_std))
+			elif args.format == "graphml": out_f.write(graph.toGraphML(not args.no_std))
+			else: out_f.write(graph.toJSON())
@@ -2,8 +2,10 @@
 
 from XDscriptLib import *
 import argparse
+import contextlib
 import sys
 import os
+import time
 
 
 if __name__ == '__main__':
@@ -11,14 +13,46 @@ if __name__ == '__main__':
 		raise RuntimeError("Python 3 required")
 
 	parser = argparse.ArgumentParser()
-	parser.add_argument("files", help="XD script files to disassemble", nargs='+', type=str)
+	parser.add_argument("files", help="XD script files (or directories containing .scd files) to disassemble", nargs='+', type=str)
 	parser.add_argument("--display-code-offsets", help="Display code offsets", action="store_true") 
+	parser.add_argument("-f", "--format", help="Output format (can be repeated; default: txt)", choices=("txt", "html", "json"),
+						action="append", dest="formats")
+	parser.add_argument("-o", "--output", help="Output: a directory, a single .zip or .sqlite archive, or - for stdout "
+						"(default: next to each input file)", type=str)
+	parser.add_argument("--sidecar", help="Load the scripts from their .scdx sidecar files when they are fresh, "
+						"(re)write them otherwise", action="store_true")
+	parser.add_argument("--watch", help="Keep running, and re-disassemble the files when they change", action="store_true")
+	parser.add_argument("--interval", help="Polling interval in seconds, in watch mode (default: 0.5)", type=float, default=0.5)
+	parser.add_argument("--trace", help="Write the timings of the processing phases to this file (Chrome trace-event format)", type=str)
+	parser.add_argument("--trace-allocations", help="Also record the memory allocated by each phase (slow)", action="store_true")
 	args = parser.parse_args()
-	fnames = args.files
-
-	for fname in fnames:
-		with open(fname, "rb") as f:
-			out_fname = os.path.splitext(fname)[0]+'.txt'
-			contents = f.read()
-			with open(out_fname, "w") as out_f:
-				out_f.write(str(ScriptCtx(contents, args.display_code_offsets)))
\ No newline at end of file
+	if args.watch and args.output is not None and os.path.splitext(args.output)[1].lower() == '.zip':
+		parser.error("--watch cannot be used with a zip archive")
+
+	tracer = Tracer(trackAllocations=args.trace_allocations)
+	with (tracer if args.trace else contextlib.nullcontext()), openBackend(args.output, args.formats or ["txt"]) as backend:
+		if not args.watch:
+			fnames = listScriptFiles(args.files)
+			for (fname, name) in zip(fnames, outputNames(fnames, args.output is not None)):
+				with tracePhase(fname):
+					if args.sidecar:
+						backend.write(name, loadScript(fname, args.display_code_offsets))
+					else:
+						with open(fname, "rb") as f:
+							backend.write(name, ScriptCtx(f.read(), args.display_code_offsets))
+		else:
+			names = dict()
+			def watchedFiles():
+				fnames = listScriptFiles(args.files)
+				names.update(zip(fnames, outputNames(fnames, args.output is not None)))
+				return fnames
+
+			def onChange(fname, ctx):
+				backend.write(names[fname], ctx)
+				print("{0}: {1} updated".format(time.strftime("%H:%M:%S"), fname), file=sys.stderr)
+
+			watcher = ScriptWatcher(watchedFiles, onChange, ScriptCache(displayOffsets=args.display_code_offsets), args.interval)
+			watcher.run(lambda changed: backend.flush() if changed else None)
+
+	if args.trace:
+		tracer.writeChromeTrace(args.trace)
@@ -0,0 +1,33 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Builds the story flag ($globals) dependency map of XD script files: writes, the flag values gating each block, and reads")
+	parser.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='+', type=str)
+	parser.add_argument("--format", help="Output format", choices=("json", "dot"), default="json")
+	parser.add_argument("-o", "--output", help="Output file (default: stdout)", type=str)
+	parser.add_argument("-p", "--previous", help="Previous map (JSON): only the scripts modified since are analyzed", type=str)
+	parser.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+
+	previous = None
+	if args.previous and os.path.exists(args.previous):
+		with open(args.previous, "r", encoding='utf-8') as f:
+			previous = FlagMap.fromJSON(f.read())
+
+	flagMap = buildFlagMap(fnames, previous, args.jobs)
+	out = open(args.output, "w", encoding='utf-8') if args.output else sys.stdout
+	try:
+		out.write(flagMap.toDOT() if args.format == "dot" else flagMap.toJSON() + '\n')
+	finally:
+		if out is not sys.stdout: out.close()
@@ -0,0 +1,180 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import XDscriptLib
+import argparse
+import hashlib
+import os
+import random
+import signal
+import struct
+import sys
+import time
+import warnings
+
+libDir = os.path.dirname(os.path.abspath(XDscriptLib.__file__))
+
+interestingWords = (0, 1, 0x10, 0x1f, 0x20, 0x7fff, 0x8000, 0xffff, 0x10000, 0x7fffffff, 0x80000000, 0xfffffff0, 0xffffffff)
+
+class Hang(Exception):
+	pass
+
+class Fuzzer(object):
+	"""
+	Coverage-guided mutational fuzzer for the hardened parser (ScriptCtx(..., hardened = True)) and the disassembler.
+	Coverage is the set of (line, previous line) pairs executed in XDscriptLib; inputs reaching new pairs are added to the corpus.
+	Any exception other than ScriptFormatError, and any input taking more than timeout seconds, is a bug.
+	"""
+
+	def __init__(self, seeds, timeout = 1.0, useCoverage = True, rng = None):
+		self.corpus = list(seeds)
+		self.timeout = timeout
+		self.useCoverage = useCoverage
+		self.rng = rng or random.Random()
+		self.coverage = set()
+		self.nbExecs = 0
+		self.nbRejected = 0
+		self.crashes = []
+		self.hangs = []
+		self._trace = set()
+		self._prev = None
+
+	#--------------------Coverage--------------------
+
+	def _localTracer(self, frame, event, arg):
+		if event == 'line':
+			cur = (frame.f_code.co_filename, frame.f_lineno)
+			self._trace.add((self._prev, cur))
+			self._prev = cur
+		return self._localTracer
+
+	def _globalTracer(self, frame, event, arg):
+		return self._localTracer if frame.f_code.co_filename.startswith(libDir) else None
+
+	#--------------------Mutations--------------------
+
+	def _sectionHeaderOffsets(self, data):
+		offsets = []
+		offset = 0x10
+		while offset + 0x20 <= len(data) and len(offsets) < 16:
+			offsets.append(offset)
+			sz = struct.unpack_from(">I", data, offset + 4)[0]
+			if sz < 0x20: break
+			offset += sz
+		return offsets
+
+	def mutate(self, data):
+		rng = self.rng
+		data = bytearray(data)
+		for _ in range(rng.randint(1, 4)):
+			kind = rng.randrange(6)
+			if not data: data = bytearray(b'TCOD' + bytes(12))
+			if kind == 0:  # bit flip
+				i = rng.randrange(len(data))
+				data[i] ^= 1 << rng.randrange(8)
+			elif kind == 1:  # random byte
+				data[rng.randrange(len(data))] = rng.randrange(256)
+			elif kind == 2 and len(data) >= 4:  # interesting word
+				i = rng.randrange(len(data) // 4) * 4
+				struct.pack_into(">I", data, i, rng.choice(interestingWords))
+			elif kind == 3:  # section header field
+				offsets = self._sectionHeaderOffsets(data)
+				if offsets:
+					i = rng.choice(offsets) + rng.choice((4, 0x10, 0x14, 0x18))
+					struct.pack_into(">I", data, i, rng.choice(interestingWords + (rng.randrange(1 << 32),)))
+			elif kind == 4:  # truncation
+				del data[rng.randrange(len(data)):]
+			else:  # chunk duplication
+				i = rng.randrange(len(data))
+				j = min(len(data), i + rng.randrange(1, 64))
+				k = rng.randrange(len(data))
+				data[k:k] = data[i:j]
+		return bytes(data)
+
+	#-------------------------------------------------
+
+	def _onAlarm(self, signum, frame):
+		raise Hang()
+
+	def execute(self, data):
+		"""Runs one input; returns True if it reached new coverage"""
+		self._trace = set()
+		self._prev = None
+		self.nbExecs += 1
+		useAlarm = hasattr(signal, "setitimer")
+		if useAlarm: signal.setitimer(signal.ITIMER_REAL, self.timeout)
+		if self.useCoverage: sys.settrace(self._globalTracer)
+		try:
+			with warnings.catch_warnings():
+				warnings.simplefilter("ignore")
+				str(ScriptCtx(data, hardened = True))
+		except ScriptFormatError:
+			self.nbRejected += 1
+		except Hang:
+			self.hangs.append(data)
+		except Exception as e:
+			self.crashes.append((data, e))
+		finally:
+			sys.settrace(None)
+			if useAlarm: signal.setitimer(signal.ITIMER_REAL, 0)
+
+		newCoverage = not self._trace <= self.coverage
+		self.coverage |= self._trace
+		return newCoverage
+
+	def run(self, maxExecs = None, duration = None):
+		if hasattr(signal, "setitimer"): signal.signal(signal.SIGALRM, self._onAlarm)
+		for data in list(self.corpus):
+			self.execute(data)
+		start = time.perf_counter()
+		while (maxExecs is None or self.nbExecs < maxExecs) and (duration is None or time.perf_counter() - start < duration):
+			data = self.mutate(self.rng.choice(self.corpus))
+			if self.execute(data): self.corpus.append(data)
+		return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Coverage-guided fuzzer for the hardened script parser")
+	parser.add_argument("files", help="XD script files used as seeds", nargs='+', type=str)
+	parser.add_argument("-n", "--iterations", help="Number of inputs to run", type=int)
+	parser.add_argument("-t", "--duration", help="Time budget in seconds (default: 60 if -n is not given)", type=float)
+	parser.add_argument("--timeout", help="Per-input timeout in seconds (hang detection)", type=float, default=1.0)
+	parser.add_argument("--target", help="Minimum acceptable throughput, in inputs per second (without coverage tracing)", type=float, default=50.0)
+	parser.add_argument("--no-coverage", help="Disable coverage tracing (faster, but blind)", action="store_true")
+	parser.add_argument("--crashes-dir", help="Directory where crashing and hanging inputs are saved", type=str, default="fuzz_crashes")
+	parser.add_argument("--seed", help="Random seed", type=int)
+	args = parser.parse_args()
+
+	seeds = []
+	for fname in args.files:
+		with open(fname, "rb") as f:
+			seeds.append(f.read())
+
+	duration = args.duration if args.duration is not None or args.iterations is not None else 60.0
+	fuzzer = Fuzzer(seeds, args.timeout, not args.no_coverage, random.Random(args.seed))
+	elapsed = fuzzer.run(args.iterations, duration)
+
+	# Throughput is measured separately, without the tracing overhead
+	bench = Fuzzer(seeds, args.timeout, False, random.Random(args.seed))
+	benchCorpus = [bench.mutate(bench.rng.choice(fuzzer.corpus)) for _ in range(200)] + fuzzer.corpus[:200]
+	start = time.perf_counter()
+	for data in benchCorpus: bench.execute(data)
+	throughput = len(benchCorpus) / (time.perf_counter() - start)
+
+	print("execs: {0} in {1:.1f}s, rejected: {2}, corpus: {3}, coverage: {4}".format(fuzzer.nbExecs, elapsed,
+		fuzzer.nbRejected, len(fuzzer.corpus), len(fuzzer.coverage)))
+	print("throughput: {0:.1f} inputs/s (target: {1})".format(throughput, args.target))
+
+	failures = [(data, "crash", repr(e)) for (data, e) in fuzzer.crashes + bench.crashes] + [(data, "hang", "") for data in fuzzer.hangs + bench.hangs]
+	if failures:
+		os.makedirs(args.crashes_dir, exist_ok = True)
+	for (data, kind, msg) in failures:
+		fname = os.path.join(args.crashes_dir, "{0}-{1}.scd".format(kind, hashlib.sha1(data).hexdigest()))
+		with open(fname, "wb") as f:
+			f.write(data)
+		print("{0}: {1} {2}".format(kind, fname, msg))
+
+	sys.exit(1 if failures or throughput < args.target else 0)
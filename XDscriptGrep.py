@@ -0,0 +1,56 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Searches XD script files for an instruction pattern (see XDscriptLib.Pattern)",
+									 epilog="example: %(prog)s '@s: setvar $globals[?k] ; ... ; jmp target<=@s' scripts/")
+	parser.add_argument("pattern", help="Instruction pattern (elements separated by ';'), unless -f is given", type=str, nargs='?')
+	parser.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='*', type=str)
+	parser.add_argument("-f", "--pattern-file", help="Read the pattern from a file (all positional arguments are then files)", type=str)
+	parser.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	parser.add_argument("-s", "--show", help="Print the matched instructions", action="store_true")
+	parser.add_argument("-c", "--count", help="Only print the number of matches of each file", action="store_true")
+	args = parser.parse_args()
+
+	if args.pattern_file is not None:
+		if args.pattern is not None: args.files.insert(0, args.pattern)
+		try:
+			with open(args.pattern_file, "r", encoding="utf-8") as f:
+				text = f.read()
+		except OSError as e:
+			parser.error("cannot read the pattern file: {0}".format(e))
+	else:
+		text = args.pattern
+	if text is None or not args.files:
+		parser.error("a pattern and at least one file are required")
+	try:
+		pattern = Pattern(text)
+	except ValueError as e:
+		parser.error("invalid pattern: {0}".format(e))
+
+	fnames = listScriptFiles(args.files)
+
+	total = 0
+	for (fname, matches) in pattern.searchFiles(fnames, args.jobs):
+		total += len(matches)
+		if args.count:
+			if matches: print("{0}: {1}".format(fname, len(matches)))
+			continue
+		if args.show and matches:
+			with open(fname, "rb") as f:
+				code = ScriptCtx(f.read()).sections["CODE"]
+		for match in matches:
+			captures = " ".join("{0}={1}".format(name, hex(value) if isinstance(value, int) else value)
+								for (name, value) in sorted(match.captures.items()))
+			print("{0}:{1}-{2}: {3}".format(fname, hex(match.start), hex(match.end), captures).rstrip())
+			if args.show:
+				for instr in code.instructions[match.start:match.end+1]:
+					if isinstance(instr, Instruction): print("\t" + str(instr))
+	if total == 0: sys.exit(1)
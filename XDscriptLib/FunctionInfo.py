@@ -490,6 +490,27 @@ stdfunctions_name_dict = { c.index: (c.name,
 								) for c in classes if isinstance(c, ClassInfo) 
 					 }
 
+# Special callbacks, see above
+specialCallbacks = ("pushpop_postprocess", "modify_floor", "preprocess", "hero_main", "postprocess", "postprocesss",
+	"pushpop_preprocess", "talk_follower", "sound", "anywaysave_callback", "anywaysave_restart")
+commonScriptCallbacks = (8, 9) # function indices
+
+# Standard functions suspending the calling task until a later frame: pause, yield, waitUntil, Tasks::sleep
+yieldingFunctions = ((0, 17), (0, 18), (0, 21), (39, 21)) # (clsID, funcID)
+
+# Function IDs (used by the task creation functions)
+currentScriptFunctionIDBase = 0x59600000
+commonScriptFunctionIDBase = 0x10000000 # (needs to be verified)
+syncTaskFromLibraryScript = (0, 142) # (clsID, funcID), its function IDs refer to the common script
+
+def getFunctionIndexFromID(functionID):
+	"""Returns the index of the function of the current script referred to by functionID, or None"""
+	return functionID & 0xffff if (functionID & 0xffff0000) == currentScriptFunctionIDBase else None
+
+def getCommonScriptFunctionIndexFromID(functionID):
+	"""Returns the index of the function of the common script referred to by functionID (from a map script), or None"""
+	return functionID & 0xffff if (functionID & 0xffff0000) == commonScriptFunctionIDBase else None
+
 def getOperatorName(index):
 	return operators_name_dict.get(index, str(index))
 
@@ -0,0 +1,193 @@
+﻿# See LICENSE for license
+
+import hashlib
+import os
+import sqlite3
+import warnings
+from XDscriptLib import FunctionInfo, Instruction, ScriptCtx
+from XDscriptLib._Bulk import mapFiles
+
+schema = """
+CREATE TABLE IF NOT EXISTS scripts (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL,
+	mtime_ns INTEGER,
+	size INTEGER,
+	sha1 TEXT,
+	entryPoint INTEGER,
+	nbWarnings INTEGER
+);
+CREATE TABLE IF NOT EXISTS functions (scriptID INTEGER, idx INTEGER, offset INTEGER, name TEXT);
+CREATE TABLE IF NOT EXISTS instructions (
+	scriptID INTEGER,
+	offset INTEGER,
+	functionOffset INTEGER,
+	opcode INTEGER,
+	name TEXT,
+	subOpcode INTEGER,
+	parameter INTEGER,
+	immediate,
+	target INTEGER,
+	variableLevel INTEGER,
+	variableID INTEGER,
+	text TEXT
+);
+CREATE TABLE IF NOT EXISTS strings (scriptID INTEGER, idx INTEGER, offset INTEGER, value TEXT);
+CREATE TABLE IF NOT EXISTS vectors (scriptID INTEGER, idx INTEGER, x REAL, y REAL, z REAL);
+CREATE TABLE IF NOT EXISTS characters (scriptID INTEGER, idx INTEGER, grpID INTEGER, resID INTEGER);
+CREATE TABLE IF NOT EXISTS globals (scriptID INTEGER, idx INTEGER, type INTEGER, value, text TEXT);
+CREATE TABLE IF NOT EXISTS arrays (scriptID INTEGER, arrayIdx INTEGER, idx INTEGER, type INTEGER, value, text TEXT);
+CREATE TABLE IF NOT EXISTS stdcalls (scriptID INTEGER, offset INTEGER, functionOffset INTEGER, classID INTEGER, functionID INTEGER, name TEXT);
+
+CREATE INDEX IF NOT EXISTS functions_script ON functions (scriptID);
+CREATE INDEX IF NOT EXISTS functions_name ON functions (name);
+CREATE INDEX IF NOT EXISTS instructions_script ON instructions (scriptID, offset);
+CREATE INDEX IF NOT EXISTS instructions_opcode ON instructions (opcode, subOpcode, parameter);
+CREATE INDEX IF NOT EXISTS instructions_variable ON instructions (variableLevel, variableID, opcode);
+CREATE INDEX IF NOT EXISTS strings_script ON strings (scriptID);
+CREATE INDEX IF NOT EXISTS strings_value ON strings (value);
+CREATE INDEX IF NOT EXISTS vectors_script ON vectors (scriptID);
+CREATE INDEX IF NOT EXISTS characters_script ON characters (scriptID);
+CREATE INDEX IF NOT EXISTS characters_res ON characters (grpID, resID);
+CREATE INDEX IF NOT EXISTS globals_script ON globals (scriptID);
+CREATE INDEX IF NOT EXISTS arrays_script ON arrays (scriptID);
+CREATE INDEX IF NOT EXISTS stdcalls_script ON stdcalls (scriptID);
+CREATE INDEX IF NOT EXISTS stdcalls_function ON stdcalls (classID, functionID);
+CREATE INDEX IF NOT EXISTS stdcalls_name ON stdcalls (name);
+"""
+
+# Tables with one row per element of a script (scriptID being the first column), in insertion order
+dataTables = ("functions", "instructions", "strings", "vectors", "characters", "globals", "arrays", "stdcalls")
+
+def _varRow(var):
+	return (var.varType, var.value, str(var))
+
+def extractRows(src, hardened = False):
+	"""
+	Parses the script contents src. Returns (entryPoint, nbWarnings, rows),
+	rows being a dict mapping each of dataTables to its rows (without the scriptID column)
+	"""
+	with warnings.catch_warnings(record = True) as caught:
+		warnings.simplefilter("always")
+		ctx = ScriptCtx(src, hardened = hardened)
+
+		code = ctx.sections["CODE"]
+		head = ctx.sections["HEAD"]
+		strg = ctx.sections.get("STRG")
+		vect = ctx.sections.get("VECT")
+		giri = ctx.sections.get("GIRI")
+		gvar = ctx.sections.get("GVAR")
+		arry = ctx.sections.get("ARRY")
+
+		rows = dict((table, []) for table in dataTables)
+		rows["functions"] = [(i, off, ctx.getLabel(off)) for (i, off) in enumerate(head.functionOffsets)]
+
+		starts = set(head.functionOffsets)
+		current = None
+		instrs = code.instructions
+		for instr in instrs:
+			if not isinstance(instr, Instruction): continue
+			pos = instr.position
+			if pos in starts: current = pos
+			opcode = instr.opcode
+			immediate = instrs[pos + 1] if instr.nextPosition > pos + 1 else None
+			target = instr.instructionID if opcode in (7, 10, 11, 12) else None  # call/jmptrue/jmpfalse/jmp
+			level, varID = (instr.subSubOpcodes[1], instr.parameter) if opcode in (3, 4, 5, 17) else (None, None)
+			rows["instructions"].append((pos, current, opcode, instr.name, instr.subOpcode, instr.parameter,
+										immediate, target, level, varID, str(instr)))
+			if opcode == 9:  # callstd
+				rows["stdcalls"].append((pos, current, instr.subOpcode, instr.parameter,
+										FunctionInfo.getStdFunctionName(instr.subOpcode, instr.parameter)))
+
+		if strg is not None:
+			offset = 0 # in bytes, like the operands of 'ldimm str'
+			for (i, s) in enumerate(strg.data.rstrip(b'\x00').split(b'\x00')):
+				rows["strings"].append((i, offset, s.decode('sjis', 'replace')))
+				offset += len(s) + 1
+		if vect is not None:
+			rows["vectors"] = [(i,) + tuple(v) for (i, v) in enumerate(vect.vectors)]
+		if giri is not None:
+			rows["characters"] = [(i, grpID, resID) for (i, (grpID, resID)) in enumerate(giri.characters)]
+		if gvar is not None:
+			rows["globals"] = [(i,) + _varRow(var) for (i, var) in enumerate(gvar.globalVars)]
+		if arry is not None:
+			rows["arrays"] = [(i, j) + _varRow(elem) for (i, ar) in enumerate(arry.arrays) for (j, elem) in enumerate(ar)]
+
+	return (head.valueOffset, len(caught), rows)
+
+def _extractFile(hardened, fname, src):
+	return (hashlib.sha1(src).hexdigest(),) + extractRows(src, hardened)
+
+class AnalysisDB(object):
+	"""
+	SQLite database of the decoded contents of a set of scripts (typically, a whole game dump), for ad-hoc queries.
+	Scripts are identified by their absolute path; see schema for the tables.
+
+	Example, scripts setting $globals[12] and calling setShadowPkmStorageUnit:
+		SELECT DISTINCT s.path FROM scripts s
+		JOIN instructions i ON i.scriptID = s.id AND i.opcode = 4 AND i.variableLevel = 0 AND i.variableID = 12
+		JOIN stdcalls c ON c.scriptID = s.id AND c.name LIKE '%setShadowPkmStorageUnit'
+	"""
+
+	def __init__(self, fname, hardened = False):
+		self.hardened = hardened
+		self.db = sqlite3.connect(fname)
+		self.db.executescript(schema)
+
+	def close(self):
+		self.db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _deleteScript(self, scriptID):
+		for table in dataTables:
+			self.db.execute("DELETE FROM {0} WHERE scriptID = ?".format(table), (scriptID,))
+		self.db.execute("DELETE FROM scripts WHERE id = ?", (scriptID,))
+
+	def update(self, fnames, maxWorkers = None, prune = False):
+		"""
+		Adds the script files fnames to the database, or refreshes them. Files whose mtime and size
+		are unchanged are skipped; the others are parsed in parallel (worker processes), and inserted
+		in a single transaction. Unreadable or invalid files are skipped with a warning (their previous
+		rows, if any, are kept). If prune is True, the scripts not in fnames are removed.
+		Returns the number of (re)loaded scripts.
+		"""
+		known = dict((path, (scriptID, mtime_ns, size)) for (scriptID, path, mtime_ns, size)
+						in self.db.execute("SELECT id, path, mtime_ns, size FROM scripts"))
+		paths = [os.path.abspath(fname) for fname in fnames]
+		stats = dict()
+		for path in paths:
+			try:
+				st = os.stat(path)
+			except OSError as e:
+				warnings.warn("{0}: {1}".format(path, e))
+				continue
+			old = known.get(path)
+			if old is None or old[1:] != (st.st_mtime_ns, st.st_size):
+				stats[path] = st
+
+		results = list(mapFiles(_extractFile, list(stats), maxWorkers, 16, (self.hardened,)))
+
+		with self.db:
+			self.db.execute("PRAGMA synchronous = OFF")
+			if prune:
+				for path in set(known) - set(paths):
+					self._deleteScript(known[path][0])
+			for (path, (sha1, entryPoint, nbWarnings, rows)) in results:
+				st = stats[path]
+				if path in known: self._deleteScript(known[path][0])
+				scriptID = self.db.execute("INSERT INTO scripts (path, mtime_ns, size, sha1, entryPoint, nbWarnings) VALUES (?, ?, ?, ?, ?, ?)",
+					(path, st.st_mtime_ns, st.st_size, sha1, entryPoint, nbWarnings)).lastrowid
+				for table in dataTables:
+					if not rows[table]: continue
+					placeholders = ', '.join('?'*(len(rows[table][0]) + 1))
+					self.db.executemany("INSERT INTO {0} VALUES ({1})".format(table, placeholders), ((scriptID,) + row for row in rows[table]))
+		return len(results)
+
+	def query(self, sql, params = ()):
+		"""Returns the rows of the result of sql"""
+		return self.db.execute(sql, params).fetchall()
@@ -0,0 +1,42 @@
+﻿# See LICENSE for license
+
+import concurrent.futures
+import warnings
+
+def mapChunks(func, items, maxWorkers = None, chunkSize = 16, args = (), initializer = None, initargs = ()):
+	"""
+	Splits items into chunks of chunkSize items, and calls func(*args, chunk) for each chunk in worker processes
+	(set up by initializer(*initargs)), or in this process if maxWorkers is 1 or if there is a single chunk.
+	Yields the results, in order. func, args and the results must be picklable
+	"""
+	chunks = [items[i:i+chunkSize] for i in range(0, len(items), chunkSize)]
+	if maxWorkers == 1 or len(chunks) <= 1:
+		for chunk in chunks: yield func(*args, chunk)
+	else:
+		with concurrent.futures.ProcessPoolExecutor(maxWorkers, initializer = initializer, initargs = initargs) as executor:
+			for ret in executor.map(func, *([arg] * len(chunks) for arg in args), chunks):
+				yield ret
+
+def _processFiles(func, args, errors, fnames):
+	ret = []
+	for fname in fnames:
+		try:
+			with open(fname, "rb") as f:
+				src = f.read()
+			with warnings.catch_warnings():
+				warnings.simplefilter("ignore")
+				ret.append((fname, func(*args, fname, src), None))
+		except errors as e:
+			ret.append((fname, None, str(e)))
+	return ret
+
+def mapFiles(func, fnames, maxWorkers = None, chunkSize = 16, args = (), errors = (OSError, ValueError)):
+	"""
+	Calls func(*args, fname, src) for each script file of fnames (src: its contents), warnings being ignored, in worker
+	processes (see mapChunks). Yields (fname, result) pairs, in order; the files for which an exception among errors
+	(default: OSError, ValueError, e.g. ScriptFormatError) is raised are skipped with a warning
+	"""
+	for partial in mapChunks(_processFiles, fnames, maxWorkers, chunkSize, (func, tuple(args), errors)):
+		for (fname, result, error) in partial:
+			if error is not None: warnings.warn("{0}: {1}".format(fname, error))
+			else: yield (fname, result)
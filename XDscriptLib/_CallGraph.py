@@ -0,0 +1,166 @@
+﻿# See LICENSE for license
+
+import json
+import xml.etree.ElementTree as ET
+from XDscriptLib import FunctionInfo, Instruction
+from XDscriptLib._Graph import stronglyConnectedComponents
+
+class CallGraph(object):
+	"""
+	Call graph of a script, built from its 'call' (script functions) and 'callstd' (standard functions) instructions.
+
+	functions: dict mapping the offset of each function to its name. Functions are the ones listed in HEAD,
+	plus the destinations of 'call' not listed there
+	calls: dict mapping the offset of each function to a dict {callee offset: number of call sites}
+	stdCalls: dict mapping the offset of each function to a dict {(clsID, funcID): number of call sites}
+	frameSizes: dict mapping the offset of each function to the size of its stack frame
+	(return address and local variables allocated with 'reserve')
+	"""
+
+	def __init__(self, ctx):
+		code = ctx.sections["CODE"]
+		head = ctx.sections["HEAD"]
+		instrs = code.instructions
+
+		starts = set(off for off in head.functionOffsets if off < len(instrs))
+		for instr in instrs:
+			if isinstance(instr, Instruction) and instr.opcode == 7 and instr.instructionID < len(instrs):
+				starts.add(instr.instructionID)
+
+		self.functions = dict((off, ctx.getLabel(off)) for off in starts)
+		self.calls = dict((off, dict()) for off in starts)
+		self.stdCalls = dict((off, dict()) for off in starts)
+		self.frameSizes = dict((off, 1) for off in starts)
+
+		current = None
+		for instr in instrs:
+			if not isinstance(instr, Instruction): continue
+			if instr.position in starts: current = instr.position
+			if current is None: continue
+
+			opcode = instr.opcode
+			if opcode == 7 and instr.instructionID < len(instrs):  # call
+				callees = self.calls[current]
+				callees[instr.instructionID] = callees.get(instr.instructionID, 0) + 1
+			elif opcode == 9:  # callstd
+				callees = self.stdCalls[current]
+				key = (instr.subOpcode, instr.parameter)
+				callees[key] = callees.get(key, 0) + 1
+			elif opcode == 13:  # reserve
+				self.frameSizes[current] += instr.subOpcode
+
+		self._sccs = None
+
+	#---------------------Analysis---------------------
+
+	def stronglyConnectedComponents(self):
+		"""
+		Returns the list of the strongly connected components (lists of function offsets) of the graph,
+		callees before callers (Tarjan's algorithm, iterative version)
+		"""
+		if self._sccs is not None:
+			return self._sccs
+
+		self._sccs = [sorted(scc) for scc in stronglyConnectedComponents(sorted(self.functions), self.calls)]
+		return self._sccs
+
+	def recursiveFunctions(self):
+		"""Returns the sorted list of the functions which can (directly or not) call themselves"""
+		ret = []
+		for scc in self.stronglyConnectedComponents():
+			if len(scc) > 1 or scc[0] in self.calls[scc[0]]:
+				ret += scc
+		return sorted(ret)
+
+	def _longestPaths(self, weight):
+		# None means 'unbounded' (recursion)
+		recursive = set(self.recursiveFunctions())
+		ret = dict()
+		for scc in self.stronglyConnectedComponents():
+			for node in scc:
+				if node in recursive:
+					ret[node] = None
+					continue
+				sub = [ret[callee] for callee in self.calls[node]]
+				ret[node] = None if None in sub else weight(node) + max(sub + [0])
+		return ret
+
+	def maxCallDepths(self):
+		"""Returns a dict mapping each function to its maximum call depth (1 for a leaf function, None if unbounded)"""
+		return self._longestPaths(lambda node: 1)
+
+	def maxStackUsages(self):
+		"""
+		Returns a dict mapping each function to an estimation of its worst-case stack usage, in stack entries
+		(sum of the frame sizes along the deepest call path; None if unbounded). The stack of a task has 256 entries.
+		"""
+		return self._longestPaths(lambda node: self.frameSizes[node])
+
+	#---------------------Export---------------------
+
+	def _stdName(self, key):
+		return FunctionInfo.getStdFunctionName(*key)
+
+	def toJSON(self):
+		depths = self.maxCallDepths()
+		stackUsages = self.maxStackUsages()
+		return json.dumps({
+			"functions": [{
+				"offset": off,
+				"name": self.functions[off],
+				"frameSize": self.frameSizes[off],
+				"maxCallDepth": depths[off],
+				"maxStackUsage": stackUsages[off],
+				"calls": [{"offset": callee, "name": self.functions[callee], "count": n} for (callee, n) in sorted(self.calls[off].items())],
+				"stdCalls": [{"name": self._stdName(key), "count": n} for (key, n) in sorted(self.stdCalls[off].items())]
+			} for off in sorted(self.functions)],
+			"recursive": [self.functions[off] for off in self.recursiveFunctions()]
+		}, indent = '\t', ensure_ascii = False)
+
+	def toDOT(self, withStd = True):
+		lines = ['digraph callgraph {']
+		for off in sorted(self.functions):
+			lines.append('\t"{0}";'.format(self.functions[off]))
+		for off in sorted(self.functions):
+			for (callee, n) in sorted(self.calls[off].items()):
+				lines.append('\t"{0}" -> "{1}" [label="{2}"];'.format(self.functions[off], self.functions[callee], n))
+			if withStd:
+				for (key, n) in sorted(self.stdCalls[off].items()):
+					lines.append('\t"{0}" -> "{1}" [label="{2}", style=dashed];'.format(self.functions[off], self._stdName(key), n))
+		lines.append('}')
+		return '\n'.join(lines) + '\n'
+
+	def toGraphML(self, withStd = True):
+		root = ET.Element("graphml", xmlns = "http://graphml.graphdrawing.org/xmlns")
+		ET.SubElement(root, "key", {"id": "name", "for": "node", "attr.name": "name", "attr.type": "string"})
+		ET.SubElement(root, "key", {"id": "std", "for": "node", "attr.name": "std", "attr.type": "boolean"})
+		ET.SubElement(root, "key", {"id": "count", "for": "edge", "attr.name": "count", "attr.type": "int"})
+		graph = ET.SubElement(root, "graph", id = "callgraph", edgedefault = "directed")
+
+		def addNode(nodeID, name, std):
+			node = ET.SubElement(graph, "node", id = nodeID)
+			ET.SubElement(node, "data", key = "name").text = name
+			ET.SubElement(node, "data", key = "std").text = "true" if std else "false"
+
+		def addEdge(src, dst, n):
+			edge = ET.SubElement(graph, "edge", source = src, target = dst)
+			ET.SubElement(edge, "data", key = "count").text = str(n)
+
+		stdNodes = set()
+		for off in sorted(self.functions):
+			addNode(hex(off), self.functions[off], False)
+		for off in sorted(self.functions):
+			for (callee, n) in sorted(self.calls[off].items()):
+				addEdge(hex(off), hex(callee), n)
+			if withStd:
+				for (key, n) in sorted(self.stdCalls[off].items()):
+					nodeID = "std_{0}_{1}".format(*key)
+					if nodeID not in stdNodes:
+						stdNodes.add(nodeID)
+						addNode(nodeID, self._stdName(key), True)
+					addEdge(hex(off), nodeID, n)
+		return ET.tostring(root, encoding = "unicode")
+
+def getCallGraph(ctx):
+	"""Returns the call graph of ctx, which is cached with ctx until CODE is modified"""
+	return ctx.cached("callGraph", CallGraph)
@@ -0,0 +1,107 @@
+﻿# See LICENSE for license
+
+import collections
+from XDscriptLib import FunctionInfo, Instruction
+
+DeadCodeInfo = collections.namedtuple("DeadCodeInfo", "functions blocks")
+
+def findReachable(ctx, commonScript = False):
+	"""
+	Returns a bytearray telling, for each word of CODE, whether it is a reachable instruction.
+
+	Roots: the entry point, the functions exported in FTBL (this includes the special callbacks, see FunctionInfo),
+	the functions referred to by their ID ('ldimm int, =0x596000xx', see the task creation functions),
+	and, for the common script, its special callbacks.
+	"""
+	code = ctx.sections["CODE"]
+	head = ctx.sections["HEAD"]
+	ftbl = ctx.sections.get("FTBL")
+	instrs = code.instructions
+	nbWords = len(instrs)
+
+	roots = [head.valueOffset]
+	if ftbl is not None:
+		roots += [off for (off, nm) in ftbl.functionTable]
+	if commonScript:
+		roots += [head.functionOffsets[i] for i in FunctionInfo.commonScriptCallbacks if i < len(head.functionOffsets)]
+
+	reached = bytearray(nbWords)
+	while roots:
+		pos = roots.pop()
+		while 0 <= pos < nbWords and not reached[pos] and isinstance(instrs[pos], Instruction):
+			reached[pos] = 1
+			instr = instrs[pos]
+			opcode = instr.opcode
+			if opcode in (7, 10, 11, 12):  # call/jmptrue/jmpfalse/jmp
+				roots.append(instr.instructionID)
+			elif opcode == 2 and instr.subOpcode == 1:  # ldimm int
+				index = FunctionInfo.getFunctionIndexFromID(instrs[pos + 1] & 0xffffffff)
+				if index is not None and index < len(head.functionOffsets):
+					roots.append(head.functionOffsets[index])
+
+			if opcode in (8, 12, 15):  # return, jmp, exit
+				break
+			pos = instr.nextPosition
+
+	return reached
+
+def findDeadCode(ctx, commonScript = False):
+	"""
+	Returns a DeadCodeInfo:
+		- functions: the indices (in HEAD) of the unreachable functions
+		- blocks: the (start, end) ranges of unreachable instructions in the reachable functions, end being exclusive
+	"""
+	code = ctx.sections["CODE"]
+	head = ctx.sections["HEAD"]
+	instrs = code.instructions
+	reached = findReachable(ctx, commonScript)
+
+	functions = [i for (i, off) in enumerate(head.functionOffsets) if not (0 <= off < len(instrs) and reached[off])]
+	deadStarts = set(head.functionOffsets[i] for i in functions)
+	liveStarts = set(head.functionOffsets) - deadStarts
+
+	blocks = []
+	pos = 0
+	inDeadFunction = False
+	while pos < len(instrs):
+		if pos in deadStarts: inDeadFunction = True
+		elif pos in liveStarts: inDeadFunction = False
+
+		if reached[pos] or inDeadFunction or not isinstance(instrs[pos], Instruction):
+			pos += 1
+			continue
+
+		start = pos
+		while pos < len(instrs) and not reached[pos] and pos not in deadStarts:
+			pos = instrs[pos].nextPosition if isinstance(instrs[pos], Instruction) else pos + 1
+		blocks.append((start, pos))
+
+	return DeadCodeInfo(functions, blocks)
+
+def stripDeadCode(ctx, commonScript = False, keepFunctionIDs = True):
+	"""
+	Removes the dead code found by findDeadCode, using the CODE editing API of ScriptCtx. Returns the DeadCodeInfo.
+	If keepFunctionIDs is True, the unreachable functions are reduced to a single 'return' instead of being deleted,
+	so that the indices of the other functions (thus their IDs) are preserved.
+	"""
+	info = findDeadCode(ctx, commonScript)
+	code = ctx.sections["CODE"]
+	head = ctx.sections["HEAD"]
+
+	# Dead call/jump instructions must not prevent dead code from being deleted
+	ranges = info.blocks + [ctx.functionExtent(i) for i in info.functions]
+	for (start, end) in ranges:
+		for instr in code.instructions[start:end]:
+			if isinstance(instr, Instruction) and instr.opcode in (7, 10, 11, 12):
+				instr.opcode = 0
+
+	for (start, end) in sorted(info.blocks, reverse = True):
+		ctx.deleteInstructions(start, end - start)
+
+	for i in sorted(info.functions, reverse = True):
+		if keepFunctionIDs:
+			ctx.replaceFunction(i, [Instruction(0x08000000)])  # return
+		else:
+			ctx.deleteFunction(i)
+
+	return info
@@ -0,0 +1,605 @@
+﻿# See LICENSE for license
+
+import collections
+import math
+import operator
+import threading
+from XDscriptLib import FunctionInfo, Instruction
+from XDscriptLib._ScriptVar import wellDefinedTypes
+
+Handle = collections.namedtuple("Handle", "kind index")
+Handle.__doc__ = """Opaque value: special variables ('singleton', 'character', 'array', 'special'), or ldimm constants of other types (type name)"""
+
+class ScriptRuntimeError(RuntimeError):
+	"""Raised when an emulated script performs an invalid operation"""
+	pass
+
+class StepLimitExceeded(ScriptRuntimeError):
+	pass
+
+class _ScriptExit(Exception):
+	pass
+
+stackSize = 256 # entries, per task
+
+#---------------------Operators---------------------
+
+def _toS32(val):
+	val &= 0xffffffff
+	return val - 0x100000000 if val & 0x80000000 else val
+
+def _isNumber(val):
+	return type(val) is int or type(val) is float
+
+def _numeric(name, intOp, floatOp):
+	"""Binary arithmetic operator: 32-bit on ints, float otherwise, componentwise on vectors"""
+	def op(a, b):
+		if type(a) is int and type(b) is int: return _toS32(intOp(a, b))
+		if _isNumber(a) and _isNumber(b): return floatOp(float(a), float(b))
+		if type(a) is tuple and type(b) is tuple: return tuple(floatOp(float(x), float(y)) for (x, y) in zip(a, b))
+		if type(a) is tuple and _isNumber(b): return tuple(floatOp(float(x), float(b)) for x in a)
+		if _isNumber(a) and type(b) is tuple: return tuple(floatOp(float(a), float(y)) for y in b)
+		raise ScriptRuntimeError("{0}: unsupported operands {1!r}, {2!r}".format(name, a, b))
+	return op
+
+def _bitwise(name, intOp):
+	def op(a, b):
+		if type(a) is not int or type(b) is not int:
+			raise ScriptRuntimeError("{0}: unsupported operands {1!r}, {2!r}".format(name, a, b))
+		return _toS32(intOp(a, b))
+	return op
+
+def _intDiv(a, b):
+	if b == 0: raise ScriptRuntimeError("div: division by zero")
+	q = abs(a) // abs(b)
+	return q if (a < 0) == (b < 0) else -q
+
+def _floatDiv(a, b):
+	if b == 0: raise ScriptRuntimeError("div: division by zero")
+	return a / b
+
+def _vectorDiv(a, b):
+	# dividing vectors by 0 is allowed
+	return a / b if b != 0 else math.copysign(math.inf, a) if a != 0 else math.nan
+
+_vectorDivision = _numeric("div", None, _vectorDiv)
+
+def _div(a, b):
+	if type(a) is int and type(b) is int: return _toS32(_intDiv(a, b))
+	if _isNumber(a) and _isNumber(b): return _floatDiv(float(a), float(b))
+	return _vectorDivision(a, b)
+
+def _mod(a, b):
+	a, b = _toInt(a), _toInt(b)
+	if b == 0: raise ScriptRuntimeError("mod: division by zero")
+	return _toS32(int(math.fmod(a, b)))
+
+_numericAdd = _numeric("add", operator.add, operator.add)
+_numericMul = _numeric("mul", operator.mul, operator.mul)
+
+def _add(a, b):
+	if type(a) is str and type(b) is str: return a + b
+	return _numericAdd(a, b)
+
+def _mul(a, b):
+	if type(a) is str and type(b) is int: return a * b
+	if type(a) is int and type(b) is str: return b * a
+	return _numericMul(a, b)
+
+def _wildcardMatch(s, pattern):
+	"""'?' matches any character, '*' matches everything after it"""
+	for (i, c) in enumerate(pattern):
+		if c == '*': return True
+		if i >= len(s) or (c != '?' and c != s[i]): return False
+	return len(s) == len(pattern)
+
+def _compare(name, cmp):
+	def op(a, b):
+		if type(a) is int and type(b) is int: return 1 if cmp(a, b) else 0
+		if type(a) is str and type(b) is str:
+			if name in ("equ", "neq"): return int(_wildcardMatch(a, b) == (name == "equ"))
+			return int(cmp(len(a), len(b))) # strings are ordered by length
+		if (_isNumber(a) and _isNumber(b)) or (type(a) is tuple and type(b) is tuple) or name in ("equ", "neq"):
+			return int(cmp(a, b))
+		raise ScriptRuntimeError("{0}: unsupported operands {1!r}, {2!r}".format(name, a, b))
+	return op
+
+def _toInt(a):
+	if type(a) is int: return a
+	if type(a) is float: return _toS32(int(a)) if math.isfinite(a) else 0
+	if type(a) is str:
+		try: return _toS32(int(a, 0))
+		except ValueError: return 0
+	raise ScriptRuntimeError("int: unsupported operand {0!r}".format(a))
+
+def _toFloat(a):
+	if _isNumber(a): return float(a)
+	if type(a) is str:
+		try: return float(a)
+		except ValueError: return 0.0
+	raise ScriptRuntimeError("float: unsupported operand {0!r}".format(a))
+
+def _toStr(a):
+	return "{0:.7g}".format(a) if type(a) is float else str(a)
+
+def _coordinate(index):
+	def op(a):
+		if type(a) is not tuple: raise ScriptRuntimeError("getv: {0!r} is not a vector".format(a))
+		return a[index]
+	return op
+
+# Implementations of the operators of FunctionInfo.operators, by name
+operatorImplementations = {
+	"not": lambda a: int(not a),
+	"neg": lambda a: _toS32(-a) if type(a) is int else tuple(-x for x in a) if type(a) is tuple else -a,
+	"hex": lambda a: "{0:x}".format(_toInt(a) & 0xffffffff),
+	"str": _toStr,
+	"int": _toInt,
+	"float": _toFloat,
+	"getvx": _coordinate(0),
+	"getvy": _coordinate(1),
+	"getvz": _coordinate(2),
+	"zerofloat": lambda a: 0.0,
+	"xor": _bitwise("xor", operator.xor),
+	"or": _bitwise("or", operator.or_),
+	"and": _bitwise("and", operator.and_),
+	"add": _add,
+	"sub": _numeric("sub", operator.sub, operator.sub),
+	"mul": _mul,
+	"div": _div,
+	"mod": _mod,
+	"equ": _compare("equ", operator.eq),
+	"gt": _compare("gt", operator.gt),
+	"ge": _compare("ge", operator.ge),
+	"lt": _compare("lt", operator.lt),
+	"le": _compare("le", operator.le),
+	"neq": _compare("neq", operator.ne),
+}
+
+_operatorInfo = { entry.index: entry for entry in FunctionInfo.operators if isinstance(entry, FunctionInfo.OperatorInfo) }
+_stdFunctionInfo = { (c.index, f.index): f for c in FunctionInfo.classes if isinstance(c, FunctionInfo.ClassInfo) and c.funcs is not None
+					 for f in c.funcs if isinstance(f, FunctionInfo.FunctionInfo) }
+
+def _setCoordinate(vector, index, value):
+	if type(vector) is not tuple or index > 2: raise ScriptRuntimeError("setvector: {0!r} is not a vector".format(vector))
+	return vector[:index] + (float(value),) + vector[index+1:]
+
+#---------------------Compilation---------------------
+
+class _Block(object):
+	"""
+	Basic block being generated. The values pushed by the block are kept as Python expressions (pending), and
+	only stored to the stack when needed: e.g. 'ldimm int, =1; ldvar $globals[0]; operator add; setvar $globals[0]'
+	becomes 'G[0] = op_add(1, G[0])'. Pending expressions reading variables are flushed before anything that
+	may modify a variable, and all of them before anything that uses the stack itself. Local variables must
+	have been allocated with 'reserve' (otherwise, reading a slot holding a pending value fails at run time,
+	and ScriptEmulator reports it as a ScriptRuntimeError)
+	"""
+
+	def __init__(self):
+		self.lines = []
+		self.pending = [] # (expression, whether it reads variables)
+		self.skip = None
+		self._nbTemps = 0
+
+	def temp(self):
+		self._nbTemps += 1
+		return "t{0}".format(self._nbTemps - 1)
+
+	def push(self, expression, volatile):
+		self.pending.append((expression, volatile))
+
+	def flush(self, volatileOnly = False):
+		"""Stores the pending values to the stack (if volatileOnly is True, only up to the last one reading a variable)"""
+		n = len(self.pending)
+		if volatileOnly:
+			while n > 0 and not self.pending[n-1][1]: n -= 1
+		expressions = [expression for (expression, _) in self.pending[:n]]
+		if len(expressions) == 1: self.lines.append("s.append({0})".format(expressions[0]))
+		elif expressions: self.lines.append("s += ({0})".format(", ".join(expressions)))
+		del self.pending[:n]
+
+	def popExpressions(self, n):
+		"""Pops n values; returns their expressions, top of the stack first, and whether one of them reads a variable"""
+		if n <= len(self.pending):
+			popped = self.pending[len(self.pending)-n:][::-1]
+			del self.pending[len(self.pending)-n:]
+			return [expression for (expression, _) in popped], any(volatile for (_, volatile) in popped)
+		# evaluate the pending expressions before the stack is modified
+		ret = []
+		for (expression, _) in self.pending:
+			name = self.temp()
+			self.lines.append("{0} = {1}".format(name, expression))
+			ret.insert(0, name)
+		nb = n - len(self.pending)
+		self.pending = []
+		name = self.temp()
+		if nb == 1:
+			self.lines.append("{0} = s.pop()".format(name))
+			return ret + [name], False
+		self.lines += ["{0} = s[-{1}:]".format(name, nb), "del s[-{0}:]".format(nb)]
+		return ret + ["{0}[{1}]".format(name, i) for i in reversed(range(nb))], False
+
+	def drop(self, n):
+		nb = n - min(n, len(self.pending))
+		del self.pending[len(self.pending) - min(n, len(self.pending)):]
+		if nb > 0: self.lines.append("del s[-{0}:]".format(nb))
+
+class _CodeGenerator(object):
+	"""
+	Generates the Python source of the basic blocks of a function. If traced is True, the stack is kept up to date
+	before each instruction, which is reported to m.tracer (see ScriptEmulator)
+	"""
+
+	def __init__(self, ctx, traced = False):
+		self.ctx = ctx
+		self.traced = traced
+		self.code = ctx.sections["CODE"]
+		self.constants = []
+		self._constantIndices = dict()
+		self.stdFunctions = []
+		self._stdFunctionIndices = dict()
+		fixups = ctx.getFixupIndex()
+		self.leaders = set(fixups) | set(ctx.sections["HEAD"].functionOffsets)
+		for instr in self.code.instructions:
+			if isinstance(instr, Instruction) and instr.opcode in (10, 11): self.leaders.add(instr.nextPosition)
+
+	def constant(self, value):
+		key = (type(value), repr(value))
+		if key not in self._constantIndices:
+			self._constantIndices[key] = len(self.constants)
+			self.constants.append(value)
+		return "K[{0}]".format(self._constantIndices[key])
+
+	def stdFunction(self, clsID, funcID):
+		"""Returns the index of the standard function (clsID, funcID) in the handler table of the emulator"""
+		key = (clsID, funcID)
+		if key not in self._stdFunctionIndices:
+			self._stdFunctionIndices[key] = len(self.stdFunctions)
+			self.stdFunctions.append(key)
+		return self._stdFunctionIndices[key]
+
+	def variable(self, instr):
+		"""Returns the Python expression of the variable accessed by instr, and whether it can be assigned"""
+		level, param = instr.subOpcode & 0xf, instr.parameter
+		if level == 0: return "G[{0}]".format(param), True
+		elif level == 1:
+			index = (param & 0xff) - 0x100 if param & 0x80 else param & 0xff # signed 8-bit offset from the return address
+			return "s[fp - {0}]".format(index) if index >= 0 else "s[fp + {0}]".format(-index), True
+		elif level == 2: return "m.lastResult", True
+		if 0 <= param < 0x80: value = Handle("singleton", param)
+		elif 0x80 <= param <= 0x120: value = Handle("character", param - 0x80)
+		elif 0x200 <= param <= 0x2ff: value = Handle("array", param - 0x200)
+		else: value = Handle("special", param)
+		return self.constant(value), False
+
+	def immediate(self, instr):
+		t, param = instr.subOpcode, instr.parameter
+		imm = self.code.instructions[instr.position + 1] if instr.nextPosition == instr.position + 2 else None
+		if t in (0, 0x35, 1, 2) and imm is None: return None
+		if t == 0: return self.constant(None if imm == 0 else Handle("none_t", imm))
+		elif t == 1: return repr(imm)
+		elif t == 2: return self.constant(imm)
+		elif t == 0x35: return repr(imm)
+		elif t == 3:
+			strg = self.ctx.sections.get("STRG")
+			return self.constant(strg.getString(param) if strg is not None else Handle("str", param))
+		elif t == 4:
+			vect = self.ctx.sections.get("VECT")
+			return self.constant(vect.vectors[param] if vect is not None and 0 <= param < len(vect.vectors) else Handle("vector", param))
+		return self.constant(Handle(wellDefinedTypes.get(t, str(t)), param & 0xffff))
+
+	def instruction(self, instr, block):
+		"""
+		Generates instr into block. Returns the expression of the position of the next block, or None if control
+		falls through (to instr.nextPosition)
+		"""
+		opcode, sub, param = instr.opcode, instr.subOpcode, instr.parameter
+		instrs = self.code.instructions
+		def fail(msg):
+			block.lines.append("raise ScriptRuntimeError({0!r})".format("{0} (instruction #{1})".format(msg, hex(instr.position))))
+			return "None"
+
+		if opcode == 0: pass
+		elif opcode == 16: block.lines.append("m.line = {0}".format(param))
+		elif opcode == 1:
+			info = _operatorInfo.get(sub)
+			if info is None or info.name not in operatorImplementations: return fail("invalid operator {0}".format(sub))
+			operands, volatile = block.popExpressions(info.nbOperands)
+			block.push("op_{0}({1})".format(info.name, ", ".join(reversed(operands))), volatile)
+		elif opcode == 2:
+			value = self.immediate(instr)
+			if value is None: return fail("missing immediate value")
+			block.push(value, False)
+		elif opcode in (3, 17):  # ldvar, ldncpvar
+			var, assignable = self.variable(instr)
+			block.push(var, assignable)
+		elif opcode in (4, 5):  # setvar, setvector
+			var, assignable = self.variable(instr)
+			if not assignable: return fail("cannot change immutable reference" if opcode == 4 else "invalid vector storage type")
+			value = block.popExpressions(1)[0][0]
+			block.flush(True)
+			block.lines.append("{0} = {1}".format(var, value) if opcode == 4 else "{0} = setCoordinate({0}, {1}, {2})".format(var, sub >> 4, value))
+		elif opcode == 6:
+			block.drop(sub)
+		elif opcode in (13, 14):  # reserve, release
+			block.flush()
+			if sub > 0: block.lines.append("s.extend({0})".format(self.constant((0,)*sub)) if opcode == 13 else "del s[-{0}:]".format(sub))
+		elif opcode == 7:
+			block.flush()
+			block.lines += ["s.append({0})".format(instr.nextPosition), "m._call({0})".format(instr.instructionID)]
+		elif opcode == 8:
+			return "None"
+		elif opcode == 9:
+			# the caller pops the parameters right after the call, which gives their actual number
+			nxt = instrs[instr.nextPosition] if instr.nextPosition < len(instrs) else None
+			if self.traced:
+				# not fused with the 'pop', which has its own step
+				info = _stdFunctionInfo.get((sub, param))
+				nbArgs = nxt.subOpcode if isinstance(nxt, Instruction) and nxt.opcode == 6 else info.nbParams if info is not None else 0
+				block.flush()
+				block.lines += ["a = s[:-{0}:-1]".format(nbArgs + 1), "r = H[{0}](m, a)".format(self.stdFunction(sub, param)),
+								"m.lastResult = 0 if r is None else r", "m.tracer.stdCall({0}, {1}, a, m.lastResult)".format(sub, param)]
+			elif isinstance(nxt, Instruction) and nxt.opcode == 6 and nxt.position not in self.leaders:
+				args = block.popExpressions(nxt.subOpcode)[0]
+				block.flush(True)
+				block.lines.append("r = H[{0}](m, [{1}])".format(self.stdFunction(sub, param), ", ".join(args)))
+				block.lines.append("m.lastResult = 0 if r is None else r")
+				block.skip = nxt # already done
+			else:
+				info = _stdFunctionInfo.get((sub, param))
+				nbParams = info.nbParams if info is not None else 0
+				block.flush()
+				block.lines.append("r = H[{0}](m, s[:-{1}:-1])".format(self.stdFunction(sub, param), nbParams + 1))
+				block.lines.append("m.lastResult = 0 if r is None else r")
+		elif opcode in (10, 11, 12):
+			dest = instr.instructionID
+			if not isinstance(instrs[dest] if dest < len(instrs) else None, Instruction):
+				return fail("invalid destination {0}".format(hex(dest)))
+			if opcode == 12:
+				block.flush()
+				return str(dest)
+			condition = block.popExpressions(1)[0][0]
+			block.flush()
+			taken, other = (dest, instr.nextPosition) if opcode == 10 else (instr.nextPosition, dest)
+			return "{0} if {1} else {2}".format(taken, condition, other)
+		elif opcode == 15:
+			block.lines.append("raise ScriptExit()")
+			return "None"
+		else:
+			return fail("illegal opcode {0}".format(opcode))
+		return None
+
+	def block(self, start, successors):
+		"""Returns the source of the block at start, and appends its successors to successors"""
+		instrs = self.code.instructions
+		block = _Block()
+		pos = start
+		nb = 0
+		while True:
+			instr = instrs[pos]
+			nb += 1
+			if self.traced:
+				block.flush()
+				block.lines.append("m.tracer.step({0}, s)".format(pos))
+			nextBlock = self.instruction(instr, block)
+			if block.skip is not None:
+				instr, block.skip = block.skip, None
+				nb += 1
+			if nextBlock is not None:
+				if instr.opcode in (10, 11, 12) and nextBlock != "None":
+					successors += [instr.instructionID] + ([instr.nextPosition] if instr.opcode != 12 else [])
+				break
+			pos = instr.nextPosition
+			if pos >= len(instrs) or not isinstance(instrs[pos], Instruction):
+				block.lines.append("raise ScriptRuntimeError({0!r})".format("end of CODE reached (instruction #{0})".format(hex(instr.position))))
+				nextBlock = "None"
+				break
+			if pos in self.leaders:
+				block.flush()
+				nextBlock = str(pos)
+				successors.append(pos)
+				break
+		body = ["m.steps += {0}".format(nb), "if m.steps > m.maxSteps: m.stepLimitExceeded()"] + block.lines + ["return " + nextBlock]
+		return "def block_{0:x}(m, s, fp, G, H):\n\t{1}\n".format(start, "\n\t".join(body))
+
+	def function(self, entry):
+		"""Returns the source of the blocks reachable from entry (without following calls), and their positions"""
+		sources = []
+		positions = []
+		seen = set()
+		pending = [entry]
+		while pending:
+			pos = pending.pop()
+			if pos in seen: continue
+			seen.add(pos)
+			successors = []
+			sources.append(self.block(pos, successors))
+			positions.append(pos)
+			pending += reversed(successors)
+		return "\n".join(sources), positions
+
+class CompiledScript(object):
+	"""
+	The functions of a script, compiled to Python: each basic block becomes a generated Python function
+	(operators, constants and variable accesses being resolved at compile time) returning the position
+	of the next block. See compileScript and ScriptEmulator
+	"""
+
+	def __init__(self, ctx, traced = False):
+		self.traced = traced
+		generator = _CodeGenerator(ctx, traced)
+		instrs = generator.code.instructions
+		namespace = { "ScriptRuntimeError": ScriptRuntimeError, "ScriptExit": _ScriptExit, "setCoordinate": _setCoordinate,
+					  "K": generator.constants }
+		namespace.update(("op_" + name, op) for (name, op) in operatorImplementations.items())
+		self.functionTable = { name: off for (off, name) in ctx.sections["FTBL"].functionTable } if "FTBL" in ctx.sections else {}
+		self.functionOffsets = list(ctx.sections["HEAD"].functionOffsets)
+
+		# functions: HEAD, and call destinations
+		entries = set(off for off in self.functionOffsets if 0 <= off < len(instrs) and isinstance(instrs[off], Instruction))
+		entries |= set(instr.instructionID for instr in instrs if isinstance(instr, Instruction) and instr.opcode == 7 and
+					   instr.instructionID < len(instrs) and isinstance(instrs[instr.instructionID], Instruction))
+		generator.leaders |= entries
+		self.sources = dict()
+		self._functions = dict()
+		for entry in sorted(entries):
+			source, positions = generator.function(entry)
+			exec(compile(source, "<script function {0}>".format(hex(entry)), "exec"), namespace)
+			self._functions[entry] = { pos: namespace["block_{0:x}".format(pos)] for pos in positions }
+			self.sources[entry] = source
+		self.stdFunctions = generator.stdFunctions
+
+	def function(self, entry):
+		"""Returns the dict mapping the position of each block of the function at entry to its compiled block"""
+		blocks = self._functions.get(entry)
+		if blocks is None: raise ScriptRuntimeError("invalid function offset {0}".format(hex(entry)))
+		return blocks
+
+_compiledScripts = collections.OrderedDict()
+_compiledScriptsLock = threading.Lock()
+maxCompiledScripts = 64
+
+def compileScript(ctx, traced = False):
+	"""
+	Returns the CompiledScript of ctx (traced: see _CodeGenerator). Compiled scripts are cached by contents
+	(see ScriptCtx.contentDigest), keeping the maxCompiledScripts most recently used ones
+	"""
+	key = (ctx.contentDigest(), traced)
+	with _compiledScriptsLock:
+		compiled = _compiledScripts.get(key)
+		if compiled is not None:
+			_compiledScripts.move_to_end(key)
+			return compiled
+	compiled = CompiledScript(ctx, traced)
+	with _compiledScriptsLock:
+		compiled = _compiledScripts.setdefault(key, compiled)
+		_compiledScripts.move_to_end(key)
+		while len(_compiledScripts) > maxCompiledScripts:
+			_compiledScripts.popitem(last = False)
+	return compiled
+
+#---------------------Execution---------------------
+
+class ScriptEmulator(object):
+	"""
+	Executes the functions of a script (compiled with compileScript), on a single task.
+
+	Values are Python objects: int (32-bit), float, str, vectors as (x, y, z) tuples, None (none_t),
+	and Handle objects for the special variables and the other constant types.
+	Standard functions (callstd) are dispatched to stdHandlers, a dict mapping (clsID, funcID) or names
+	('yield', 'Player::processEvents'...) to handler(emulator, args), args being the values the caller pops
+	after the call, top of the stack first (i.e. the instance, then the parameters). When no 'pop' follows the
+	call, args holds the top nbParams stack values of the function's entry in the standard-function table
+	instead, which includes the instance for some functions only: handlers should not rely on len(args) or on
+	the instance being present in that case. The value returned by the handler is stored in $lastResult (int(0) if it returns None). Unhandled calls return 0 and are counted
+	in stdCalls. maxSteps bounds the total number of instructions executed by the emulator (StepLimitExceeded).
+	If tracer is set (e.g. a TraceRecorder), the script is compiled in traced mode, which is slower, and the
+	execution is reported to it.
+
+		emu = ScriptEmulator(ctx, { "getFlag": lambda emu, args: flags[args[0]] })
+		emu.call("door_open", 1, 2)
+	"""
+
+	def __init__(self, ctx, stdHandlers = None, maxSteps = None, tracer = None):
+		self.tracer = tracer
+		self.script = compileScript(ctx, tracer is not None)
+		if tracer is not None: tracer.attach(ctx)
+		self._stdHandlers = dict()
+		self.maxSteps = math.inf if maxSteps is None else maxSteps
+		self.steps = 0
+		self.line = None
+		self.lastResult = 0
+		self.stack = []
+		self.stdCalls = collections.Counter()
+		self._stdTable = [self._unhandledStdCall(key) for key in self.script.stdFunctions]
+		for (key, handler) in (stdHandlers or {}).items():
+			self.setStdHandler(key, handler)
+		gvar = ctx.sections.get("GVAR")
+		self.globals = collections.defaultdict(int)
+		for (i, var) in enumerate(gvar.globalVars if gvar is not None else ()):
+			if var.varType in (1, 2): self.globals[i] = var.value
+			elif var.varType == 0 and var.value == 0: self.globals[i] = None
+			else: self.globals[i] = Handle(wellDefinedTypes.get(var.varType, str(var.varType)), var.value)
+
+	def stepLimitExceeded(self):
+		raise StepLimitExceeded("step limit exceeded ({0} steps)".format(self.maxSteps))
+
+	def setStdHandler(self, function, handler):
+		"""Sets the handler of the standard function function ((clsID, funcID) or name); None restores the default one"""
+		key = _stdFunctionKey(function)
+		if handler is None: self._stdHandlers.pop(key, None)
+		else: self._stdHandlers[key] = handler
+		if key in self.script.stdFunctions:
+			self._stdTable[self.script.stdFunctions.index(key)] = handler or self._unhandledStdCall(key)
+
+	def _unhandledStdCall(self, key):
+		def handler(emulator, args):
+			self.stdCalls[key] += 1
+			return 0
+		return handler
+
+	def _call(self, entry):
+		stack = self.stack
+		if len(stack) > stackSize: raise ScriptRuntimeError("stack overflow")
+		blocks = self.script.function(entry)
+		fp = len(stack) - 1
+		G = self.globals
+		H = self._stdTable
+		pc = entry
+		try:
+			if self.tracer is None:
+				while pc is not None:
+					pc = blocks[pc](self, stack, fp, G, H)
+			else:
+				self.tracer.enter(entry)
+				try:
+					while pc is not None:
+						pc = blocks[pc](self, stack, fp, G, H)
+				finally:
+					self.tracer.leave()
+		except (IndexError, TypeError) as e:
+			# stack slots which were never pushed, operands of the wrong type...
+			raise ScriptRuntimeError("{0}: {1} (block #{2})".format(type(e).__name__, e, hex(pc))) from e
+		del stack[fp:]
+
+	def call(self, function, *args):
+		"""
+		Calls function (FTBL name, or HEAD index) with args. Returns $lastResult, or None if the script
+		exited ('exit')
+		"""
+		if isinstance(function, str):
+			if function not in self.script.functionTable: raise ValueError("unknown function '{0}'".format(function))
+			entry = self.script.functionTable[function]
+		elif 0 <= function < len(self.script.functionOffsets):
+			entry = self.script.functionOffsets[function]
+		else:
+			raise ValueError("invalid function index {0}".format(function))
+		return self.callEntry(entry, *args)
+
+	def callEntry(self, entry, *args):
+		"""Same as call, for the function at entry (position in CODE)"""
+		depth = len(self.stack)
+		self.stack += reversed(args)
+		self.stack.append(-1) # return address
+		if self.tracer is not None: self.tracer.beginCall(entry, args, self.globals, self.lastResult)
+		ret = None
+		try:
+			self._call(entry)
+			ret = self.lastResult
+		except _ScriptExit:
+			pass
+		except BaseException as e:
+			if self.tracer is not None: self.tracer.abortCall(e)
+			raise
+		finally:
+			del self.stack[depth:]
+		if self.tracer is not None: self.tracer.endCall(ret)
+		return ret
+
+def _stdFunctionKey(key):
+	if isinstance(key, tuple): return key
+	for (clsID, (_, funcs)) in FunctionInfo.stdfunctions_name_dict.items():
+		for funcID in funcs:
+			if FunctionInfo.getStdFunctionName(clsID, funcID) == key: return (clsID, funcID)
+	raise ValueError("unknown standard function '{0}'".format(key))
@@ -0,0 +1,504 @@
+﻿# See LICENSE for license
+
+import bisect
+import collections
+import json
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from XDscriptLib import getCallGraph
+from XDscriptLib._Emulator import Handle, ScriptEmulator, ScriptRuntimeError
+
+TraceStep = collections.namedtuple("TraceStep", "step position stack")
+TraceStdCall = collections.namedtuple("TraceStdCall", "step clsID funcID args result")
+TraceCall = collections.namedtuple("TraceCall", "step entry args globals lastResult")
+TraceReturn = collections.namedtuple("TraceReturn", "step result")
+TraceAbort = collections.namedtuple("TraceAbort", "step error")
+TraceInvocation = collections.namedtuple("TraceInvocation", "offset name firstStep endStep")
+
+traceVersion = 1
+_header = struct.Struct("<4sHH")
+_trailer = struct.Struct("<QIQI4s")
+
+# Events (one tag byte each)
+_STEP, _STDCALL, _CALL, _RETURN, _ABORT = range(5)
+
+# Values (one tag byte each)
+_NONE, _INT, _FLOAT, _STRREF, _STR, _VECTOR, _HANDLE = range(7)
+_double = struct.Struct("<d")
+_vector = struct.Struct("<3d")
+
+class TraceDivergence(ScriptRuntimeError):
+	"""Raised by replayTrace when the execution does not follow the trace"""
+	pass
+
+class _ReplayAbort(Exception):
+	pass
+
+def _same(a, b):
+	return a is b or (type(a) is type(b) and a == b)
+
+#---------------------Encoding---------------------
+
+class _Encoder(object):
+	"""Encoding of a chunk: varints, values, and the table of the strings already written in the chunk"""
+
+	def __init__(self):
+		self.buf = bytearray()
+		self.strings = dict()
+
+	def varint(self, n):
+		buf = self.buf
+		while n >= 0x80:
+			buf.append((n & 0x7f) | 0x80)
+			n >>= 7
+		buf.append(n)
+
+	def zigzag(self, n):
+		self.varint(2*n if n >= 0 else -2*n - 1)
+
+	def string(self, s):
+		index = self.strings.get(s)
+		if index is not None:
+			self.buf.append(_STRREF)
+			self.varint(index)
+		else:
+			self.strings[s] = len(self.strings)
+			data = s.encode('utf-8', 'surrogatepass')
+			self.buf.append(_STR)
+			self.varint(len(data))
+			self.buf += data
+
+	def value(self, value):
+		t = type(value)
+		if t is int:
+			self.buf.append(_INT)
+			self.zigzag(value)
+		elif value is None:
+			self.buf.append(_NONE)
+		elif t is float:
+			self.buf.append(_FLOAT)
+			self.buf += _double.pack(value)
+		elif t is str:
+			self.string(value)
+		elif t is Handle:
+			self.buf.append(_HANDLE)
+			self.string(str(value.kind))
+			self.zigzag(value.index)
+		elif t is tuple and len(value) == 3:
+			self.buf.append(_VECTOR)
+			self.buf += _vector.pack(*value)
+		else:
+			# values returned by custom standard function handlers
+			self.value(int(value) if t is bool else repr(value))
+
+	def values(self, values):
+		self.varint(len(values))
+		for value in values: self.value(value)
+
+class _Decoder(object):
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+		self.strings = []
+
+	def varint(self):
+		data = self.data
+		ret = shift = 0
+		while True:
+			b = data[self.pos]
+			self.pos += 1
+			ret |= (b & 0x7f) << shift
+			if b < 0x80: return ret
+			shift += 7
+
+	def zigzag(self):
+		n = self.varint()
+		return n >> 1 if not n & 1 else -(n >> 1) - 1
+
+	def value(self):
+		tag = self.data[self.pos]
+		self.pos += 1
+		if tag == _INT: return self.zigzag()
+		elif tag == _NONE: return None
+		elif tag == _FLOAT:
+			self.pos += 8
+			return _double.unpack_from(self.data, self.pos - 8)[0]
+		elif tag == _STRREF: return self.strings[self.varint()]
+		elif tag == _STR:
+			size = self.varint()
+			self.pos += size
+			self.strings.append(bytes(self.data[self.pos-size:self.pos]).decode('utf-8', 'surrogatepass'))
+			return self.strings[-1]
+		elif tag == _HANDLE:
+			kind = self.value()
+			return Handle(kind, self.zigzag())
+		elif tag == _VECTOR:
+			self.pos += 24
+			return _vector.unpack_from(self.data, self.pos - 24)
+		raise ValueError("invalid value tag {0} in trace".format(tag))
+
+	def values(self):
+		return [self.value() for i in range(self.varint())]
+
+#---------------------Recording---------------------
+
+class TraceRecorder(object):
+	"""
+	Records the execution of a ScriptEmulator (ScriptEmulator(ctx, tracer = recorder)) to out (file name or binary file):
+	every instruction executed (step) with the stack before it, the standard function calls with their arguments and
+	results, and the calls made through the emulator (with the globals, so that they can be replayed, see replayTrace).
+
+	Format (little-endian):
+		header { char magic[4] = "XDTR"; u16 version; u16 padding; }
+		chunks: zlib-compressed, each holding chunkSize steps. A chunk starts with a keyframe (last position and
+			stack of the previous chunk), then events (tag byte): steps { zigzag position delta; varint number
+			of entries dropped from the previous stack; values pushed }, standard function calls, calls, returns.
+			Integers are varints, strings are stored once per chunk, then referenced by index.
+		index: zlib-compressed JSON: chunk table [first step, number of steps, offset, size], number of steps,
+			function names (FTBL/labels) by offset, digest of the script (ScriptCtx.contentDigest)
+		invocations: zlib-compressed u32 triplets { function offset; first step; end step (exclusive) }
+		trailer { u64 index offset; u32 index size; u64 invocations offset; u32 invocations size; char magic[4] = "XDTE"; }
+	Chunks can be decoded independently, which makes seeking (ExecutionTrace) cheap.
+	"""
+
+	def __init__(self, out, chunkSize = 4096, compressLevel = 6):
+		self._owned = isinstance(out, str)
+		self._file = open(out, "wb") if self._owned else out
+		self._file.write(_header.pack(b'XDTR', traceVersion, 0))
+		self._offset = _header.size
+		self.chunkSize = chunkSize
+		self.compressLevel = compressLevel
+		self.nbSteps = 0
+		self.functions = dict()
+		self.scriptDigest = None
+		self._chunks = []
+		self._invocations = array('I')
+		self._active = []
+		self._stack = []
+		self._position = 0
+		self._newChunk()
+
+	def attach(self, ctx):
+		"""Called by ScriptEmulator"""
+		self.functions.update(getCallGraph(ctx).functions)
+		self.scriptDigest = ctx.contentDigest().hex()
+
+	def _newChunk(self):
+		self._encoder = _Encoder()
+		self._chunkStart = self.nbSteps
+		self._encoder.zigzag(self._position)
+		self._encoder.values(self._stack)
+		self._keyframeSize = len(self._encoder.buf)
+
+	def _flushChunk(self):
+		if len(self._encoder.buf) == self._keyframeSize: return
+		data = zlib.compress(bytes(self._encoder.buf), self.compressLevel)
+		self._file.write(data)
+		self._chunks.append([self._chunkStart, self.nbSteps - self._chunkStart, self._offset, len(data)])
+		self._offset += len(data)
+
+	def step(self, position, stack):
+		if self.nbSteps - self._chunkStart >= self.chunkSize:
+			self._flushChunk()
+			self._newChunk()
+		prev = self._stack
+		n = min(len(prev), len(stack))
+		i = 0
+		while i < n and (prev[i] is stack[i] or (type(prev[i]) is type(stack[i]) and prev[i] == stack[i])):
+			i += 1
+		enc = self._encoder
+		enc.buf.append(_STEP)
+		enc.zigzag(position - self._position)
+		enc.varint(len(prev) - i)
+		new = stack[i:]
+		enc.values(new)
+		del prev[i:]
+		prev += new
+		self._position = position
+		self.nbSteps += 1
+
+	def stdCall(self, clsID, funcID, args, result):
+		enc = self._encoder
+		enc.buf.append(_STDCALL)
+		enc.varint(clsID)
+		enc.varint(funcID)
+		enc.values(args)
+		enc.value(result)
+
+	def enter(self, entry):
+		self._active.append((entry, self.nbSteps))
+
+	def leave(self):
+		entry, first = self._active.pop()
+		self._invocations += array('I', (entry, first, self.nbSteps))
+
+	def beginCall(self, entry, args, globalVars, lastResult):
+		enc = self._encoder
+		enc.buf.append(_CALL)
+		enc.varint(entry)
+		enc.values(args)
+		enc.varint(len(globalVars))
+		for (index, value) in sorted(globalVars.items()):
+			enc.zigzag(index)
+			enc.value(value)
+		enc.value(lastResult)
+
+	def endCall(self, result):
+		enc = self._encoder
+		enc.buf.append(_RETURN)
+		enc.value(result)
+
+	def abortCall(self, error):
+		enc = self._encoder
+		enc.buf.append(_ABORT)
+		enc.string(repr(error))
+
+	def close(self):
+		"""Writes the pending chunk and the index"""
+		if self._file is None: return
+		self._flushChunk()
+		index = zlib.compress(json.dumps({"chunks": self._chunks, "steps": self.nbSteps, "script": self.scriptDigest,
+										  "functions": dict((str(off), name) for (off, name) in self.functions.items())}).encode('utf-8'))
+		invocations = array('I', self._invocations)
+		if sys.byteorder != 'little': invocations.byteswap()
+		invocations = zlib.compress(invocations.tobytes())
+		self._file.write(index)
+		self._file.write(invocations)
+		self._file.write(_trailer.pack(self._offset, len(index), self._offset + len(index), len(invocations), b'XDTE'))
+		if self._owned: self._file.close()
+		self._file = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+#---------------------Reading---------------------
+
+class ExecutionTrace(object):
+	"""
+	A trace written by TraceRecorder (src: file name, which is memory-mapped, or bytes).
+
+		trace = ExecutionTrace("run.xdtr")
+		trace.step(1000000)                  # TraceStep(step, position, stack)
+		for inv in trace.invocations("hero_main"): ...
+		for ev in trace.events(inv.firstStep, inv.endStep): ...
+
+	Only the chunk holding the requested steps is decompressed and decoded (the last decoded chunk is kept).
+	"""
+
+	def __init__(self, src):
+		self._file = self._mmap = None
+		if isinstance(src, str):
+			self._file = open(src, "rb")
+			try:
+				self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+			except:
+				self._file.close()
+				raise
+			src = self._mmap
+		self._src = src
+		magic, version, _ = _header.unpack_from(src)
+		if magic != b'XDTR': raise ValueError("Not a trace file")
+		if version != traceVersion: raise ValueError("Unsupported trace version {0}".format(version))
+		indexOffset, indexSize, invOffset, invSize, magic = _trailer.unpack_from(src, len(src) - _trailer.size)
+		if magic != b'XDTE': raise ValueError("Truncated trace file (not closed?)")
+		index = json.loads(zlib.decompress(src[indexOffset:indexOffset+indexSize]).decode('utf-8'))
+		self._chunks = index["chunks"]
+		self._chunkStarts = [chunk[0] for chunk in self._chunks]
+		self.nbSteps = index["steps"]
+		self.scriptDigest = index["script"]
+		self.functions = dict((int(off), name) for (off, name) in index["functions"].items())
+		invocations = array('I', zlib.decompress(src[invOffset:invOffset+invSize]))
+		if sys.byteorder != 'little': invocations.byteswap()
+		self._invocations = [TraceInvocation(invocations[i], self.functions.get(invocations[i]), invocations[i+1], invocations[i+2])
+							 for i in range(0, len(invocations), 3)]
+		self._invocations.sort(key = lambda inv: inv.firstStep)
+		self._cached = (None, None)
+
+	def close(self):
+		self._cached = (None, None)
+		if self._mmap is not None: self._mmap.close()
+		if self._file is not None: self._file.close()
+		self._mmap = self._file = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def __len__(self):
+		return self.nbSteps
+
+	def _decodeChunk(self, i):
+		"""Returns the events of the chunk #i (steps as TraceStep)"""
+		if self._cached[0] == i: return self._cached[1]
+		first, nb, offset, size = self._chunks[i]
+		dec = _Decoder(zlib.decompress(self._src[offset:offset+size]))
+		position = dec.zigzag()
+		stack = dec.values()
+		events = []
+		step = first
+		data = dec.data
+		while dec.pos < len(data):
+			tag = data[dec.pos]
+			dec.pos += 1
+			if tag == _STEP:
+				position += dec.zigzag()
+				dropped = dec.varint()
+				if dropped: del stack[len(stack)-dropped:]
+				stack += dec.values()
+				events.append(TraceStep(step, position, tuple(stack)))
+				step += 1
+			elif tag == _STDCALL:
+				clsID, funcID = dec.varint(), dec.varint()
+				events.append(TraceStdCall(step - 1, clsID, funcID, dec.values(), dec.value()))
+			elif tag == _CALL:
+				entry, args = dec.varint(), dec.values()
+				globalVars = dict((dec.zigzag(), dec.value()) for i in range(dec.varint()))
+				events.append(TraceCall(step, entry, args, globalVars, dec.value()))
+			elif tag == _RETURN:
+				events.append(TraceReturn(step, dec.value()))
+			elif tag == _ABORT:
+				events.append(TraceAbort(step, dec.value()))
+			else:
+				raise ValueError("invalid event tag {0} in trace".format(tag))
+		self._cached = (i, events)
+		return events
+
+	def _chunkOf(self, step):
+		return max(0, bisect.bisect_right(self._chunkStarts, step) - 1)
+
+	def step(self, i):
+		"""Returns the TraceStep #i (seeking: only its chunk is decoded)"""
+		if not 0 <= i < self.nbSteps: raise IndexError("step {0} out of range".format(i))
+		for event in self._decodeChunk(self._chunkOf(i)):
+			if type(event) is TraceStep and event.step == i: return event
+
+	def events(self, start = 0, stop = None):
+		"""Yields the events (TraceStep, TraceStdCall, TraceCall, TraceReturn, TraceAbort) from step start to step stop (exclusive)"""
+		# the calls and returns between two chunks are stored at the end of the first one
+		for i in range(self._chunkOf(max(0, start - 1)), len(self._chunks)):
+			if stop is not None and self._chunks[i][0] >= stop: break
+			for event in self._decodeChunk(i):
+				if event.step < start: continue
+				if stop is not None and event.step >= stop: return
+				yield event
+
+	def steps(self, start = 0, stop = None):
+		"""Yields the TraceSteps from start to stop (exclusive)"""
+		for event in self.events(start, stop):
+			if type(event) is TraceStep: yield event
+
+	def stdCalls(self, start = 0, stop = None):
+		for event in self.events(start, stop):
+			if type(event) is TraceStdCall: yield event
+
+	def invocations(self, function = None):
+		"""
+		Returns the TraceInvocations (offset, name, firstStep, endStep) of function (name or offset; None: all),
+		in execution order
+		"""
+		if function is None: return list(self._invocations)
+		return [inv for inv in self._invocations if function in (inv.offset, inv.name)]
+
+#---------------------Replay---------------------
+
+class _TraceChecker(object):
+	"""Tracer comparing an execution with a trace, and providing the recorded results of the standard functions"""
+
+	def __init__(self, trace):
+		self.trace = trace
+		self._events = trace.events()
+		self._next = next(self._events, None)
+		self.nbSteps = 0
+
+	def peek(self):
+		return self._next
+
+	def take(self, cls, what):
+		event = self._next
+		if type(event) is not cls:
+			raise TraceDivergence("step {0}: {1} instead of {2}".format(self.nbSteps, what, type(event).__name__ if event is not None else "end of trace"))
+		self._next = next(self._events, None)
+		return event
+
+	def attach(self, ctx):
+		pass
+
+	def step(self, position, stack):
+		if type(self._next) is TraceAbort: raise _ReplayAbort()
+		event = self.take(TraceStep, "instruction #{0}".format(hex(position)))
+		if event.position != position:
+			raise TraceDivergence("step {0}: instruction #{1} instead of #{2}".format(event.step, hex(position), hex(event.position)))
+		if len(event.stack) != len(stack) or not all(_same(a, b) for (a, b) in zip(event.stack, stack)):
+			raise TraceDivergence("step {0}: stack {1!r} instead of {2!r}".format(event.step, stack, list(event.stack)))
+		self.nbSteps += 1
+
+	def stdResult(self, key):
+		def handler(emulator, args):
+			event = self.peek()
+			if type(event) is TraceAbort: raise _ReplayAbort()
+			if type(event) is not TraceStdCall or (event.clsID, event.funcID) != key:
+				raise TraceDivergence("step {0}: unexpected standard function call {1}".format(self.nbSteps, key))
+			return event.result
+		return handler
+
+	def stdCall(self, clsID, funcID, args, result):
+		event = self.take(TraceStdCall, "standard function call")
+		if not (len(event.args) == len(args) and all(_same(a, b) for (a, b) in zip(event.args, args))):
+			raise TraceDivergence("step {0}: arguments {1!r} instead of {2!r}".format(event.step, args, event.args))
+
+	def enter(self, entry):
+		pass
+
+	def leave(self):
+		pass
+
+	def beginCall(self, entry, args, globalVars, lastResult):
+		pass # taken by replayTrace
+
+	def abortCall(self, error):
+		pass
+
+	def endCall(self, result):
+		event = self.take(TraceReturn, "return")
+		if not _same(event.result, result):
+			raise TraceDivergence("step {0}: result {1!r} instead of {2!r}".format(event.step, result, event.result))
+
+def replayTrace(trace, ctx, maxSteps = None):
+	"""
+	Re-executes the calls recorded in trace (ExecutionTrace) on ctx, the standard functions returning their recorded results,
+	and checks that every step matches the trace. Interrupted calls are interrupted at the same step. Returns the number of steps replayed; raises TraceDivergence at the
+	first difference, or ValueError if the trace was recorded on another script
+	"""
+	if trace.scriptDigest is not None and trace.scriptDigest != ctx.contentDigest().hex():
+		raise ValueError("the trace was recorded on another script")
+	checker = _TraceChecker(trace)
+	emulator = ScriptEmulator(ctx, maxSteps = maxSteps, tracer = checker)
+	for key in emulator.script.stdFunctions:
+		emulator.setStdHandler(key, checker.stdResult(key))
+	while checker.peek() is not None:
+		call = checker.take(TraceCall, "call")
+		emulator.globals.clear()
+		emulator.globals.update(call.globals)
+		emulator.lastResult = call.lastResult
+		try:
+			emulator.callEntry(call.entry, *call.args)
+		except _ReplayAbort:
+			# the recorded call was interrupted (exception raised by a handler, step limit...)
+			checker.take(TraceAbort, "abort")
+		except TraceDivergence:
+			raise
+		except Exception as e:
+			# the recorded call may have failed in the script itself (e.g. ScriptRuntimeError): it must fail in the same way
+			if type(checker.peek()) is not TraceAbort: raise
+			event = checker.take(TraceAbort, "abort")
+			if event.step != checker.nbSteps or event.error != repr(e):
+				raise TraceDivergence("step {0}: {1} instead of {2}".format(checker.nbSteps, repr(e), event.error)) from e
+	return checker.nbSteps
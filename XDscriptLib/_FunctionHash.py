@@ -0,0 +1,286 @@
+﻿# See LICENSE for license
+
+import collections
+import hashlib
+import json
+import random
+import threading
+from XDscriptLib import ScriptCtx, getCallGraph
+from XDscriptLib._Bulk import mapFiles
+from XDscriptLib._Graph import reachable
+
+FunctionFingerprint = collections.namedtuple("FunctionFingerprint", "file offset name named digest size signature")
+SimilarFunction = collections.namedtuple("SimilarFunction", "similarity function")
+NameSuggestion = collections.namedtuple("NameSuggestion", "function name similarity source")
+
+defaultNumPermutations = 64
+defaultBands = 16
+defaultShingleSize = 4
+
+_maxHash = (1 << 64) - 1
+
+#---------------------Normalization---------------------
+
+def normalizedTokens(ctx, start, positions = None):
+	"""
+	Returns the normalized instructions of the function at start (positions: its instructions, default: the ones reachable
+	from start), in CODE order. Positions and labels are abstracted: branch targets are relative to the branch (in
+	instructions), and callees are not kept. Operands are canonicalized: immediates and string/vector operands are resolved,
+	$globals indices are renumbered by order of first use, and 'setline' and 'nop' are dropped
+	"""
+	code = ctx.sections["CODE"]
+	instrs = code.instructions
+	strg = ctx.sections.get("STRG")
+	vect = ctx.sections.get("VECT")
+	if positions is None: positions = reachable(instrs, start)
+	positions = [pos for pos in positions if instrs[pos].opcode not in (0, 16)]
+	index = dict((pos, i) for (i, pos) in enumerate(positions))
+
+	globalIndices = dict()
+	tokens = []
+	for (i, pos) in enumerate(positions):
+		instr = instrs[pos]
+		opcode, sub, param = instr.opcode, instr.subOpcode, instr.parameter
+		if opcode in (10, 11, 12):  # jmptrue, jmpfalse, jmp
+			target = instr.instructionID
+			while target < len(instrs) and target not in index and getattr(instrs[target], "opcode", None) in (0, 16): target = instrs[target].nextPosition
+			token = (opcode, index[target] - i if target in index else None)
+		elif opcode == 7:  # call
+			token = (7,)
+		elif opcode == 2:  # ldimm
+			if sub in (1, 2) and instr.nextPosition == pos + 2: token = (2, sub, instrs[pos + 1])
+			elif sub == 3 and strg is not None: token = (2, 3, strg.getString(param & 0xffff))
+			elif sub == 4 and vect is not None and 0 <= param < len(vect.vectors): token = (2, 4, tuple(vect.vectors[param]))
+			else: token = (2, sub, param)
+		elif opcode in (3, 4, 5, 17) and sub & 0xf == 0:  # $globals
+			token = (opcode, sub, ("g", globalIndices.setdefault(param, len(globalIndices))))
+		else:
+			token = (opcode, sub, param)
+		tokens.append(token)
+	return tokens
+
+def _hash64(data):
+	return int.from_bytes(hashlib.blake2b(data, digest_size = 8).digest(), 'little')
+
+def shingles(tokens, shingleSize = defaultShingleSize):
+	"""Returns the set of 64-bit hashes of the runs of shingleSize consecutive tokens (the whole sequence if it is shorter)"""
+	reprs = [repr(token).encode('utf-8') for token in tokens]
+	n = min(shingleSize, len(reprs))
+	return set(_hash64(b'\x00'.join(reprs[i:i+n])) for i in range(len(reprs) - n + 1))
+
+#---------------------MinHash---------------------
+
+_masks = dict() # numPermutations -> masks
+_masksLock = threading.Lock()
+
+def _permutationMasks(numPermutations):
+	# the shingle hashes are uniformly distributed, XORing them with random masks gives independent permutations
+	with _masksLock:
+		ret = _masks.get(numPermutations)
+		if ret is None:
+			rng = random.Random(0x5844)
+			ret = _masks[numPermutations] = [rng.getrandbits(64) for i in range(numPermutations)]
+	return ret
+
+def minHash(hashes, numPermutations = defaultNumPermutations):
+	"""Returns the MinHash signature (tuple of numPermutations ints) of a set of 64-bit hashes"""
+	if not hashes: return (_maxHash,) * numPermutations
+	return tuple(min(h ^ mask for h in hashes) for mask in _permutationMasks(numPermutations))
+
+def estimatedSimilarity(a, b):
+	"""Estimated Jaccard similarity of the shingle sets of two MinHash signatures"""
+	return sum(1 for (x, y) in zip(a, b) if x == y) / len(a) if a else 0.0
+
+_signatures = collections.OrderedDict() # (digest, numPermutations, shingleSize) -> signature
+_signaturesLock = threading.Lock()
+maxCachedSignatures = 16384
+
+def fingerprintFunction(ctx, start, fileName = None, numPermutations = defaultNumPermutations, shingleSize = defaultShingleSize):
+	"""
+	Returns the FunctionFingerprint of the function at start: digest is the SHA-1 (hex) of its normalized instructions
+	(see normalizedTokens), size their number, and signature their MinHash. Signatures are cached by digest, keeping the
+	maxCachedSignatures most recently used: the copies of a function are only hashed once
+	"""
+	tokens = normalizedTokens(ctx, start)
+	digest = hashlib.sha1(repr(tokens).encode('utf-8')).hexdigest()
+	key = (digest, numPermutations, shingleSize)
+	with _signaturesLock:
+		signature = _signatures.get(key)
+		if signature is not None: _signatures.move_to_end(key)
+	if signature is None:
+		signature = minHash(shingles(tokens, shingleSize), numPermutations)
+		with _signaturesLock:
+			_signatures[key] = signature
+			while len(_signatures) > maxCachedSignatures:
+				_signatures.popitem(last = False)
+	return FunctionFingerprint(fileName, start, ctx.getLabel(start), start in ctx.sections["CODE"].labels, digest, len(tokens), signature)
+
+def fingerprintScript(ctx, fileName = None, numPermutations = defaultNumPermutations, shingleSize = defaultShingleSize):
+	"""Returns the list of FunctionFingerprint of the functions of ctx (see CallGraph), sorted by offset"""
+	return [fingerprintFunction(ctx, off, fileName, numPermutations, shingleSize) for off in sorted(getCallGraph(ctx).functions)]
+
+#---------------------Index---------------------
+
+class FunctionIndex(object):
+	"""
+	Locality-sensitive hashing index of FunctionFingerprints: signatures are split into bands of rows, and functions sharing
+	a band are candidates, whose similarity is then estimated from their signatures. With b bands of r rows, functions of
+	similarity s are candidates with probability 1 - (1 - s^r)^b (about 0.5 at (1/b)^(1/r)), so that lookups only compare
+	a few functions, whatever the size of the corpus.
+
+	Functions with the same digest are stored once per copy, but looked up once (see duplicates).
+	digests: dict mapping file names to the SHA-1 of the file they were computed from (see buildFunctionIndex)
+	"""
+
+	def __init__(self, numPermutations = defaultNumPermutations, bands = defaultBands, shingleSize = defaultShingleSize):
+		if bands <= 0 or numPermutations % bands != 0: raise ValueError("the number of permutations must be a multiple of the number of bands")
+		self.numPermutations = numPermutations
+		self.bands = bands
+		self.rows = numPermutations // bands
+		self.shingleSize = shingleSize
+		self.functions = [] # FunctionFingerprint
+		self.digests = collections.OrderedDict()
+		self._byDigest = collections.OrderedDict() # digest -> indices in functions
+		self._buckets = collections.defaultdict(list) # (band, band values) -> digests
+
+	def __len__(self):
+		return len(self.functions)
+
+	def _bands(self, signature):
+		r = self.rows
+		return [(i, signature[i*r:(i+1)*r]) for i in range(self.bands)]
+
+	def add(self, fingerprint):
+		if len(fingerprint.signature) != self.numPermutations: raise ValueError("inconsistent signature size")
+		copies = self._byDigest.get(fingerprint.digest)
+		if copies is None:
+			copies = self._byDigest[fingerprint.digest] = []
+			for band in self._bands(fingerprint.signature): self._buckets[band].append(fingerprint.digest)
+		copies.append(len(self.functions))
+		self.functions.append(fingerprint)
+
+	def addScript(self, ctx, fileName = None):
+		for fingerprint in fingerprintScript(ctx, fileName, self.numPermutations, self.shingleSize): self.add(fingerprint)
+
+	def copies(self, digest):
+		"""Returns the list of the FunctionFingerprints of digest"""
+		return [self.functions[i] for i in self._byDigest.get(digest, ())]
+
+	def duplicates(self, minSize = 1):
+		"""Returns the lists of the functions with identical normalized contents (at least minSize instructions), largest first"""
+		ret = [self.copies(digest) for (digest, indices) in self._byDigest.items()
+			   if len(indices) > 1 and self.functions[indices[0]].size >= minSize]
+		ret.sort(key = lambda copies: (-len(copies), copies[0].file or "", copies[0].offset))
+		return ret
+
+	def _candidates(self, signature):
+		ret = set()
+		for band in self._bands(signature): ret.update(self._buckets.get(band, ()))
+		return ret
+
+	def query(self, signature, threshold = 0.5):
+		"""
+		Returns the list of SimilarFunction(similarity, fingerprint) of the indexed functions similar to signature (a MinHash
+		signature or a FunctionFingerprint), with an estimated similarity of at least threshold, most similar first
+		"""
+		if isinstance(signature, FunctionFingerprint): signature = signature.signature
+		ret = []
+		for digest in self._candidates(signature):
+			copies = self._byDigest[digest]
+			similarity = estimatedSimilarity(signature, self.functions[copies[0]].signature)
+			if similarity >= threshold: ret += [SimilarFunction(similarity, self.functions[i]) for i in copies]
+		ret.sort(key = lambda match: (-match.similarity, match.function.file or "", match.function.offset))
+		return ret
+
+	def clusters(self, threshold = 0.8, minSize = 6):
+		"""
+		Returns the clusters of similar functions (at least minSize instructions): the connected components of the graph
+		linking the functions of estimated similarity at least threshold. Clusters have at least two functions, largest first
+		"""
+		digests = [digest for (digest, indices) in self._byDigest.items() if self.functions[indices[0]].size >= minSize]
+		parent = dict((digest, digest) for digest in digests)
+		def find(x):
+			while parent[x] != x:
+				parent[x] = parent[parent[x]]
+				x = parent[x]
+			return x
+		for digest in digests:
+			signature = self.functions[self._byDigest[digest][0]].signature
+			for other in self._candidates(signature):
+				if other == digest or other not in parent: continue
+				a, b = find(digest), find(other)
+				if a != b and estimatedSimilarity(signature, self.functions[self._byDigest[other][0]].signature) >= threshold: parent[a] = b
+		groups = collections.defaultdict(list)
+		for digest in digests:
+			groups[find(digest)] += self.copies(digest)
+		ret = [sorted(group, key = lambda f: (f.file or "", f.offset)) for group in groups.values() if len(group) > 1]
+		ret.sort(key = lambda group: (-len(group), group[0].file or "", group[0].offset))
+		return ret
+
+	def inferNames(self, sources = None, threshold = 0.8, minSize = 6):
+		"""
+		Returns the list of NameSuggestion(function, name, similarity, source) for the unnamed functions (functions without
+		FTBL entry, 'sub_' labels): the name of the most similar named function of the files sources (default: every file),
+		if its estimated similarity is at least threshold and no equally similar function has another name
+		"""
+		sources = None if sources is None else set(sources)
+		ret = []
+		for (digest, indices) in self._byDigest.items():
+			unnamed = [self.functions[i] for i in indices if not self.functions[i].named]
+			if not unnamed or unnamed[0].size < minSize: continue
+			best, names = None, set()
+			for match in self.query(unnamed[0].signature, threshold):
+				f = match.function
+				if not f.named or (sources is not None and f.file not in sources): continue
+				if best is None: best = match
+				elif match.similarity < best.similarity: break
+				names.add(f.name)
+			if best is None or len(names) > 1: continue
+			ret += [NameSuggestion(f, best.function.name, best.similarity, best.function) for f in unnamed]
+		ret.sort(key = lambda suggestion: (suggestion.function.file or "", suggestion.function.offset))
+		return ret
+
+	#---------------------Serialization---------------------
+
+	def toJSON(self):
+		return json.dumps({
+			"numPermutations": self.numPermutations, "bands": self.bands, "shingleSize": self.shingleSize,
+			"files": [{"file": fname, "digest": digest} for (fname, digest) in self.digests.items()],
+			"functions": [{"file": f.file, "offset": f.offset, "name": f.name, "named": f.named, "digest": f.digest,
+						   "size": f.size, "signature": ["{0:016x}".format(h) for h in f.signature]} for f in self.functions]
+		}, ensure_ascii = False)
+
+	@classmethod
+	def fromJSON(cls, text):
+		d = json.loads(text)
+		ret = cls(d["numPermutations"], d["bands"], d["shingleSize"])
+		for entry in d["files"]: ret.digests[entry["file"]] = entry["digest"]
+		for f in d["functions"]:
+			ret.add(FunctionFingerprint(f["file"], f["offset"], f["name"], f["named"], f["digest"], f["size"], tuple(int(h, 16) for h in f["signature"])))
+		return ret
+
+#---------------------Bulk processing---------------------
+
+def _fingerprintFile(digests, numPermutations, shingleSize, fname, src):
+	digest = hashlib.sha1(src).hexdigest()
+	if digests.get(fname) == digest: return (digest, None)
+	return (digest, fingerprintScript(ScriptCtx(src), fname, numPermutations, shingleSize))
+
+def buildFunctionIndex(fnames, previous = None, maxWorkers = None, chunkSize = 16,
+					   numPermutations = defaultNumPermutations, bands = defaultBands, shingleSize = defaultShingleSize):
+	"""
+	Returns the FunctionIndex of the functions of the script files fnames, fingerprinted by worker processes (chunkSize files
+	per task). The fingerprints of previous (a FunctionIndex with the same parameters) are reused for the files which have
+	not changed since (same SHA-1). Files that cannot be loaded are skipped with a warning
+	"""
+	reuse = previous is not None and (previous.numPermutations, previous.bands, previous.shingleSize) == (numPermutations, bands, shingleSize)
+	digests = previous.digests if reuse else dict()
+	previousFunctions = collections.defaultdict(list)
+	if reuse:
+		for f in previous.functions: previousFunctions[f.file].append(f)
+	ret = FunctionIndex(numPermutations, bands, shingleSize)
+	fnames = list(collections.OrderedDict.fromkeys(fnames)) # the index has one entry per file
+	for (fname, (digest, fingerprints)) in mapFiles(_fingerprintFile, fnames, maxWorkers, chunkSize, (dict(digests), numPermutations, shingleSize)):
+		ret.digests[fname] = digest
+		for f in (previousFunctions[fname] if fingerprints is None else fingerprints): ret.add(f)
+	return ret
@@ -0,0 +1,71 @@
+﻿# See LICENSE for license
+
+from XDscriptLib import Instruction
+
+#---------------------Control flow---------------------
+
+def successors(instrs, instr):
+	"""Returns the positions of the instructions that can follow instr within its function (calls do not leave it)"""
+	opcode = instr.opcode
+	if opcode in (8, 15): return ()  # return, exit
+	ret = []
+	if opcode != 12: ret.append(instr.nextPosition)  # jmp
+	if opcode in (10, 11, 12): ret.append(instr.instructionID)
+	return [pos for pos in ret if 0 <= pos < len(instrs) and isinstance(instrs[pos], Instruction)]
+
+def reachable(instrs, start):
+	"""Returns the sorted positions of the instructions reachable from start, within its function"""
+	ret = set()
+	work = [start]
+	while work:
+		pos = work.pop()
+		if pos in ret or not (0 <= pos < len(instrs) and isinstance(instrs[pos], Instruction)): continue
+		ret.add(pos)
+		work += successors(instrs, instrs[pos])
+	return sorted(ret)
+
+#---------------------Graphs---------------------
+
+def stronglyConnectedComponents(nodes, edges):
+	"""
+	Returns the list of the strongly connected components (lists of nodes) of the graph whose edges are given by
+	edges (dict mapping each node to its successors), successors before predecessors (Tarjan's algorithm, iterative
+	version). The nodes are visited in the order of nodes
+	"""
+	index = dict()
+	lowlink = dict()
+	onStack = set()
+	stack = []
+	sccs = []
+	for root in nodes:
+		if root in index: continue
+		index[root] = lowlink[root] = len(index)
+		stack.append(root)
+		onStack.add(root)
+		work = [(root, iter(edges[root]))]
+		while work:
+			node, it = work[-1]
+			advanced = False
+			for nxt in it:
+				if nxt not in index:
+					index[nxt] = lowlink[nxt] = len(index)
+					stack.append(nxt)
+					onStack.add(nxt)
+					work.append((nxt, iter(edges[nxt])))
+					advanced = True
+					break
+				elif nxt in onStack:
+					lowlink[node] = min(lowlink[node], index[nxt])
+			if advanced: continue
+
+			work.pop()
+			if work: lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+			if lowlink[node] == index[node]:
+				scc = []
+				while True:
+					member = stack.pop()
+					onStack.discard(member)
+					scc.append(member)
+					if member == node: break
+				sccs.append(scc)
+	return sccs
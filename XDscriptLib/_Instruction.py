@@ -3,6 +3,7 @@
 import struct
 import warnings
 from XDscriptLib import FunctionInfo
+from XDscriptLib._ScriptVar import wellDefinedTypes
 
 class Instruction(object):
 	"""
@@ -145,7 +146,7 @@ class Instruction(object):
 			if self._parameter < 0 or self._parameter > 0x2ff or 0x120 < self._parameter < 0x200:
 				return "$invalidSpecials[{0}]".format(self._parameter)
 			elif 0 <= self._parameter < 0x80: # possible singletons (fake objects)
-				name = FunctionInfo.stdfunctions_name_dict.get(self._parameter, str(self._parameter))[0]
+				name = FunctionInfo.stdfunctions_name_dict.get(self._parameter, ("",))[0] or str(self._parameter)
 				return "${0}".format(name[0].lower() + name[1:])
 			elif 0x80 <= self._parameter <= 0x120:
 				return "$characters[{0}]".format(self._parameter - 0x80)
@@ -170,7 +171,10 @@ class Instruction(object):
 				at instruction #{1})".format(FunctionInfo.getOperatorName(self._subOpcode), hex(self.position)))
 		
 		elif self._opcode == 2:
-			if self.ctx is not None:
+			if self.ctx is not None and self._subOpcode in (0, 1, 2, 0x35) and\
+			self._position + 1 >= len(self.ctx.sections["CODE"].instructions):
+				warnings.warn("missing immediate value (instruction #{0})".format(hex(self.position)))
+			elif self.ctx is not None:
 				packed = None
 				
 				if self._subOpcode in (0, 1, 2, 0x35):
@@ -218,7 +222,7 @@ class Instruction(object):
 		elif self._opcode == 5:  # setvector
 			vecindex, veclevel = self.subSubOpcodes
 				
-			if vecindex == 4:
+			if vecindex >= 4:
 				warnings.warn("out-of-range vector coordinate index encountered ({0} \
 				at instruction #{1})".format(self._parameter, hex(self.position)))	
 			
@@ -234,17 +238,9 @@ class Instruction(object):
 					(at instruction #{0}: {1}\t{2})".format(hex(self.position),
 					self.name, hex(instrID)))
 				
-				else:
-					if self._opcode == 7 and instrID not in self.ctx.sections["HEAD"].functionOffsets:
-						warnings.warn("call to unreferenced function ({0} \
-						at instruction #{1})".format(instrID, hex(self.position)))
-
-					lbl = ''.join(["sub_" if self._opcode == 7 else "loc_", hex(instrID)[2:]])
-					if not self.ctx.sections["CODE"].labels[instrID]: self.ctx.sections["CODE"].labels[instrID] = lbl
-					if self._opcode != 7 and (True if self.ctx is None 
-							   else self.position+1 < len(self.ctx.sections["CODE"].instructions)) :
-						lbl2 = ''.join(["loc_", hex(self.position+1)[2:]])
-						if not self.ctx.sections["CODE"].labels[self.position+1]: self.ctx.sections["CODE"].labels[self.position+1] = lbl2
+				elif self._opcode == 7 and instrID not in self.ctx.sections["HEAD"].functionOffsets:
+					warnings.warn("call to unreferenced function ({0} \
+					at instruction #{1})".format(instrID, hex(self.position)))
 				
 					
 		elif self._opcode == 9:  # callstd
@@ -278,11 +274,13 @@ class Instruction(object):
 	def opcode(self, value):
 		val2 = int(value) & 0xff
 		self._opcode = val2
+		self.changed()
 		self.check()
 		
 	@subOpcode.setter
 	def subOpcode(self, value):
 		self._subOpcode = int(value) & 0xff
+		self.changed()
 		self.check()
 		
 	@parameter.setter
@@ -290,25 +288,53 @@ class Instruction(object):
 		val2 = int(value) & 0xffff
 		# sign extend:
 		self._parameter = -((~val2 + 1) & 0xffff) if ((val2 & 0x8000) == 0x8000) else val2
+		self.changed()
 		self.check()
 	
 	@subSubOpcodes.setter
 	def subSubOpcodes(self, values):
 		self._subOpcode = ((int(values[0]) & 0xf) << 4) | (int(values[1]) & 0xf)
+		self.changed()
 		self.check()
 		
 	@instructionID.setter
 	def instructionID(self, value):
 		val2 = int(value)
 		self._subOpcode = (val2 >> 16) & 0xff
-		self.parameter = val2 & 0xffff
+		self.parameter = val2 & 0xffff # calls changed()
 		self.check()
 	
 	#-------------------------------------------------
 	
 	
 	#---------------------Methods---------------------
-	
+
+	def invalidate(self):
+		"""Drops the memoized text of this instruction"""
+		self._text = None
+		self._textDeps = None
+
+	def changed(self):
+		"""Called by the setters: drops the memoized text, and notifies ctx"""
+		self.invalidate()
+		if self.ctx is not None:
+			self.ctx.instructionChanged(self)
+
+	def renderDependencies(self):
+		"""
+		Returns what the text of this instruction depends on, apart from its own fields:
+		the label of the destination for call/jmp*, and the immediate word for ldimm
+		"""
+		if self.ctx is None:
+			return None
+		elif self._opcode in (7, 10, 11, 12):
+			instrID = self.instructionID
+			return self.ctx.getLabel(instrID) if instrID < len(self.ctx.sections["CODE"].instructions) else None
+		elif self._opcode == 2 and self._subOpcode in (0, 1, 2, 0x35):
+			instrs = self.ctx.sections["CODE"].instructions
+			return instrs[self._position + 1] if self._position + 1 < len(instrs) else None
+		return None
+
 	def fromRaw(self, rawWord=0):
 		self._opcode = (rawWord >> 24) & 0xff
 		self._subOpcode = (rawWord >> 16) & 0xff
@@ -316,10 +342,30 @@ class Instruction(object):
 		self.check()
 	
 	def toRaw(self):
-		return (self._opcode << 24) | (self._subOpcode << 16) | self._parameter 
+		return (self._opcode << 24) | (self._subOpcode << 16) | (self._parameter & 0xffff)
 	
+	@classmethod
+	def fromDecoded(cls, ctx, position, nextPosition, opcode, subOpcode, parameter):
+		"""
+		Fast constructor, for instructions which have already been decoded and checked (e.g. loaded from a sidecar file):
+		neither check() nor the ctx notifications are called
+		"""
+		instr = cls.__new__(cls)
+		instr._text = None
+		instr._textDeps = None
+		instr.ctx = ctx
+		instr._position = position
+		instr._nextPosition = nextPosition
+		instr._label = ""
+		instr._opcode = opcode
+		instr._subOpcode = subOpcode
+		instr._parameter = parameter
+		return instr
+
 	def __init__(self, rawWord=0, ctx=None, position=0, label=""):
 		#print(position)
+		self._text = None
+		self._textDeps = None
 		self.ctx = ctx
 		self.position = position
 		self._nextPosition = position + 1
@@ -332,15 +378,26 @@ class Instruction(object):
 		
 	
 	def __str__(self):
-		self.check()
+		"""Memoized; the text is re-rendered only if a setter has been called, or if a dependency has changed"""
+		deps = self.renderDependencies()
+		if self._text is None or deps != self._textDeps:
+			self.check()
+			self._text = self.render()
+			self._textDeps = self.renderDependencies()
+		return self._text
+
+	def render(self):
 
 		instrnamestr = self.name if self._opcode <= 17 else "illegal{0}".format(self._opcode)
 
 		instrstr = None
 		
 		if self._opcode > 17:
-			return ''.join([labelstr, 
-						"illegal{0}\t{1}, {2}, {3}".format(self._opcode, self._subOpcode, self._parameter)])
+			return "{0}{1}{2}, {3}".format(instrnamestr, (14 - len(instrnamestr)) * ' ', self._subOpcode, self._parameter)
+
+		elif self._opcode == 2 and self._subOpcode in (0, 1, 2, 0x35) and self.ctx is not None and\
+		self._position + 1 >= len(self.ctx.sections["CODE"].instructions):
+			instrstr = "{0}, <missing>".format(wellDefinedTypes.get(self._subOpcode))
 		
 		elif self._opcode in (0, 8, 15):  # nop, return, exit
 			instrstr = "{0}".format((self._subOpcode, self._parameter)) if\
@@ -369,14 +426,14 @@ class Instruction(object):
 			
 			elif self._subOpcode == 4:
 				instrstr = "vector, ={0}".format(self._parameter if self.ctx is None or self.ctx.sections.get("VECT") is None
-									 else "<{0}, {1}, {2}>".format(*self.ctx.sections["VECT"].vectors[self._parameter]) )
+									 or not 0 <= self._parameter < len(self.ctx.sections["VECT"].vectors)
+									 else self.ctx.sections["VECT"].vectors.text(self._parameter))
 			
 			elif self._subOpcode == 0x2c:
 				instrstr = "type44, {0}".format(self._parameter & 0xffff)  # unsigned parameter
 			
 			elif self._subOpcode == 0x35:
-				typestr = "codeptr_t"
-				valuestr = "={0}".format(hex(self.ctx.sections["CODE"].instructions[self._position + 1])\
+				instrstr = "codeptr_t, ={0}".format(hex(self.ctx.sections["CODE"].instructions[self._position + 1])\
 											if self.ctx is not None else "")
 			
 			else:
@@ -386,7 +443,9 @@ class Instruction(object):
 			instrstr = self.variableName
 
 		elif self._opcode == 5:  # setvector
-			instrstr = "{0}, {1}".format(self.__class__.vectorCoordNames[self.subSubOpcodes[0]], self.variableName)
+			vecindex = self.subSubOpcodes[0]
+			instrstr = "{0}, {1}".format(self.__class__.vectorCoordNames[vecindex] if vecindex < len(self.__class__.vectorCoordNames)
+											else str(vecindex), self.variableName)
 			
 		elif self._opcode in (6, 13, 14):  # pop, reserve, release
 			instrstr = "{0}{1}".format(self._subOpcode, "" if self._parameter == 0 else\
@@ -395,7 +454,7 @@ class Instruction(object):
 		elif self._opcode in (7, 10, 11, 12):  # call/jmptrue/jmpfalse/jmp
 			instrID = self.instructionID
 			instrstr = hex(instrID) if (self.ctx is None or instrID >= len(self.ctx.sections["CODE"].instructions))\
-			else self.ctx.sections["CODE"].labels[instrID]
+			else self.ctx.getLabel(instrID)
 			
 		elif self._opcode == 9:  # callstd
 			instrstr = FunctionInfo.getStdFunctionName(self._subOpcode, self._parameter)
@@ -0,0 +1,116 @@
+﻿# See LICENSE for license
+
+import collections
+import csv
+import json
+import warnings
+from XDscriptLib import FunctionInfo, Instruction, ScriptCtx, decodeCodeColumns
+from XDscriptLib._ScriptVar import wellDefinedTypes
+from XDscriptLib._Bulk import mapChunks
+
+variableLevelNames = ("$globals", "$stack", "$lastResult", "specials")
+
+class OpcodeStats(object):
+	"""
+	Instruction usage statistics over a corpus of scripts, computed from the decoded CODE columns
+	(see decodeCodeColumns). Counters are keyed by raw values, names are only resolved on export:
+
+		opcodes: opcode
+		ldimmTypes: type (sub-opcode of 'ldimm')
+		operators: operator index (sub-opcode of 'operator')
+		stdCalls: (clsID, funcID) (sub-opcode and parameter of 'callstd')
+		variableLevels: storage level (rightmost nibble of the sub-opcode of 'ldvar', 'setvar', 'setvector', 'ldncpvar')
+
+	Statistics computed separately (e.g. by different processes) are aggregated with update()
+	"""
+
+	categories = ("opcodes", "ldimmTypes", "operators", "stdCalls", "variableLevels")
+
+	def __init__(self):
+		self.nbScripts = 0
+		self.nbInstructions = 0
+		for category in self.categories:
+			setattr(self, category, collections.Counter())
+
+	def addColumns(self, columns):
+		self.nbScripts += 1
+		self.nbInstructions += len(columns.opcodes)
+		self.opcodes.update(columns.opcodes)
+		for (opcode, subOpcode, parameter) in zip(columns.opcodes, columns.subOpcodes, columns.parameters):
+			if opcode == 2: self.ldimmTypes[subOpcode] += 1
+			elif opcode == 1: self.operators[subOpcode] += 1
+			elif opcode == 9: self.stdCalls[(subOpcode, parameter)] += 1
+			elif opcode in (3, 4, 5, 17): self.variableLevels[subOpcode & 0xf] += 1
+
+	def addScript(self, src):
+		"""Adds the script contents src"""
+		self.addColumns(decodeCodeColumns(ScriptCtx.fromRawSections(src).sections["CODE"]))
+
+	def update(self, other):
+		"""Adds the statistics of other"""
+		self.nbScripts += other.nbScripts
+		self.nbInstructions += other.nbInstructions
+		for category in self.categories:
+			getattr(self, category).update(getattr(other, category))
+
+	#---------------------Export---------------------
+
+	@staticmethod
+	def keyName(category, key):
+		if category == "opcodes":
+			return Instruction.instructionNames[key] if key < len(Instruction.instructionNames) else "illegal_{0}".format(key)
+		elif category == "ldimmTypes":
+			return wellDefinedTypes.get(key, str(key))
+		elif category == "operators":
+			return FunctionInfo.getOperatorName(key)
+		elif category == "stdCalls":
+			return FunctionInfo.getStdFunctionName(*key)
+		else:
+			return variableLevelNames[key] if key < len(variableLevelNames) else "level_{0}".format(key)
+
+	def rows(self):
+		"""(category, name, count) tuples, most common first in each category"""
+		for category in self.categories:
+			for (key, count) in getattr(self, category).most_common():
+				yield (category, self.keyName(category, key), count)
+
+	def toDict(self):
+		ret = { "nbScripts": self.nbScripts, "nbInstructions": self.nbInstructions }
+		for category in self.categories:
+			ret[category] = collections.OrderedDict((self.keyName(category, key), count)
+													for (key, count) in getattr(self, category).most_common())
+		return ret
+
+	def toJSON(self):
+		return json.dumps(self.toDict(), indent = '\t', ensure_ascii = False)
+
+	def writeCSV(self, out):
+		writer = csv.writer(out)
+		writer.writerow(["category", "name", "count"])
+		writer.writerows(self.rows())
+
+def _fileStats(fnames):
+	stats = OpcodeStats()
+	errors = []
+	for fname in fnames:
+		try:
+			with open(fname, "rb") as f:
+				src = f.read()
+			with warnings.catch_warnings():
+				warnings.simplefilter("ignore")
+				stats.addScript(src)
+		except (OSError, ValueError) as e:
+			errors.append("{0}: {1}".format(fname, e))
+	return (stats, errors)
+
+def collectStats(fnames, maxWorkers = None, chunkSize = 64):
+	"""
+	Returns the OpcodeStats of the script files fnames. The files are processed by worker processes
+	(chunkSize files per task), whose partial statistics are then aggregated. The files which cannot be read
+	or parsed are skipped with a warning
+	"""
+	stats = OpcodeStats()
+	for (partial, errors) in mapChunks(_fileStats, fnames, maxWorkers, chunkSize):
+		for error in errors: warnings.warn(error)
+		stats.update(partial)
+	return stats
@@ -0,0 +1,259 @@
+﻿# See LICENSE for license
+
+import html
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import zipfile
+from XDscriptLib import Instruction
+
+#---------------------Formatters---------------------
+
+class ListingFormatter(object):
+	"""Plain disassembly listing (the format of str(ScriptCtx))"""
+	name = "txt"
+	extension = "txt"
+
+	def write(self, ctx, out, name = ""):
+		ctx.writeListing(out)
+
+class HTMLFormatter(object):
+	"""
+	Disassembly listing as a standalone HTML page: call/jump destinations and function names are hyperlinks
+	to their labels, and each label is followed by the list of the instructions referencing it (xrefs)
+	"""
+	name = "html"
+	extension = "html"
+
+	_instructionLine = re.compile(r'^(?:0x[0-9a-f]+:)?\t')
+	_labelLine = re.compile(r'^([^\s;.][^\s]*):$')
+	_functionLine = re.compile(r'^(\t\.(?:function|set __ENTRY_POINT__,) )([^\s,]+)')
+
+	def _link(self, label):
+		return '<a href="#{0}">{1}</a>'.format(html.escape(label), html.escape(label))
+
+	def write(self, ctx, out, name = ""):
+		code = ctx.sections["CODE"]
+		instructions = iter(instr for instr in code.instructions if isinstance(instr, Instruction))
+		xrefs = ctx.cached("xrefs", type(ctx).getXrefs)
+		labelXrefs = dict((ctx.getLabel(pos), refs) for (pos, refs) in xrefs.items() if pos < len(code.instructions))
+
+		out.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{0}</title>\n'.format(html.escape(name)))
+		out.write('<style>pre {font-family: monospace} .label {font-weight: bold} .xrefs {color: gray}</style>\n')
+		out.write('</head>\n<body>\n<pre>\n')
+
+		listing = io.StringIO()
+		ctx.writeListing(listing)
+		inCode = False
+		for line in listing.getvalue().splitlines():
+			if line.startswith('.section'):
+				inCode = line == '.section "CODE":'
+				out.write(html.escape(line) + '\n')
+				continue
+
+			if inCode and self._instructionLine.match(line):
+				instr = next(instructions)
+				esc = html.escape(line)
+				if instr.opcode in (7, 10, 11, 12) and instr.instructionID < len(code.instructions):  # call/jmptrue/jmpfalse/jmp
+					label = html.escape(ctx.getLabel(instr.instructionID))
+					if label and esc.endswith(label):
+						esc = esc[:-len(label)] + '<a href="#{0}">{0}</a>'.format(label)
+				out.write('<span id="i_{0}">{1}</span>\n'.format(hex(instr.position)[2:], esc))
+				continue
+
+			m = self._labelLine.match(line) if inCode else None
+			if m is not None:
+				out.write('<span class="label" id="{0}">{0}:</span>'.format(html.escape(m.group(1))))
+				refs = labelXrefs.get(m.group(1))
+				if refs:
+					out.write('<span class="xrefs">\t; xrefs: {0}</span>'.format(', '.join(
+						'<a href="#i_{0}">{1}</a>'.format(hex(ref)[2:], hex(ref)) for ref in refs)))
+				out.write('\n')
+				continue
+
+			m = self._functionLine.match(line)
+			if m is not None:
+				out.write(html.escape(m.group(1)) + self._link(m.group(2)) + html.escape(line[m.end():]) + '\n')
+				continue
+
+			out.write(html.escape(line) + '\n')
+
+		out.write('</pre>\n</body>\n</html>\n')
+
+class JSONFormatter(object):
+	"""Structured dump of the decoded script"""
+	name = "json"
+	extension = "json"
+
+	def __init__(self, indent = '\t'):
+		self.indent = indent
+
+	def toDict(self, ctx):
+		code = ctx.sections["CODE"]
+		head = ctx.sections["HEAD"]
+		strg = ctx.sections.get("STRG")
+		vect = ctx.sections.get("VECT")
+		giri = ctx.sections.get("GIRI")
+		gvar = ctx.sections.get("GVAR")
+		arry = ctx.sections.get("ARRY")
+		xrefs = ctx.cached("xrefs", type(ctx).getXrefs)
+
+		instructions = []
+		for instr in code.instructions:
+			if not isinstance(instr, Instruction): continue
+			entry = {
+				"offset": instr.position,
+				"label": ctx.getLabel(instr.position),
+				"words": [instr.toRaw()] + list(code.instructions[instr.position+1:instr.nextPosition]),
+				"text": str(instr)
+			}
+			if instr.opcode in (7, 10, 11, 12): entry["target"] = instr.instructionID
+			if instr.position in xrefs: entry["xrefs"] = xrefs[instr.position]
+			instructions.append(entry)
+
+		return {
+			"entryPoint": head.valueOffset,
+			"functions": [{"offset": off, "name": ctx.getLabel(off)} for off in head.functionOffsets],
+			"code": instructions,
+			"strings": [] if strg is None else [s for s in strg.stringContents.rstrip('\x00').split('\x00') if s],
+			"vectors": [] if vect is None else [list(v) for v in vect.vectors],
+			"characters": [] if giri is None else [{"grpID": grpID, "resID": resID} for (grpID, resID) in giri.characters],
+			"globalVars": [] if gvar is None else [str(var) for var in gvar.globalVars],
+			"arrays": [] if arry is None else [[str(elem) for elem in ar] for ar in arry.arrays]
+		}
+
+	def write(self, ctx, out, name = ""):
+		json.dump(self.toDict(ctx), out, indent = self.indent, ensure_ascii = False)
+		out.write('\n')
+
+formatters = { cls.name: cls for cls in (ListingFormatter, HTMLFormatter, JSONFormatter) }
+
+#---------------------Backends---------------------
+
+class OutputBackend(object):
+	"""
+	Destination of the disassembled scripts. write(name, ctx) is called once per script,
+	name being its output name without extension; flush() makes what has been written so far visible
+	(called in watch mode), close() is called at the end.
+	Every formatter is applied to the same ScriptCtx, so that the scripts are only decoded once.
+	"""
+
+	def __init__(self, formatters):
+		self.formatters = formatters
+
+	def write(self, name, ctx):
+		raise NotImplementedError
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class DirectoryBackend(OutputBackend):
+	"""One file per script and per format: <outDir>/<name>.<extension> (next to the input if outDir is None)"""
+
+	def __init__(self, formatters, outDir = None):
+		OutputBackend.__init__(self, formatters)
+		self.outDir = outDir
+
+	def write(self, name, ctx):
+		base = name if self.outDir is None else os.path.join(self.outDir, name)
+		if os.path.dirname(base): os.makedirs(os.path.dirname(base), exist_ok = True)
+		for formatter in self.formatters:
+			with open('.'.join([base, formatter.extension]), "w", encoding = 'utf-8') as out:
+				formatter.write(ctx, out, name)
+
+class StreamBackend(OutputBackend):
+	"""Everything is written to a single text stream (stdout by default), as soon as each script is decoded"""
+
+	def __init__(self, formatters, out = None):
+		OutputBackend.__init__(self, formatters)
+		self.out = sys.stdout if out is None else out
+
+	def write(self, name, ctx):
+		for formatter in self.formatters:
+			if isinstance(formatter, ListingFormatter): self.out.write('; {0}\n'.format(name))
+			formatter.write(ctx, self.out, name)
+		self.out.flush()
+
+class ZipBackend(OutputBackend):
+	"""A single zip archive, with one member per script and per format"""
+
+	def __init__(self, formatters, fname, compression = zipfile.ZIP_DEFLATED):
+		OutputBackend.__init__(self, formatters)
+		self.archive = zipfile.ZipFile(fname, "w", compression)
+
+	def write(self, name, ctx):
+		for formatter in self.formatters:
+			out = io.StringIO()
+			formatter.write(ctx, out, name)
+			self.archive.writestr('.'.join([name.replace(os.sep, '/'), formatter.extension]), out.getvalue().encode('utf-8'))
+
+	def close(self):
+		self.archive.close()
+
+class SQLiteBackend(OutputBackend):
+	"""A single SQLite database, with a 'listings' (name, format, contents) table; written in a single transaction"""
+
+	def __init__(self, formatters, fname):
+		OutputBackend.__init__(self, formatters)
+		self.db = sqlite3.connect(fname)
+		self.db.execute("CREATE TABLE IF NOT EXISTS listings (name TEXT, format TEXT, contents TEXT, PRIMARY KEY (name, format))")
+
+	def write(self, name, ctx):
+		for formatter in self.formatters:
+			out = io.StringIO()
+			formatter.write(ctx, out, name)
+			self.db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (name.replace(os.sep, '/'), formatter.name, out.getvalue()))
+
+	def flush(self):
+		self.db.commit()
+
+	def close(self):
+		self.db.commit()
+		self.db.close()
+
+def openBackend(output, formats, jsonIndent = '\t'):
+	"""
+	Returns the backend corresponding to output: None (files next to the inputs), '-' (stdout),
+	a .zip or .sqlite/.db file (archive), or a directory. formats is a list of keys of formatters
+	"""
+	if output == '-': jsonIndent = None # one JSON document per line
+	fmts = [JSONFormatter(jsonIndent) if fmt == "json" else formatters[fmt]() for fmt in formats]
+	if output is None: return DirectoryBackend(fmts)
+	elif output == '-': return StreamBackend(fmts)
+	ext = os.path.splitext(output)[1].lower()
+	if ext == '.zip': return ZipBackend(fmts, output)
+	elif ext in ('.sqlite', '.db'): return SQLiteBackend(fmts, output)
+	else: return DirectoryBackend(fmts, output)
+
+def outputNames(fnames, relative = True):
+	"""
+	Output names (without extension) of the script files fnames: their path relative to their
+	common directory if relative is True, their path as is otherwise
+	"""
+	names = [os.path.splitext(fname)[0] for fname in fnames]
+	if not relative or not names: return names
+	common = os.path.commonpath([os.path.dirname(os.path.abspath(fname)) for fname in fnames])
+	return [os.path.relpath(os.path.abspath(name), common) for name in names]
+
+def listScriptFiles(paths):
+	"""Script files designated by paths: files are kept as is, directories are walked for .scd files (sorted by directory)"""
+	fnames = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, _, files in os.walk(path):
+				fnames += sorted(os.path.join(root, f) for f in files if f.endswith(".scd"))
+		else:
+			fnames.append(path)
+	return fnames
@@ -0,0 +1,388 @@
+﻿# See LICENSE for license
+
+import bisect
+import collections
+import functools
+import re
+from XDscriptLib import FunctionInfo, Instruction, ScriptCtx, decodeCodeColumns, instructionColumns
+from XDscriptLib._ScriptVar import wellDefinedTypes
+from XDscriptLib._Bulk import mapFiles
+
+PatternMatch = collections.namedtuple("PatternMatch", "start end captures")
+
+_opcodeNames = { name: opcode for (opcode, name) in enumerate(Instruction.instructionNames) }
+_opcodeNames.update({"jumptrue": 10, "jumpfalse": 11, "jump": 12})
+_ldimmTypes = { name: t for (t, name) in wellDefinedTypes.items() }
+_operators = { name: index for (index, name) in FunctionInfo.operators_name_dict.items() }
+_stdClasses = { name: clsID for (clsID, (name, _)) in FunctionInfo.stdfunctions_name_dict.items() }
+_singletons = { "$" + name[0].lower() + name[1:]: clsID for (clsID, (name, _)) in FunctionInfo.stdfunctions_name_dict.items()
+				if name and clsID < 0x80 }
+
+_variableOpcodes = frozenset((3, 4, 5, 17))
+_branchOpcodes = frozenset((7, 10, 11, 12))
+_immediateTypes = frozenset((0, 1, 2, 0x35))
+
+_comparisons = {
+	"=": lambda a, b: a == b,
+	"!=": lambda a, b: a != b,
+	"<": lambda a, b: a < b,
+	"<=": lambda a, b: a <= b,
+	">": lambda a, b: a > b,
+	">=": lambda a, b: a >= b,
+}
+
+_elementRe = re.compile(r"^(?:@(\w+)\s*:\s*)?(!)?\s*([^\s{]+)(.*?)(?:\{\s*(\d*)\s*(,?)\s*(\d*)\s*\})?$", re.S)
+_gapRe = re.compile(r"^\.\.\.\s*(?:\{\s*(\d*)\s*(,?)\s*(\d*)\s*\})?$")
+_fieldRe = re.compile(r"^(sub|param|target|value)(!=|<=|>=|=|<|>)(.+)$")
+_variableRe = re.compile(r"^(\$\w+)(?:\[(.+)\])?$")
+_valueRe = re.compile(r"^(\w+)(?:=(.+))?$")
+
+def _number(text):
+	try:
+		return int(text, 0)
+	except ValueError:
+		return float(text)
+
+def _quantifier(low, comma, high):
+	low = int(low) if low else 0
+	high = (None if comma else low) if not high else int(high)
+	if high is not None and high < low: raise ValueError("invalid quantifier {{{0},{1}}}".format(low, high))
+	return low, high
+
+#---------------------Predicates---------------------
+# A predicate is a function (columns, index, captures) returning the (possibly updated) captures if
+# the instruction #index satisfies it, None otherwise. The captures dict is copied before being updated
+
+def _valuePredicate(getter, op, text, names):
+	"""Predicate comparing getter(columns, index) to text: a number, '*', '?name' or '@name' (capture)"""
+	if text == "*": return lambda cols, i, caps: caps
+	if text[0] in "?@":
+		name = text[1:]
+		if not name.isidentifier(): raise ValueError("invalid capture name '{0}'".format(text))
+		names.append(name)
+		compare = _comparisons[op]
+		def predicate(cols, i, caps):
+			value = getter(cols, i)
+			if name not in caps:
+				if op != "=" or value is None: return None
+				caps = dict(caps)
+				caps[name] = value
+				return caps
+			return caps if value is not None and compare(value, caps[name]) else None
+		return predicate
+	try:
+		expected = _number(text)
+	except ValueError:
+		raise ValueError("invalid value '{0}'".format(text)) from None
+	compare = _comparisons[op]
+	def predicate(cols, i, caps):
+		value = getter(cols, i)
+		return caps if value is not None and compare(value, expected) else None
+	return predicate
+
+def _maskPredicate(check):
+	return lambda cols, i, caps: caps if check(cols, i) else None
+
+def _sub(cols, i):
+	return cols.subOpcodes[i]
+
+def _param(cols, i):
+	return cols.parameters[i]
+
+def _immediate(cols, i):
+	return cols.immediates[i]
+
+def _target(cols, i):
+	return (cols.subOpcodes[i] << 16) | (cols.parameters[i] & 0xffff) if cols.opcodes[i] in _branchOpcodes else None
+
+def _variablePredicates(token, names):
+	m = _variableRe.match(token)
+	if m is None: raise ValueError("invalid variable '{0}'".format(token))
+	var, index = m.groups()
+	if var in ("$globals", "$stack", "$characters", "$arrays"):
+		if index is None: raise ValueError("missing index in '{0}'".format(token))
+		level, base = {"$globals": (0, 0), "$stack": (1, 0), "$characters": (3, 0x80), "$arrays": (3, 0x200)}[var]
+		if var == "$characters": inRange = lambda p: 0x80 <= p <= 0x120
+		elif var == "$arrays": inRange = lambda p: 0x200 <= p <= 0x2ff
+		else: inRange = lambda p: True
+		ret = [_maskPredicate(lambda cols, i: cols.subOpcodes[i] & 0xf == level and inRange(cols.parameters[i]))]
+		ret.append(_valuePredicate(lambda cols, i: cols.parameters[i] - base, "=", index, names))
+		return ret
+	if index is not None: raise ValueError("unexpected index in '{0}'".format(token))
+	if var == "$lastResult":
+		return [_maskPredicate(lambda cols, i: cols.subOpcodes[i] & 0xf == 2)]
+	if var in _singletons:
+		clsID = _singletons[var]
+		return [_maskPredicate(lambda cols, i: cols.subOpcodes[i] & 0xf == 3 and cols.parameters[i] == clsID)]
+	raise ValueError("unknown variable '{0}'".format(var))
+
+def _stdCallPredicates(token, names):
+	if "::" in token:
+		cls, func = token.split("::", 1)
+		if cls == "*":
+			clsID = None
+		else:
+			clsID = _stdClasses.get(cls)
+			if clsID is None:
+				try: clsID = int(cls, 0)
+				except ValueError: raise ValueError("unknown class '{0}'".format(cls)) from None
+	else:
+		clsID, func = 0, token
+	ret = [] if clsID is None else [_maskPredicate(lambda cols, i: cols.subOpcodes[i] == clsID)]
+	if func == "*" or func[0] in "?@":
+		ret.append(_valuePredicate(_param, "=", func, names))
+		return ret
+	funcs = FunctionInfo.stdfunctions_name_dict.get(clsID, ("", {}))[1] if clsID is not None else {}
+	funcIDs = [index for (index, name) in funcs.items() if name == func]
+	if funcIDs:
+		ret.append(_valuePredicate(_param, "=", str(funcIDs[0]), names))
+	else:
+		try: ret.append(_valuePredicate(_param, "=", str(int(func, 0)), names))
+		except ValueError: raise ValueError("unknown function '{0}'".format(token)) from None
+	return ret
+
+def _ldimmPredicates(token, names):
+	m = _valueRe.match(token)
+	if m is None: raise ValueError("invalid ldimm operand '{0}'".format(token))
+	typeName, value = m.groups()
+	if typeName in _ldimmTypes: t = _ldimmTypes[typeName]
+	else:
+		try: t = int(typeName, 0)
+		except ValueError: raise ValueError("unknown type '{0}'".format(typeName)) from None
+	ret = [_maskPredicate(lambda cols, i: cols.subOpcodes[i] == t)]
+	if value is not None:
+		# immediate value for none_t, int, float and codeptr_t; parameter (string offset, vector index...) otherwise
+		ret.append(_valuePredicate(_immediate if t in _immediateTypes else _param, "=", value, names))
+	return ret
+
+def _operand(token, opcodes, names):
+	"""Returns the list of the predicates of an operand of an element whose opcode is in opcodes"""
+	m = _fieldRe.match(token)
+	if m is not None:
+		field, op, value = m.groups()
+		return [_valuePredicate({"sub": _sub, "param": _param, "target": _target, "value": _immediate}[field], op, value, names)]
+	if token in ("back", "forward"):
+		backward = token == "back"
+		def predicate(cols, i, caps):
+			target = _target(cols, i)
+			return caps if target is not None and (target <= cols.positions[i]) == backward else None
+		return [predicate]
+	if token.startswith("$"):
+		if opcodes is not None and not opcodes <= _variableOpcodes:
+			raise ValueError("variable operand '{0}' on a non-variable instruction".format(token))
+		return _variablePredicates(token, names)
+	if "::" in token or opcodes == {9}:
+		return _stdCallPredicates(token, names)
+	if opcodes == {2}:
+		return _ldimmPredicates(token, names)
+	if opcodes == {1}:
+		if token in _operators: index = _operators[token]
+		else:
+			try: index = int(token, 0)
+			except ValueError: raise ValueError("unknown operator '{0}'".format(token)) from None
+		return [_maskPredicate(lambda cols, i: cols.subOpcodes[i] == index)]
+	raise ValueError("cannot interpret the operand '{0}' (ambiguous or unknown)".format(token))
+
+#---------------------Compilation---------------------
+
+_TEST, _SPLIT, _JUMP, _MATCH = range(4)
+
+class Pattern(object):
+	"""
+	Instruction pattern, compiled to a nondeterministic automaton run over the decoded CODE columns
+	(see decodeCodeColumns).
+
+	A pattern is a sequence of elements separated by ';' or newlines. Each element matches one instruction:
+
+		[@name:] [!] opspec [operand ...] [{m,n}]
+
+	- opspec: instruction name ('ldimm', 'callstd'...), alternatives ('jmp|jmptrue'), opcode number, or '*'
+	- operands (all must hold):
+		ldimm:      type[=value]                  int=5, float, str=?s, codeptr_t
+		callstd:    Class::func, Class::*, func   Character::talk, yield (class 0), 35::*
+		operator:   name                          add, equ
+		variables:  $globals[i], $stack[i], $lastResult, $characters[i], $arrays[i], $singleton
+		branches:   target<=@label, target=0x10, back, forward
+		any:        sub=, param=, value= (ldimm immediate), with =, !=, <, <=, >, >=
+	  Values are numbers, '*', or captures: '?name' binds the value the first time, and must be equal
+	  the next times (backreference); '@name' refers to the position captured by '@name:'.
+	- '@name:' captures the position of the instruction; '!' negates the element (opcode and operands)
+	- '{m,n}', '{m,}', '{m}': the element is repeated (greedily)
+	- '...' matches any sequence of instructions (lazily), '...{m,n}' between m and n instructions
+
+	Matches are leftmost-first, non-overlapping, and never cross function boundaries (HEAD). Examples:
+
+		ldimm int=?n ; ...{0,4} ; callstd Character::*
+		@s: setvar $globals[?k] ; ... ; jmp target<=@s    # global written inside a loop
+	"""
+
+	def __init__(self, text):
+		self.text = text
+		self._program = []
+		self._names = []
+		self._compile(text)
+		# threads must only be merged if their captures do not constrain the rest of the match
+		self._constrained = len(self._names) != len(set(self._names))
+
+	def _emit(self, *op):
+		self._program.append(list(op))
+		return len(self._program) - 1
+
+	def _repeat(self, emitOne, low, high, greedy = True):
+		"""Emits low mandatory copies, then (high - low) optional ones (or a loop if high is None)"""
+		for _ in range(low):
+			emitOne()
+		if high is None:
+			split = self._emit(_SPLIT, None, None)
+			start = len(self._program)
+			emitOne()
+			self._emit(_JUMP, split)
+			end = len(self._program)
+			self._program[split][1:] = [start, end] if greedy else [end, start]
+		else:
+			splits = []
+			for _ in range(high - low):
+				splits.append(self._emit(_SPLIT, None, None))
+				start = len(self._program)
+				emitOne()
+				splits[-1] = (splits[-1], start)
+			end = len(self._program)
+			for (split, start) in splits:
+				self._program[split][1:] = [start, end] if greedy else [end, start]
+
+	def _compile(self, text):
+		elements = [e.strip() for e in re.split(r"[;\n]", text) if e.strip() and not e.strip().startswith("#")]
+		elements = [e.split("#", 1)[0].strip() for e in elements]
+		if not elements: raise ValueError("empty pattern")
+		minLength = 0
+		for element in elements:
+			m = _gapRe.match(element)
+			if m is not None:
+				low, high = _quantifier(*m.groups()) if m.group(1) is not None or m.group(3) else (0, None)
+				self._repeat(lambda: self._emit(_TEST, lambda cols, i, caps: caps), low, high, greedy = False)
+				minLength += low
+				continue
+
+			m = _elementRe.match(element)
+			if m is None: raise ValueError("invalid element '{0}'".format(element))
+			label, negated, opspec, operands, low, comma, high = m.groups()
+			test = self._element(label, negated, opspec, operands.split())
+			low, high = _quantifier(low, comma, high) if low or comma or high else (1, 1)
+			self._repeat(lambda: self._emit(_TEST, test), low, high)
+			minLength += low
+		if minLength == 0: raise ValueError("the pattern matches empty sequences")
+		self._emit(_MATCH)
+
+	def _element(self, label, negated, opspec, operands):
+		if opspec == "*":
+			opcodes = None
+		else:
+			opcodes = set()
+			for name in opspec.split("|"):
+				if name in _opcodeNames: opcodes.add(_opcodeNames[name])
+				else:
+					try: opcodes.add(int(name, 0))
+					except ValueError: raise ValueError("unknown instruction '{0}'".format(name)) from None
+			opcodes = frozenset(opcodes)
+		predicates = []
+		for token in operands:
+			predicates += _operand(token, opcodes, self._names)
+		if label is not None: self._names.append(label)
+
+		def test(cols, i, caps):
+			if opcodes is not None and cols.opcodes[i] not in opcodes: return None
+			for predicate in predicates:
+				caps = predicate(cols, i, caps)
+				if caps is None: return None
+			return caps
+
+		if negated:
+			return lambda cols, i, caps: caps if test(cols, i, caps) is None else None
+		if label is None: return test
+		def labelled(cols, i, caps):
+			caps = test(cols, i, caps)
+			if caps is None: return None
+			caps = dict(caps)
+			caps[label] = cols.positions[i]
+			return caps
+		return labelled
+
+	#---------------------Matching---------------------
+
+	def _addThread(self, threads, seen, pc, caps, start):
+		program = self._program
+		stack = [pc]
+		while stack:
+			pc = stack.pop()
+			key = (pc, tuple(sorted(caps.items()))) if self._constrained else pc
+			if key in seen: continue
+			seen.add(key)
+			op = program[pc]
+			if op[0] == _SPLIT: stack += [op[2], op[1]]
+			elif op[0] == _JUMP: stack.append(op[1])
+			else: threads.append((pc, caps, start))
+
+	def _searchRange(self, cols, lo, hi, matches):
+		program = self._program
+		while lo < hi:
+			threads, seen = [], set()
+			self._addThread(threads, seen, 0, {}, lo)
+			matched = None
+			i = lo
+			while threads:
+				nextThreads, seen = [], set()
+				for (pc, caps, start) in threads:
+					op = program[pc]
+					if op[0] == _MATCH:
+						matched = (start, i, caps)
+						break # lower-priority threads are dropped
+					if i < hi:
+						caps = op[1](cols, i, caps)
+						if caps is not None: self._addThread(nextThreads, seen, pc + 1, caps, start)
+				i += 1
+				if matched is None and i < hi: self._addThread(nextThreads, seen, 0, {}, i)
+				threads = nextThreads
+			if matched is None: return
+			start, end, caps = matched
+			matches.append(PatternMatch(cols.positions[start], cols.positions[end - 1], caps))
+			lo = end
+
+	def searchColumns(self, cols, functionStarts = ()):
+		"""Returns the list of the matches (PatternMatch: first and last positions, captures) in the CODE columns cols"""
+		boundaries = sorted(set([0, len(cols.positions)] + [bisect.bisect_left(cols.positions, pos) for pos in functionStarts]))
+		matches = []
+		for (lo, hi) in zip(boundaries, boundaries[1:]):
+			self._searchRange(cols, lo, hi, matches)
+		return matches
+
+	def search(self, ctx):
+		"""Returns the list of the matches in the script ctx (ScriptCtx)"""
+		cols = ctx.cached("codeColumns", lambda ctx: instructionColumns(ctx.sections["CODE"].instructions))
+		return self.searchColumns(cols, ctx.sections["HEAD"].functionOffsets)
+
+	def searchBytes(self, src):
+		"""Same as search, for the script contents src; instructions are not decoded into Instruction objects"""
+		ctx = ScriptCtx.fromRawSections(src)
+		ctx.parseHEADSection()
+		return self.searchColumns(decodeCodeColumns(ctx.sections["CODE"]), ctx.sections["HEAD"].functionOffsets)
+
+	def searchFiles(self, fnames, maxWorkers = None, chunkSize = 16):
+		"""
+		Searches the script files fnames, in parallel (worker processes, chunkSize files per task).
+		Yields (fname, matches) pairs, in order; files that cannot be loaded are skipped with a warning
+		"""
+		return mapFiles(_searchFile, fnames, maxWorkers, chunkSize, (self.text,))
+
+	def searchCorpus(self, corpus, maxWorkers = None, chunkSize = 16):
+		"""Searches the scripts of a SharedCorpus, in parallel. Returns the list of (fname, matches) pairs, in order"""
+		return corpus.map(functools.partial(_searchShared, self.text), maxWorkers, chunkSize)
+
+@functools.lru_cache(maxsize = 16)
+def _compiledPattern(text):
+	return Pattern(text)
+
+def _searchShared(text, script):
+	return (script.fileName, _compiledPattern(text).searchColumns(script.columns, script.functionOffsets))
+
+def _searchFile(text, fname, src):
+	return _compiledPattern(text).searchBytes(src)
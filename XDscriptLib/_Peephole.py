@@ -0,0 +1,179 @@
+﻿# See LICENSE for license
+
+import collections
+from XDscriptLib import FunctionInfo, Instruction
+
+OptimizationReport = collections.namedtuple("OptimizationReport", "nbInstructionsBefore nbInstructionsAfter sizeBefore sizeAfter rewrites")
+
+def _toS32(val):
+	val &= 0xffffffff
+	return val - 0x100000000 if val & 0x80000000 else val
+
+# Operators that can be folded when all their operands are int constants
+# (int arithmetic is 32-bit, comparison results are ints)
+foldableOperators = {
+	"neg": lambda a: _toS32(-a),
+	"xor": lambda a, b: _toS32(a ^ b),
+	"or":  lambda a, b: _toS32(a | b),
+	"and": lambda a, b: _toS32(a & b),
+	"add": lambda a, b: _toS32(a + b),
+	"sub": lambda a, b: _toS32(a - b),
+	"mul": lambda a, b: _toS32(a * b),
+	"equ": lambda a, b: int(a == b),
+	"gt":  lambda a, b: int(a > b),
+	"ge":  lambda a, b: int(a >= b),
+	"lt":  lambda a, b: int(a < b),
+	"le":  lambda a, b: int(a <= b),
+	"neq": lambda a, b: int(a != b),
+}
+
+_operatorInfo = { entry.index: entry for entry in FunctionInfo.operators if isinstance(entry, FunctionInfo.OperatorInfo) }
+
+def _instructionCount(code):
+	return sum(1 for instr in code.instructions if isinstance(instr, Instruction))
+
+class PeepholeOptimizer(object):
+	"""
+	Peephole optimizer working on the decoded instruction stream of a ScriptCtx.
+	The rewrites are applied through the CODE editing API of ScriptCtx, which relocates the code
+	and patches the call/jump destinations; the rewrites found in a pass are applied together (see ScriptCtx.applySplices). A rewrite is never applied if another instruction jumps
+	in the middle of the sequence it replaces.
+
+	Rewrites:
+		- 'setline': setline removal (line numbers are only used for debugging purposes)
+		- 'jmpnext': removal of 'jmp' to the next instruction (ignoring the 'setline' being stripped)
+		- 'jmpchain': call/jump destinations of jumps to a 'jmp' are replaced by the final destination
+		- 'pushpop': 'ldvar'/'ldimm' followed by 'pop': both are removed (or the count of 'pop' is decremented)
+		- 'constfold': 'ldimm int' constants followed by an operator (see foldableOperators) are folded
+	"""
+
+	def __init__(self, ctx, stripSetline = True):
+		self.ctx = ctx
+		self.stripSetline = stripSetline
+		self.rewrites = collections.Counter()
+
+	def _isTarget(self, pos):
+		head = self.ctx.sections["HEAD"]
+		return pos in self.ctx.getFixupIndex() or pos in self._functionStarts or pos == head.valueOffset
+
+	def _next(self, instr):
+		instrs = self.ctx.sections["CODE"].instructions
+		pos = instr.nextPosition
+		return instrs[pos] if pos < len(instrs) and isinstance(instrs[pos], Instruction) else None
+
+	def _intImmediate(self, instr):
+		if instr is not None and instr.opcode == 2 and instr.subOpcode == 1 and instr.nextPosition == instr.position + 2:
+			return self.ctx.sections["CODE"].instructions[instr.position + 1]
+		return None
+
+	def _skipSetlines(self, pos):
+		"""Returns the position of the first instruction from pos which is not a 'setline' being stripped"""
+		instrs = self.ctx.sections["CODE"].instructions
+		while self.stripSetline and pos < len(instrs) and isinstance(instrs[pos], Instruction) and instrs[pos].opcode == 16:
+			pos = instrs[pos].nextPosition
+		return pos
+
+	def _finalDestination(self, dest):
+		instrs = self.ctx.sections["CODE"].instructions
+		seen = set()
+		while dest < len(instrs) and isinstance(instrs[dest], Instruction) and instrs[dest].opcode == 12 and dest not in seen:
+			seen.add(dest)
+			dest = instrs[dest].instructionID
+		return dest
+
+	def _rewrite(self, instr, limit):
+		"""
+		Tries to apply a rewrite at instr, the code from limit onwards being already rewritten in this pass.
+		Jump destinations are modified in place ('jmpchain', returns True); the other rewrites return
+		(name, (position, count, words)), the splice to apply (see ScriptCtx.applySplices). Returns None otherwise
+		"""
+		ctx = self.ctx
+		pos = instr.position
+		opcode = instr.opcode
+		nxt = self._next(instr)
+
+		if opcode == 16 and self.stripSetline:
+			return ('setline', (pos, instr.nextPosition - pos, []))
+
+		if opcode == 12 and self._skipSetlines(instr.instructionID) == self._skipSetlines(instr.nextPosition):
+			return ('jmpnext', (pos, instr.nextPosition - pos, []))
+
+		if opcode in (10, 11, 12):
+			dest = self._finalDestination(instr.instructionID)
+			if dest != instr.instructionID and dest < len(ctx.sections["CODE"].instructions):
+				instr.instructionID = dest
+				self.rewrites['jmpchain'] += 1
+				return True
+
+		if nxt is None or nxt.nextPosition > limit or self._isTarget(nxt.position):
+			return None
+
+		if opcode in (2, 3) and nxt.opcode == 6 and nxt.subOpcode >= 1 and nxt.parameter == 0:  # ldimm/ldvar; pop
+			words = [] if nxt.subOpcode == 1 else [Instruction(0x06000000 | ((nxt.subOpcode - 1) << 16))]
+			return ('pushpop', (pos, nxt.nextPosition - pos, words))
+
+		a = self._intImmediate(instr)
+		if a is None:
+			return None
+
+		op = nxt
+		args = (a,)
+		b = self._intImmediate(nxt)
+		if b is not None:
+			op = self._next(nxt)
+			args = (a, b)
+			if op is None or op.nextPosition > limit or self._isTarget(op.position):
+				return None
+
+		info = _operatorInfo.get(op.subOpcode) if op.opcode == 1 else None
+		if info is None or info.nbOperands != len(args) or info.name not in foldableOperators:
+			return None
+		return ('constfold', (pos, op.nextPosition - pos, [Instruction(0x02010000), foldableOperators[info.name](*args)]))
+
+	def _apply(self, rewrites):
+		"""Applies the (name, splice) rewrites at once, or one by one if some cannot be applied. Returns True if CODE has been modified"""
+		try:
+			self.ctx.applySplices([splice for (name, splice) in rewrites])
+			self.rewrites.update(name for (name, splice) in rewrites)
+			return True
+		except ValueError:
+			pass
+		changed = False
+		# Backwards, so that the positions of the remaining splices stay valid
+		for (name, splice) in sorted(rewrites, key = lambda rewrite: rewrite[1][0], reverse = True):
+			try:
+				self.ctx.spliceInstructions(*splice)
+			except ValueError:
+				continue # e.g. the instruction to remove is the last one and is referenced
+			self.rewrites[name] += 1
+			changed = True
+		return changed
+
+	def run(self):
+		"""Applies the rewrites until no more can be applied. Returns an OptimizationReport"""
+		code = self.ctx.sections["CODE"]
+		nbInstructionsBefore, sizeBefore = _instructionCount(code), 4*len(code.instructions)
+
+		changed = True
+		while changed:
+			changed = False
+			self._functionStarts = set(self.ctx.sections["HEAD"].functionOffsets)
+			# Each pass collects non-overlapping rewrites (going backwards), then applies them in a single relayout of CODE
+			rewrites = []
+			limit = len(code.instructions)
+			for pos in range(len(code.instructions) - 1, -1, -1):
+				instr = code.instructions[pos]
+				if not isinstance(instr, Instruction): continue
+				ret = self._rewrite(instr, limit)
+				if ret is True:
+					changed = True
+				elif ret is not None:
+					rewrites.append(ret)
+					limit = pos
+			if rewrites and self._apply(rewrites): changed = True
+
+		return OptimizationReport(nbInstructionsBefore, _instructionCount(code), sizeBefore, 4*len(code.instructions), dict(self.rewrites))
+
+def optimizeScript(ctx, stripSetline = True):
+	"""Runs the peephole optimizer on ctx, see PeepholeOptimizer. Returns an OptimizationReport"""
+	return PeepholeOptimizer(ctx, stripSetline).run()
@@ -0,0 +1,173 @@
+﻿# See LICENSE for license
+
+import collections
+import hashlib
+import os
+import sys
+import threading
+from XDscriptLib import Instruction, ScriptCtx, loadScript
+
+CacheStats = collections.namedtuple("CacheStats", "hits misses evictions nbEntries currentSize maxSize")
+
+def estimateCtxSize(ctx):
+	"""Rough estimation of the memory used by a parsed ScriptCtx, in bytes"""
+	sz = sys.getsizeof(ctx)
+	for sec in ctx.sections.values():
+		sz += sys.getsizeof(sec) + sys.getsizeof(sec.data)
+	code = ctx.sections["CODE"]
+	sz += sys.getsizeof(code.instructions) + sys.getsizeof(code.labels)
+	for instr in code.instructions:
+		sz += sys.getsizeof(instr)
+		if isinstance(instr, Instruction): sz += sys.getsizeof(instr.__dict__)
+	return sz
+
+class ScriptCacheEntry(object):
+	"""
+	Cache entry: a parsed ScriptCtx, along with the results memoized for it
+	(rendered listings, xrefs, ...), tagged with the modificationCount of the ctx they were computed on
+	"""
+
+	def __init__(self, key, ctx, size):
+		self.key = key
+		self.ctx = ctx
+		self.size = size
+		self.memo = dict()
+		self.lock = threading.Lock()
+
+class ScriptCache(object):
+	"""
+	Thread-safe, in-process cache of parsed ScriptCtx objects, with LRU eviction.
+
+	Files are keyed by (absolute path, mtime, size), raw buffers by their SHA-1 digest.
+	maxSize is the memory budget in bytes (as estimated by estimateCtxSize, plus the size of
+	the memoized results); the least recently used entries are evicted when it is exceeded.
+	The most recently used entry is never evicted, even if it does not fit in the budget by itself.
+	If sidecars is True, files are loaded through their sidecar files (see loadScript).
+
+	The cached ScriptCtx objects are shared: any number of threads may read the same one (its lazily built
+	indices are locked), but it must not be modified while other threads use it. Memoized results are
+	recomputed after the ctx has been modified (e.g. through the CODE editing API).
+	"""
+
+	def __init__(self, maxSize = 256*1024*1024, displayOffsets = False, hardened = False, sidecars = False):
+		self.maxSize = maxSize
+		self.displayOffsets = displayOffsets
+		self.hardened = hardened
+		self.sidecars = sidecars
+		self._entries = collections.OrderedDict()
+		self._lock = threading.RLock()
+		self._currentSize = 0
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+
+	#---------------------Getters---------------------
+
+	@property
+	def stats(self):
+		with self._lock:
+			return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self._currentSize, self.maxSize)
+
+	#-------------------------------------------------
+
+	def _evict(self):
+		# Caller must hold self._lock
+		while self._currentSize > self.maxSize and len(self._entries) > 1:
+			_, entry = self._entries.popitem(last=False)
+			self._currentSize -= entry.size
+			self._evictions += 1
+
+	def _lookup(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				self._entries.move_to_end(key)
+				self._hits += 1
+			else:
+				self._misses += 1
+			return entry
+
+	def _insert(self, key, ctx):
+		entry = ScriptCacheEntry(key, ctx, estimateCtxSize(ctx))
+		with self._lock:
+			other = self._entries.get(key)
+			if other is not None: # another thread was faster
+				self._entries.move_to_end(key)
+				return other
+			self._entries[key] = entry
+			self._currentSize += entry.size
+			self._evict()
+		return entry
+
+	def _grow(self, entry, delta):
+		with self._lock:
+			entry.size += delta
+			if self._entries.get(entry.key) is entry:
+				self._currentSize += delta
+				self._evict()
+
+	def _fileKey(self, fname):
+		fname = os.path.abspath(fname)
+		st = os.stat(fname)
+		return (fname, st.st_mtime_ns, st.st_size)
+
+	def getEntry(self, fname):
+		key = self._fileKey(fname)
+		entry = self._lookup(key)
+		if entry is None:
+			if self.sidecars:
+				entry = self._insert(key, loadScript(fname, self.displayOffsets, self.hardened))
+			else:
+				with open(fname, "rb") as f:
+					entry = self._insert(key, ScriptCtx(f.read(), self.displayOffsets, self.hardened))
+		return entry
+
+	def getEntryFromBytes(self, src):
+		key = hashlib.sha1(src).digest()
+		entry = self._lookup(key)
+		if entry is None:
+			entry = self._insert(key, ScriptCtx(src, self.displayOffsets, self.hardened))
+		return entry
+
+	def get(self, fname):
+		"""Returns the ScriptCtx corresponding to the script file fname, loading it if needed"""
+		return self.getEntry(fname).ctx
+
+	def getFromBytes(self, src):
+		"""Returns the ScriptCtx corresponding to the script contents src, loading it if needed"""
+		return self.getEntryFromBytes(src).ctx
+
+	def memoize(self, entry, name, func):
+		"""
+		Returns func(entry.ctx), computing it only once per entry, unless entry.ctx is modified
+		in the meantime (see ScriptCtx.modificationCount)
+		"""
+		with entry.lock:
+			version = entry.ctx.modificationCount
+			old = entry.memo.get(name)
+			if old is not None and old[0] == version:
+				return old[1]
+			res = func(entry.ctx)
+			entry.memo[name] = (version, res)
+			self._grow(entry, sys.getsizeof(res) - (0 if old is None else sys.getsizeof(old[1])))
+			return res
+
+	def listing(self, fname):
+		"""Returns the (memoized) disassembly listing of fname"""
+		return self.memoize(self.getEntry(fname), "listing", str)
+
+	def xrefs(self, fname):
+		"""Returns the (memoized) cross-references of fname, see ScriptCtx.getXrefs"""
+		return self.memoize(self.getEntry(fname), "xrefs", ScriptCtx.getXrefs)
+
+	def invalidate(self, fname):
+		"""Drops every cached version of fname"""
+		fname = os.path.abspath(fname)
+		with self._lock:
+			for key in [k for k in self._entries if isinstance(k, tuple) and k[0] == fname]:
+				self._currentSize -= self._entries.pop(key).size
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._currentSize = 0
@@ -1,10 +1,18 @@
 ﻿# See LICENSE for license
 
 import struct
+import hashlib
+import threading
 import warnings
 import copy
-from XDscriptLib import Instruction, ScriptVar, parseScriptArray
+import bisect
+import collections
+from array import array
+from XDscriptLib import Instruction, ScriptVar, parseScriptArray, VectorPool
 import io
+from XDscriptLib._Trace import traced, tracePhase
+
+_missing = object()
 
 class ScriptSection(object):
 	"""
@@ -14,20 +22,105 @@ class ScriptSection(object):
 	0x04: s32 sectionSize
 	0x08 to 0x0f: padding
 	0x10: s32 nbElems. For CODE, HEAD, and FTBL, it is the number of functions. For all other sections, it should be obvious.
-	0x14: s32 valueOffset. For FTBL, the name buffer offset. For HEAD, the entry point
+	0x14: s32 valueOffset. For FTBL, the name buffer offset. For HEAD, the entry point. For CODE, the number of words (the data is padded)
 	0x18: u32 unknown (used by FTBL and GVAR)
 	0x1c to 0x1f: padding ?
 	0x20: data
 	"""
 
 	def __init__(self, src):
-		self.name = src[:4].decode('ascii')
+		self.name = bytes(src[:4]).decode('latin-1')
 		data = memoryview(src)
 		self.totalSize = struct.unpack_from(">I", data, 4)[0]
 		self.nbElems = struct.unpack_from(">i", data, 0x10)[0]
 		self.valueOffset = struct.unpack_from(">I", data, 0x14)[0]
 		self.unknown = struct.unpack_from(">I", data, 0x18)[0]
+		self.header = bytes(data[:0x20])
 		self.data = bytes(data[0x20:self.totalSize])
+		self.fileOffset = None # offset of the section in the script file, set by ScriptCtx.loadSections
+
+	def toBytes(self):
+		"""Serializes the section, padding its data to a multiple of 16 bytes"""
+		data = self.data + b'\x00' * (-len(self.data) % 16)
+		hdr = bytearray(self.header)
+		struct.pack_into(">4sI", hdr, 0, self.name.encode('ascii'), 0x20 + len(data))
+		struct.pack_into(">iII", hdr, 0x10, self.nbElems, self.valueOffset, self.unknown)
+		self.totalSize = len(hdr) + len(data)
+		return bytes(hdr) + data
+
+class ScriptFormatError(ValueError):
+	"""Raised when a script is malformed (always in hardened mode, only when the script cannot be parsed at all otherwise)"""
+	pass
+
+def codeWordCount(sec):
+	"""Returns the number of words of a CODE section"""
+	return sec.valueOffset if 0 < sec.valueOffset <= len(sec.data) // 4 else len(sec.data) // 4
+
+CodeColumns = collections.namedtuple("CodeColumns", "positions opcodes subOpcodes parameters immediates")
+
+def decodeCodeColumns(sec):
+	"""
+	Decodes a CODE section into columns (arrays) of instruction positions, opcodes, sub-opcodes and parameters,
+	without creating Instruction objects. immediates is the list of the immediate values of 'ldimm' (None for
+	the other instructions), decoded as in Instruction.check
+	"""
+	nbWords = codeWordCount(sec)
+	words = struct.unpack_from(">{0}I".format(nbWords), sec.data)
+	positions, opcodes, subOpcodes, parameters = array('I'), array('B'), array('B'), array('h')
+	immediates = []
+	pos = 0
+	while pos < nbWords:
+		word = words[pos]
+		opcode, subOpcode = word >> 24, (word >> 16) & 0xff
+		positions.append(pos)
+		opcodes.append(opcode)
+		subOpcodes.append(subOpcode)
+		parameters.append((word & 0xffff) - 0x10000 if word & 0x8000 else word & 0xffff)
+		if opcode == 2 and subOpcode in (0, 1, 2, 0x35) and pos + 1 < nbWords:
+			immediate = words[pos + 1]
+			if subOpcode == 1: immediate = immediate - 0x100000000 if immediate & 0x80000000 else immediate
+			elif subOpcode == 2: immediate = struct.unpack(">f", struct.pack(">I", immediate))[0]
+			immediates.append(immediate)
+			pos += 2
+		else:
+			immediates.append(None)
+			pos += 1
+	return CodeColumns(positions, opcodes, subOpcodes, parameters, immediates)
+
+def instructionColumns(instructions):
+	"""Same as decodeCodeColumns, for an already decoded instruction list (CODE.instructions)"""
+	positions, opcodes, subOpcodes, parameters = array('I'), array('B'), array('B'), array('h')
+	immediates = []
+	for instr in instructions:
+		if not isinstance(instr, Instruction): continue
+		positions.append(instr.position)
+		opcodes.append(instr.opcode)
+		subOpcodes.append(instr.subOpcode)
+		parameters.append(instr.parameter)
+		immediates.append(instructions[instr.position + 1] if instr.nextPosition == instr.position + 2 else None)
+	return CodeColumns(positions, opcodes, subOpcodes, parameters, immediates)
+
+def parseFunctionTable(sec):
+	"""Returns the list of (code offset, name) of a FTBL section"""
+	functionTable = []
+	for i in range(min(sec.nbElems, len(sec.data) // 8)):
+		code_off = struct.unpack_from(">I", sec.data, 8*i)[0]
+		nm_off = struct.unpack_from(">I", sec.data, 4 + 8*i)[0] - 0x20
+		if 0 > nm_off or nm_off >= len(sec.data): 
+			continue 
+		nm = sec.data[nm_off:sec.data.find(b'\x00', nm_off)].decode('sjis', 'replace')
+		functionTable.append((code_off, nm))
+	return functionTable
+
+def _decodeString(data, offset):
+	"""Decodes the string at offset (in bytes: string offsets refer to the Shift-JIS encoded data)"""
+	end = data.find(b'\x00', offset)
+	return data[offset:end if end >= 0 else len(data)].decode('sjis', 'replace')
+
+def _nbItems(ctx, sectionName, attr):
+	# item count of a phase (see _Trace)
+	sec = ctx.sections.get(sectionName)
+	return len(getattr(sec, attr, ())) if sec is not None else 0
 
 class ScriptCtx(object):
 	"""Script context class (assembler / disassembler)
@@ -40,34 +133,133 @@ class ScriptCtx(object):
 	
 	#Oh, and f*ck properties ...
 
+	def error(self, msg):
+		"""Raises ScriptFormatError in hardened mode, warns otherwise"""
+		if self.hardened: raise ScriptFormatError(msg)
+		warnings.warn(msg)
+
+	@traced("loadSections", lambda ctx: len(ctx.sections))
 	def loadSections(self, src):
 		self.sections = dict()
+		src = memoryview(src)
 		offset = 0x10
-		while offset < self.totalSize:
+		end = min(self.totalSize, len(src))
+		while offset < end:
+			if offset + 0x20 > end:
+				self.error("Truncated section header at offset {0}".format(hex(offset)))
+				break
 			currentSection = ScriptSection(src[offset:])
+			if currentSection.totalSize < 0x20 or offset + currentSection.totalSize > end:
+				self.error("Invalid section size encountered ({0} at offset {1})".format(hex(currentSection.totalSize), hex(offset)))
+				break
+			if currentSection.name in self.sections:
+				self.error("Duplicate section {0}".format(currentSection.name))
+			currentSection.fileOffset = offset
 			offset += currentSection.totalSize
 			self.sections[currentSection.name] = currentSection
 
+		for name in ("HEAD", "CODE"):
+			if name not in self.sections:
+				raise ScriptFormatError("Missing {0} section".format(name))
+
+	def _checkRange(self, sec, what, value, limit):
+		if not 0 <= value < limit:
+			raise ScriptFormatError("{0}: out-of-range {1} ({2}, limit {3})".format(sec.name, what, value, limit))
+
+	@traced("validate")
+	def validate(self):
+		"""
+		Hardened mode: validates every count, offset and index of every section once, before anything is parsed,
+		so that the parsing functions do not need to. Raises ScriptFormatError.
+		"""
+		sections = self.sections
+		for sec in sections.values():
+			if sec.nbElems < 0:
+				raise ScriptFormatError("{0}: negative number of elements".format(sec.name))
+		code = sections["CODE"]
+		head = sections["HEAD"]
+		ftbl = sections.get("FTBL")
+		strg = sections.get("STRG")
+		vect = sections.get("VECT")
+		nbWords = codeWordCount(code)
+
+		for (sec, elemSize) in ((ftbl, 8), (head, 4), (vect, 12), (sections.get("GIRI"), 8), (sections.get("GVAR"), 8), (sections.get("ARRY"), 4)):
+			if sec is not None and elemSize * sec.nbElems > len(sec.data):
+				raise ScriptFormatError("{0}: too many elements ({1})".format(sec.name, sec.nbElems))
+
+		if strg is not None:
+			try: strg.data.decode('sjis')
+			except UnicodeDecodeError as e: raise ScriptFormatError("STRG: {0}".format(e))
+
+		if ftbl is not None:
+			for i in range(ftbl.nbElems):
+				code_off, nm_off = struct.unpack_from(">II", ftbl.data, 8*i)
+				self._checkRange(ftbl, "code offset", code_off, nbWords)
+				self._checkRange(ftbl, "name offset", nm_off - 0x20, len(ftbl.data))
+				nm_end = ftbl.data.find(b'\x00', nm_off - 0x20)
+				if nm_end < 0:
+					raise ScriptFormatError("FTBL: unterminated function name")
+				try: ftbl.data[nm_off - 0x20:nm_end].decode('sjis')
+				except UnicodeDecodeError as e: raise ScriptFormatError("FTBL: {0}".format(e))
+
+		functionOffsets = struct.unpack_from(">{0}I".format(head.nbElems), head.data)
+		for off in functionOffsets + (head.valueOffset,):
+			self._checkRange(head, "function offset", off, nbWords)
+
+		words = struct.unpack_from(">{0}I".format(nbWords), code.data)
+		boundaries = bytearray(nbWords)
+		destinations = list(functionOffsets) + [head.valueOffset]
+		pos = 0
+		while pos < nbWords:
+			boundaries[pos] = 1
+			opcode, subOpcode, parameter = words[pos] >> 24, (words[pos] >> 16) & 0xff, words[pos] & 0xffff
+			if parameter & 0x8000: parameter -= 0x10000
+			if opcode > 17:
+				raise ScriptFormatError("CODE: illegal opcode {0} at instruction #{1}".format(opcode, hex(pos)))
+			elif opcode == 2 and subOpcode in (0, 1, 2, 0x35):
+				if pos + 1 >= nbWords:
+					raise ScriptFormatError("CODE: missing immediate at instruction #{0}".format(hex(pos)))
+				pos += 1
+			elif opcode == 2 and subOpcode == 3:
+				self._checkRange(code, "string offset", parameter, 0 if strg is None else len(strg.data))
+			elif opcode == 2 and subOpcode == 4:
+				self._checkRange(code, "vector ID", parameter, 0 if vect is None else vect.nbElems)
+			elif opcode in (7, 10, 11, 12):
+				destinations.append((subOpcode << 16) | (parameter & 0xffff))
+			pos += 1
+
+		for dest in destinations:
+			self._checkRange(code, "destination", dest, nbWords)
+			if not boundaries[dest]:
+				raise ScriptFormatError("CODE: destination {0} is not an instruction boundary".format(hex(dest)))
+
+		arry = sections.get("ARRY")
+		if arry is not None:
+			for i in range(arry.nbElems):
+				off = struct.unpack_from(">I", arry.data, 4*i)[0] - 0x10
+				if off < 4*arry.nbElems: continue # skipped by parseARRYSection
+				self._checkRange(arry, "array offset", off, len(arry.data) - 0x10 + 1)
+				sz = struct.unpack_from(">i", arry.data, off)[0]
+				self._checkRange(arry, "array size", sz, (len(arry.data) - off - 0x10) // 8 + 1)
+
+	@traced("parseFTBLSection", lambda ctx: _nbItems(ctx, "FTBL", "functionTable"))
 	def parseFTBLSection(self):
 		sec = self.sections.get("FTBL")
 		if sec is None: return
-		sec.functionTable = []
-		for i in range(sec.nbElems):
-			code_off = struct.unpack_from(">I", sec.data, 8*i)[0]
-			nm_off = struct.unpack_from(">I", sec.data, 4 + 8*i)[0] - 0x20
-			if 0 > nm_off or nm_off >= len(sec.data): 
-				continue 
-			nm = sec.data[nm_off:sec.data.find(b'\x00', nm_off)].decode('sjis')
-			sec.functionTable.append((code_off, nm))
+		sec.functionTable = parseFunctionTable(sec)
 
+	@traced("parseHEADSection", lambda ctx: _nbItems(ctx, "HEAD", "functionOffsets"))
 	def parseHEADSection(self):
 		sec = self.sections["HEAD"]
-		sec.functionOffsets = [struct.unpack_from(">I", sec.data, 4*i)[0] for i in range(sec.nbElems)]
+		sec.functionOffsets = [struct.unpack_from(">I", sec.data, 4*i)[0] for i in range(min(sec.nbElems, len(sec.data) // 4))]
 
+	@traced("parseCODESection", lambda ctx: _nbItems(ctx, "CODE", "instructions"))
 	def parseCODESection(self):
 		sec = self.sections["CODE"]
-		sec.instructions = list(struct.unpack_from(">{0}I".format(len(sec.data) // 4), sec.data))
-		sec.labels = [""]*len(sec.instructions)
+		nbWords = codeWordCount(sec)
+		sec.instructions = list(struct.unpack_from(">{0}I".format(nbWords), sec.data))
+		sec.labels = dict()
+		sec.fixups = None
 
 		pos = 0
 		while pos < len(sec.instructions):
@@ -76,53 +268,78 @@ class ScriptCtx(object):
 				pos =  sec.instructions[pos].nextPosition
 
 	
-	def parseSTRGSection(self):
-		"""String constants"""
+	@traced("parseSTRGSection", lambda ctx: _nbItems(ctx, "STRG", "stringContents"))
+	def parseSTRGSection(self, stringContents = None):
+		"""String constants (stringContents: already decoded contents)"""
 		sec = self.sections.get("STRG")
 		if sec is None: return
-		sec.stringContents = sec.data.decode('sjis')
-		sec.getString = (lambda offset: sec.stringContents[offset:sec.stringContents.find('\x00', offset)])
+		sec.stringContents = sec.data.decode('sjis', 'replace') if stringContents is None else stringContents
+		sec.getString = (lambda offset: _decodeString(sec.data, offset))
 
+	@traced("parseVECTSection", lambda ctx: _nbItems(ctx, "VECT", "vectors"))
 	def parseVECTSection(self):
 		"""Vector constants"""
 		sec = self.sections.get("VECT")
 		if sec is None: return
-		sec.vectors = [struct.unpack_from(">3f", sec.data, 12*i) for i in range(sec.nbElems)]
+		sec.vectors = VectorPool(sec.data, sec.nbElems)
 	
+	@traced("parseGIRISection", lambda ctx: _nbItems(ctx, "GIRI", "characters"))
 	def parseGIRISection(self):
 		"""Characters. (grpID = 0, resID = 100) is the player itself"""
 		sec = self.sections.get("GIRI")
 		if sec is None: return
-		sec.characters = [(struct.unpack_from(">I", sec.data, 8*i)[0], struct.unpack_from(">I", sec.data, 8*i + 4)[0]) for i in range(sec.nbElems)]
+		sec.characters = [(struct.unpack_from(">I", sec.data, 8*i)[0], struct.unpack_from(">I", sec.data, 8*i + 4)[0]) for i in range(min(sec.nbElems, len(sec.data) // 8))]
 
+	@traced("parseGVARSection", lambda ctx: _nbItems(ctx, "GVAR", "globalVars"))
 	def parseGVARSection(self):
 		"""Global variables"""
 		sec = self.sections.get("GVAR")
 		if sec is None: return
-		sec.globalVars = [ScriptVar(sec.data[8*i:8*i+8]) for i in range(sec.nbElems)] 
+		sec.globalVars = [ScriptVar(sec.data[8*i:8*i+8]) for i in range(min(sec.nbElems, len(sec.data) // 8))]
 
+	@traced("parseARRYSection", lambda ctx: _nbItems(ctx, "ARRY", "arrays"))
 	def parseARRYSection(self):
 		"""Arrays"""
 		sec = self.sections.get("ARRY")
 		if sec is None: return
 
 		sec.arrays = []
-		for i in range(sec.nbElems):
+		for i in range(min(sec.nbElems, len(sec.data) // 4)):
 			off = struct.unpack_from(">I", sec.data, 4*i)[0]
-			if (off - 0x10) >= 4*sec.nbElems: sec.arrays.append(parseScriptArray(memoryview(sec.data)[off-0x10:]))
+			if (off - 0x10) >= 4*sec.nbElems:
+				if off > len(sec.data) or 0x10 + 8*struct.unpack_from(">i", sec.data, off-0x10)[0] > len(sec.data) - (off-0x10):
+					self.error("ARRY: invalid array (offset {0})".format(hex(off)))
+					continue
+				sec.arrays.append(parseScriptArray(memoryview(sec.data)[off-0x10:]))
 	
 
-	def load(self, src):
-		if src[:4] != b'TCOD': warnings.warn("Apparently not a XD script file!")
+	def loadHeaders(self, src):
+		"""Loads the script header and the raw sections, without decoding them"""
+		if len(src) < 0x10: raise ScriptFormatError("Truncated script header")
+		self.analysisCache = dict()
+		self.modificationCount = 0
+		self._lazyLock = threading.RLock() # lazily built indices (see cached, getFixupIndex)
+		if src[:4] != b'TCOD': self.error("Apparently not a XD script file!")
 		self.totalSize = struct.unpack_from(">I", src, 4)[0]
+		self.header = bytes(src[:0x10])
 		if self.totalSize != len(src):
 			warnings.warn("len(src) is different from the script stored total size")
 
 		self.loadSections(src)
+		if self.hardened: self.validate()
+
+	@traced("load", lambda ctx: ctx.totalSize)
+	def load(self, src, sidecar = None):
+		"""
+		Loads the script src. sidecar is an optional pre-decoded version of its CODE and STRG sections
+		(a Sidecar, which must match src), see _Sidecar
+		"""
+		self.loadHeaders(src)
 		self.parseFTBLSection()
 		self.parseHEADSection()
-		self.parseCODESection()
-		self.parseSTRGSection()
+		if sidecar is None: self.parseCODESection()
+		else: sidecar.restoreCODESection(self)
+		self.parseSTRGSection(None if sidecar is None else sidecar.stringContents)
 		self.parseVECTSection()
 		self.parseGIRISection()
 		self.parseGVARSection()
@@ -137,20 +354,487 @@ class ScriptCtx(object):
 			if not ftbl.nbElems == head.nbElems == code.nbElems:
 				warnings.warn("Inconsistent number of functions between FTBL, HEAD, and CODE")
 			for (off, nm) in ftbl.functionTable:
-				code.labels[off] = nm
+				if off < len(code.instructions): code.labels[off] = nm
+				else: warnings.warn("out-of-range function offset in FTBL ({0})".format(hex(off)))
 		elif head.nbElems != code.nbElems:
 			warnings.warn("Inconsistent number of functions between HEAD, and CODE")
 
-		entryPoint = head.valueOffset
-		if not code.labels[entryPoint]: code.labels[entryPoint] = "__start" 
+		if head.valueOffset >= len(code.instructions): warnings.warn("out-of-range entry point ({0})".format(hex(head.valueOffset)))
+		if sidecar is not None: code.labels.update(sidecar.labels)
 		
-	def __init__(self, src, displayOffsets = False):
-		self.load(src)
+	def invalidateRenderCache(self):
+		"""To be called after modifying the contents of STRG or VECT"""
+		self.analysisChanged()
+		for instr in self.sections["CODE"].instructions:
+			if isinstance(instr, Instruction): instr.invalidate()
+
+	def getLabel(self, pos):
+		"""
+		Returns the label of the position pos of CODE ("" if there is none).
+
+		CODE.labels only holds the labels which are explicitly named (function names from FTBL, or user-defined).
+		The other labels are generated on demand, the position-fixup index being the label discovery pass:
+		'sub_' for call destinations and functions, 'loc_' for jump destinations and what follows jumps,
+		and '__start' for the entry point.
+		"""
+		code = self.sections["CODE"]
+		lbl = code.labels.get(pos)
+		if lbl is not None: return lbl
+
+		refs = self.getFixupIndex().get(pos)
+		if refs:
+			return ('sub_' if any(instr.opcode == 7 for instr in refs) else 'loc_') + hex(pos)[2:]
+		prev = code.instructions[pos - 1] if 0 < pos <= len(code.instructions) else None
+		if isinstance(prev, Instruction) and prev.opcode in (10, 11, 12):
+			return 'loc_' + hex(pos)[2:]
+		head = self.sections["HEAD"]
+		if pos == head.valueOffset:
+			return "__start"
+		if pos in self.cached("functionStarts", lambda ctx: set(head.functionOffsets)):
+			return 'sub_' + hex(pos)[2:]
+		return ""
+
+	def cached(self, name, func):
+		"""
+		Returns func(self), computing it only once. The cached results are dropped whenever CODE is modified
+		(through the editing methods or the Instruction setters, see analysisChanged). Concurrent readers are safe;
+		modifying the script while other threads read it is not
+		"""
+		ret = self.analysisCache.get(name, _missing)
+		if ret is _missing:
+			with self._lazyLock:
+				ret = self.analysisCache.get(name, _missing)
+				if ret is _missing:
+					ret = self.analysisCache[name] = func(self)
+		return ret
+
+	def analysisChanged(self):
+		"""Drops the cached results (see cached) and increments modificationCount; called whenever the script is modified"""
+		self.analysisCache.clear()
+		self.modificationCount += 1
+
+	def contentDigest(self):
+		"""
+		Returns the SHA-1 digest (bytes) of the decoded contents of the script: the words of CODE, the function offsets,
+		the entry point, the function table, and the data of the other sections. Unlike hashing toBytes(), nothing is
+		assembled (or modified). Cached (see cached); invalidateRenderCache must be called after modifying STRG or VECT
+		"""
+		return self.cached("digest", ScriptCtx._contentDigest)
+
+	def _contentDigest(self):
+		h = hashlib.sha1()
+		code = self.sections["CODE"]
+		head = self.sections["HEAD"]
+		ftbl = self.sections.get("FTBL")
+		words = [word.toRaw() if isinstance(word, Instruction) else struct.unpack(">I", struct.pack(">f", word))[0]
+				if type(word) is float else word & 0xffffffff for word in code.instructions]
+		h.update(struct.pack(">{0}I".format(len(words)), *words))
+		h.update(struct.pack(">{0}I".format(len(head.functionOffsets) + 1), head.valueOffset, *head.functionOffsets))
+		for (off, nm) in (ftbl.functionTable if ftbl is not None else ()):
+			h.update(struct.pack(">I", off) + nm.encode('utf-8') + b'\x00')
+		for (name, sec) in self.sections.items():
+			if name in ("CODE", "HEAD", "FTBL"): continue
+			data = sec.vectors.toBytes() if name == "VECT" and sec.vectors.modified else sec.data
+			h.update(struct.pack(">4sI", name.encode('latin-1'), len(data)) + data)
+		return h.digest()
+
+	def getXrefs(self):
+		"""Returns a dict mapping each call/jump destination to the sorted list of positions referencing it"""
+		code = self.sections["CODE"]
+		xrefs = dict()
+		for instr in code.instructions:
+			if isinstance(instr, Instruction) and instr.opcode in (7, 10, 11, 12):
+				xrefs.setdefault(instr.instructionID, []).append(instr.position)
+		return xrefs
+
+	#---------------------Assembling---------------------
+
+	def buildFTBLSection(self):
+		sec = self.sections.get("FTBL")
+		if sec is None: return
+		nameBufferOffset = 0x20 + 8*len(sec.functionTable)
+		entries = io.BytesIO()
+		names = io.BytesIO()
+		for (off, nm) in sec.functionTable:
+			entries.write(struct.pack(">II", off, nameBufferOffset + names.tell()))
+			names.write(nm.encode('sjis') + b'\x00')
+		sec.nbElems = len(sec.functionTable)
+		sec.valueOffset = nameBufferOffset
+		sec.data = entries.getvalue() + names.getvalue()
+
+	def buildHEADSection(self):
+		sec = self.sections["HEAD"]
+		sec.nbElems = len(sec.functionOffsets)
+		sec.data = struct.pack(">{0}I".format(len(sec.functionOffsets)), *sec.functionOffsets)
+
+	def buildCODESection(self):
+		sec = self.sections["CODE"]
+		out = io.BytesIO()
+		for word in sec.instructions:
+			if isinstance(word, Instruction):
+				out.write(struct.pack(">I", word.toRaw()))
+			elif type(word) is float:
+				out.write(struct.pack(">f", word))
+			else:
+				out.write(struct.pack(">I", word & 0xffffffff))
+		sec.nbElems = len(self.sections["HEAD"].functionOffsets)
+		sec.valueOffset = len(sec.instructions)
+		sec.data = out.getvalue()
+
+	def buildVECTSection(self):
+		sec = self.sections.get("VECT")
+		if sec is None: return
+		sec.nbElems = len(sec.vectors)
+		sec.data = sec.vectors.toBytes()
+		sec.vectors.modified = False
+
+	def _usedByVariables(self, varType):
+		# GVAR and ARRY are not rebuilt, the pool entries they may reference cannot be remapped
+		gvar = self.sections.get("GVAR")
+		arry = self.sections.get("ARRY")
+		variables = (gvar.globalVars if gvar is not None else []) + [elem for ar in (arry.arrays if arry is not None else []) for elem in ar]
+		return any(var.varType == varType for var in variables)
+
+	def _remapLdimm(self, ldimmType, remap):
+		for instr in self.sections["CODE"].instructions:
+			if isinstance(instr, Instruction) and instr.opcode == 2 and instr.subOpcode == ldimmType:
+				newParameter = remap(instr.parameter)
+				if newParameter != instr.parameter: instr.parameter = newParameter
+
+	def dedupVECTSection(self):
+		"""Merges the identical vectors of VECT, remapping the 'ldimm vector' instructions. Returns the number of vectors removed"""
+		sec = self.sections.get("VECT")
+		if sec is None or self._usedByVariables(4): return 0
+		unique = dict()
+		remap = []
+		pool = VectorPool()
+		for v in sec.vectors:
+			key = struct.pack(">3f", *v) # bitwise identity
+			if key not in unique: unique[key] = pool.append(v)
+			remap.append(unique[key])
+		nbRemoved = len(sec.vectors) - len(pool)
+		if nbRemoved == 0: return 0
+
+		sec.vectors = pool
+		self.buildVECTSection()
+		self._remapLdimm(4, lambda index: remap[index] if 0 <= index < len(remap) else index)
+		return nbRemoved
+
+	def dedupSTRGSection(self):
+		"""
+		Merges the identical strings of STRG, remapping the 'ldimm str' instructions (string offsets).
+		Returns the number of strings removed
+		"""
+		sec = self.sections.get("STRG")
+		if sec is None or self._usedByVariables(3): return 0
+		starts = []
+		newStarts = []
+		unique = dict()
+		data = io.BytesIO()
+		offset = 0
+		for s in sec.data.rstrip(b'\x00').split(b'\x00'):
+			if s not in unique:
+				unique[s] = data.tell()
+				data.write(s + b'\x00')
+			starts.append(offset)
+			newStarts.append(unique[s])
+			offset += len(s) + 1
+		end = offset
+		nbRemoved = len(starts) - len(unique)
+		if nbRemoved == 0: return 0
+
+		def remap(offset):
+			if not 0 <= offset < end: return offset
+			i = bisect.bisect_right(starts, offset) - 1
+			return newStarts[i] + offset - starts[i]
+
+		self._remapLdimm(3, remap)
+		sec.nbElems = len(unique)
+		sec.data = data.getvalue()
+		sec.stringContents = sec.data.decode('sjis', 'replace')
+		self.invalidateRenderCache()
+		return nbRemoved
+
+	def dedupPools(self):
+		"""Merges the identical strings (STRG) and vectors (VECT). Returns (number of strings removed, number of vectors removed)"""
+		return (self.dedupSTRGSection(), self.dedupVECTSection())
+
+	def toBytes(self, dedupPools = False):
+		"""
+		Assembles the script, rebuilding FTBL, HEAD, CODE (and VECT if modified) from their parsed contents.
+		If dedupPools is True, identical strings and vectors are merged first (see dedupPools)
+		"""
+		if dedupPools: self.dedupPools()
+		vect = self.sections.get("VECT")
+		if vect is not None and vect.vectors.modified: self.buildVECTSection()
+		self.buildFTBLSection()
+		self.buildHEADSection()
+		self.buildCODESection()
+		body = b''.join(sec.toBytes() for sec in self.sections.values())
+		hdr = bytearray(self.header)
+		self.totalSize = len(hdr) + len(body)
+		struct.pack_into(">I", hdr, 4, self.totalSize)
+		return bytes(hdr) + body
+
+	#---------------------Editing---------------------
+
+	def getFixupIndex(self):
+		"""
+		Returns the position-fixup index of CODE: a dict mapping each call/jump destination to
+		the set of instructions referencing it. It is built on first use, then kept up-to-date by
+		the editing methods and the Instruction setters.
+		"""
+		code = self.sections["CODE"]
+		if code.fixups is None:
+			with self._lazyLock, tracePhase("labels"): # label discovery, see getLabel
+				if code.fixups is None:
+					fixups = dict()
+					fixupTargets = dict()
+					for instr in code.instructions:
+						if isinstance(instr, Instruction) and instr.opcode in (7, 10, 11, 12):
+							dest = instr.instructionID
+							fixups.setdefault(dest, set()).add(instr)
+							fixupTargets[instr] = dest
+					code.fixupTargets = fixupTargets
+					code.fixups = fixups # published last, for the concurrent readers
+		return code.fixups
+
+	def instructionChanged(self, instr):
+		"""Called by the Instruction setters"""
+		self.analysisChanged()
+		self.updateFixup(instr)
+
+	def updateFixup(self, instr):
+		code = self.sections["CODE"]
+		if code.fixups is None: return
+		old = code.fixupTargets.pop(instr, None)
+		if old is not None:
+			code.fixups[old].discard(instr)
+			if not code.fixups[old]: del code.fixups[old]
+
+		pos = instr.position
+		if instr.opcode in (7, 10, 11, 12) and pos < len(code.instructions) and code.instructions[pos] is instr:
+			dest = instr.instructionID
+			code.fixups.setdefault(dest, set()).add(instr)
+			code.fixupTargets[instr] = dest
+
+	def functionExtent(self, index):
+		"""Returns (start, end) of the code of the function #index (in HEAD), end being exclusive"""
+		code = self.sections["CODE"]
+		offsets = self.sections["HEAD"].functionOffsets
+		start = offsets[index]
+		return (start, min([off for off in offsets if off > start] + [len(code.instructions)]))
+
+	def spliceInstructions(self, position, count, words):
+		"""
+		Replaces the count words of CODE starting at position by words (a list of Instructions and immediate values,
+		laid out like CODE.instructions), relocating everything that follows.
+
+		Destinations strictly inside the replaced range cannot be referenced by instructions outside of it.
+		Destinations at position keep on pointing to position if count > 0 (i.e they point to the new code),
+		and are relocated if count == 0 (i.e they keep on pointing to the old code).
+		New call/jump instructions must use destinations relative to the new layout.
+		"""
+		self.applySplices([(position, count, words)])
+
+	def applySplices(self, splices):
+		"""
+		Applies several splices (list of (position, count, words), see spliceInstructions) at once: CODE is rebuilt and
+		relocated a single time. The ranges they replace must not overlap; positions refer to the current layout,
+		and the destinations of new call/jump instructions to the new one. Nothing is modified if an error is raised
+		"""
+		code = self.sections["CODE"]
+		head = self.sections["HEAD"]
+		ftbl = self.sections.get("FTBL")
+		instrs = code.instructions
+		splices = sorted(splices, key = lambda splice: (splice[0], splice[1]))
+
+		starts = []
+		shifts = [] # total delta of the splices preceding (and including) each splice
+		shift = 0
+		previousEnd = 0
+		for (position, count, words) in splices:
+			end = position + count
+			if count < 0 or position < 0 or end > len(instrs):
+				raise ValueError("Out-of-range position!")
+			if position < previousEnd:
+				raise ValueError("Overlapping edits at {0}".format(hex(position)))
+			for p in (position, end):
+				if p < len(instrs) and not isinstance(instrs[p], Instruction):
+					raise ValueError("{0} is not an instruction boundary".format(hex(p)))
+			shift += len(words) - count
+			starts.append(position)
+			shifts.append(shift)
+			previousEnd = end
+		newSize = len(instrs) + shift
+
+		def relocate(off):
+			i = bisect.bisect_right(starts, off) - 1
+			if i < 0: return off
+			position, count, words = splices[i]
+			before = shifts[i] - len(words) + count
+			if off == position and count > 0: return off + before
+			if off < position + count: raise ValueError("Offset {0} is inside the edited range".format(hex(off)))
+			return off + shifts[i]
+
+		removed = set()
+		for (position, count, words) in splices:
+			removed.update(instr for instr in instrs[position:position+count] if isinstance(instr, Instruction))
+		fixups = self.getFixupIndex()
+		relocations = []
+		for dest, refs in fixups.items():
+			refs = [instr for instr in refs if instr not in removed]
+			if not refs: continue
+			newDest = relocate(dest)
+			if newDest != dest: relocations += [(instr, newDest) for instr in refs]
+			if newDest >= newSize and dest < len(instrs): raise ValueError("Offset {0} would be out of range".format(hex(dest)))
+
+		functionOffsets = [relocate(off) for off in head.functionOffsets]
+		entryPoint = relocate(head.valueOffset)
+		functionTable = [] if ftbl is None else [(relocate(off), nm) for (off, nm) in ftbl.functionTable]
+
+		#-------------- No error can happen past this point --------------
+
+		self.analysisChanged()
+
+		for instr in removed:
+			instr.ctx = None
+			old = code.fixupTargets.pop(instr, None)
+			if old is not None:
+				fixups[old].discard(instr)
+				if not fixups[old]: del fixups[old]
+
+		# Labels: generated labels are relocated along with the fixup index, only the named ones need to be moved
+		labels = dict()
+		for (pos, lbl) in code.labels.items():
+			try:
+				labels[relocate(pos)] = lbl
+			except ValueError:
+				pass # removed
+		code.labels = labels
+
+		parts = []
+		added = []
+		previousEnd = 0
+		for (position, count, words) in splices:
+			parts.append(instrs[previousEnd:position])
+			added += [instr for instr in words if isinstance(instr, Instruction)]
+			parts.append(words)
+			previousEnd = position + count
+		parts.append(instrs[previousEnd:])
+		instrs[:] = [word for part in parts for word in part]
+
+		added = set(added)
+		for (q, instr) in enumerate(instrs):
+			if not isinstance(instr, Instruction): continue
+			if instr in added:
+				instr.ctx = self
+				instr.position = q
+			elif instr.position != q:
+				instr.nextPosition += q - instr.position
+				instr.position = q
+
+		head.functionOffsets = functionOffsets
+		head.valueOffset = entryPoint
+		if ftbl is not None: ftbl.functionTable = functionTable
+
+		for (instr, dest) in relocations:
+			instr.instructionID = dest
+		for instr in added:
+			instr.check()
+			self.updateFixup(instr)
+
+	def insertInstructions(self, position, words):
+		self.spliceInstructions(position, 0, words)
+
+	def deleteInstructions(self, position, count):
+		self.spliceInstructions(position, count, [])
+
+	def replaceInstruction(self, position, words):
+		"""
+		Replaces the instruction at position (and its immediate word, if any) by words.
+		For example, this can be used to change the type of 'ldimm'.
+		"""
+		instr = self.sections["CODE"].instructions[position]
+		if not isinstance(instr, Instruction):
+			raise ValueError("{0} is not an instruction boundary".format(hex(position)))
+		self.spliceInstructions(position, instr.nextPosition - position, words)
+
+	def insertFunction(self, words, name = None, position = None):
+		"""
+		Inserts a new function at position (the end of CODE by default), which must be a function boundary.
+		It is appended to HEAD (and to FTBL, if present), so that the IDs of the other functions are preserved.
+		Returns its index.
+		"""
+		code = self.sections["CODE"]
+		head = self.sections["HEAD"]
+		ftbl = self.sections.get("FTBL")
+		if position is None: position = len(code.instructions)
+		if position != len(code.instructions) and position not in head.functionOffsets:
+			raise ValueError("{0} is not a function boundary".format(hex(position)))
+
+		self.spliceInstructions(position, 0, words)
+		head.functionOffsets.append(position)
+		self.analysisChanged()
+		if name is not None: code.labels[position] = name
+		if ftbl is not None:
+			ftbl.functionTable.append((position, self.getLabel(position)))
+		return len(head.functionOffsets) - 1
+
+	def deleteFunction(self, index):
+		"""
+		Deletes the function #index. The IDs of the functions following it are decremented.
+		The function must not be called (or jumped to) from outside of it: the references have to be removed first
+		"""
+		head = self.sections["HEAD"]
+		ftbl = self.sections.get("FTBL")
+		code = self.sections["CODE"]
+		start, end = self.functionExtent(index)
+		if start == head.valueOffset:
+			raise ValueError("Cannot delete the entry point")
+		refs = sorted(instr.position for instr in self.getFixupIndex().get(start, ()) if not start <= instr.position < end)
+		if refs:
+			raise ValueError("{0} is still referenced at {1}".format(self.getLabel(start), ", ".join(hex(pos) for pos in refs)))
+
+		oldOffsets, oldTable = head.functionOffsets, None if ftbl is None else ftbl.functionTable
+		oldLabel = code.labels.get(start)
+		head.functionOffsets = oldOffsets[:index] + oldOffsets[index+1:]
+		if ftbl is not None: ftbl.functionTable = [(off, nm) for (off, nm) in oldTable if off != start]
+		code.labels.pop(start, None)
+		try:
+			self.spliceInstructions(start, end - start, [])
+		except ValueError:
+			head.functionOffsets = oldOffsets
+			if ftbl is not None: ftbl.functionTable = oldTable
+			if oldLabel is not None: code.labels[start] = oldLabel
+			raise
+
+	def replaceFunction(self, index, words):
+		start, end = self.functionExtent(index)
+		self.spliceInstructions(start, end - start, words)
+
+	#-------------------------------------------------
+
+	def __init__(self, src, displayOffsets = False, hardened = False, sidecar = None):
+		self.hardened = hardened
+		self.load(src, sidecar)
 		self.displayOffsets = displayOffsets
-	
-	def __str__(self):
-		out = io.StringIO()
 
+	@classmethod
+	def fromRawSections(cls, src, hardened = False):
+		"""
+		Returns a ScriptCtx whose sections are loaded but not decoded (see loadHeaders), for tools which only need
+		the raw section data (e.g. decodeCodeColumns). Most methods cannot be used on it
+		"""
+		ctx = cls.__new__(cls)
+		ctx.hardened = hardened
+		ctx.displayOffsets = False
+		ctx.loadHeaders(src)
+		return ctx
+	
+	@traced("render", lambda ctx: _nbItems(ctx, "CODE", "instructions"))
+	def writeListing(self, out):
+		"""Writes the disassembly listing to the text stream out"""
 		ftbl = self.sections.get("FTBL")
 		code = self.sections["CODE"]
 		head = self.sections["HEAD"]
@@ -163,33 +847,33 @@ class ScriptCtx(object):
 		if ftbl is not None:
 			out.write('.section "FTBL":\n')
 			for (off, nm) in ftbl.functionTable:
-				out.write('\t.function {0}, "{1}"\n'.format(code.labels[off], nm))
+				out.write('\t.function {0}, "{1}"\n'.format(self.getLabel(off), nm))
 			out.write('\n')
 
 
 		out.write('.section "HEAD":\n')
-		out.write('\t.set __ENTRY_POINT__, {0}\n'.format(code.labels[head.valueOffset]))
+		out.write('\t.set __ENTRY_POINT__, {0}\n'.format(self.getLabel(head.valueOffset)))
 		for off in head.functionOffsets:
-			if not code.labels[off]: code.labels[off] = 'sub_{0}'.format(hex(off))
-			out.write('\t.function {0}\n'.format(code.labels[off]))
+			out.write('\t.function {0}\n'.format(self.getLabel(off)))
 		out.write('\n')
 
+		functionNames = set() if ftbl is None else set(nm for (off, nm) in ftbl.functionTable)
 		out.write('.section "CODE":\n')
 		for instr in code.instructions:
 			if not isinstance(instr, Instruction): continue
 			
+			label = self.getLabel(instr.position)
 			separator_printed = False
-			if (ftbl is not None and code.labels[instr.position] in [nm for (off, nm) in ftbl.functionTable])\
-			or code.labels[instr.position][:4] == 'sub_':
+			if label in functionNames or label[:4] == 'sub_':
 				 out.write('\n\n;=============================SUBROUTINE==============================\n')
 				 separator_printed = True
 
-			elif code.labels[instr.position][:4] == 'loc_':
+			elif label[:4] == 'loc_':
 				out.write(';---------------------------------------------------------------------\n')
 				separator_printed = True
 
-			if code.labels[instr.position]:
-				out.write('{0}:\n'.format(code.labels[instr.position]))
+			if label:
+				out.write('{0}:\n'.format(label))
 
 			if instr.opcode == 16 and not separator_printed:
 				out.write('\n')
@@ -212,8 +896,8 @@ class ScriptCtx(object):
 		
 		if vect is not None:
 			out.write('.section "VECT":\n')
-			for v in vect.vectors:
-				out.write('\t.vector <{0}, {1}, {2}>\n'.format(*v))
+			for i in range(len(vect.vectors)):
+				out.write('\t.vector {0}\n'.format(vect.vectors.text(i)))
 			out.write('\n')
 
 		if giri is not None:
@@ -235,6 +919,8 @@ class ScriptCtx(object):
 				out.write('\t.array [{0}]\n'.format(', '.join(str(elem) for elem in ar)))
 			out.write('\n')
 
-
+	def __str__(self):
+		out = io.StringIO()
+		self.writeListing(out)
 		return out.getvalue()
 		
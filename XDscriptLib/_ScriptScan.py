@@ -0,0 +1,81 @@
+﻿# See LICENSE for license
+
+import collections
+import concurrent.futures
+import csv
+import json
+import mmap
+import os
+import struct
+import warnings
+from XDscriptLib import ScriptSection, ScriptFormatError, parseFunctionTable
+
+ScriptInfo = collections.namedtuple("ScriptInfo", "fileName totalSize sections functionNames")
+SectionInfo = collections.namedtuple("SectionInfo", "name totalSize nbElems")
+
+sectionNames = ("FTBL", "HEAD", "CODE", "STRG", "VECT", "GIRI", "GVAR", "ARRY")
+
+def scanScript(fname):
+	"""
+	Fast scan of a script file: only the TCOD header, the section headers and the FTBL section are read
+	(the file is memory-mapped). Returns a ScriptInfo. Raises ScriptFormatError if the file is too small to hold the TCOD header
+	"""
+	with open(fname, "rb") as f:
+		if os.fstat(f.fileno()).st_size < 0x10: raise ScriptFormatError("Truncated script header")
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as src:
+			if src[:4] != b'TCOD': warnings.warn("Apparently not a XD script file! ({0})".format(fname))
+			totalSize = struct.unpack_from(">I", src, 4)[0]
+			end = min(totalSize, len(src))
+
+			sections = []
+			functionNames = []
+			offset = 0x10
+			while offset + 0x20 <= end:
+				sec = ScriptSection(src[offset:offset+0x20])
+				if sec.totalSize < 0x20:
+					warnings.warn("Invalid section size encountered ({0} at offset {1})".format(sec.totalSize, hex(offset)))
+					break
+				sections.append(SectionInfo(sec.name, sec.totalSize, sec.nbElems))
+				if sec.name == "FTBL":
+					sec = ScriptSection(src[offset:offset+sec.totalSize])
+					functionNames = [nm for (off, nm) in parseFunctionTable(sec)]
+				offset += sec.totalSize
+
+	return ScriptInfo(fname, totalSize, sections, functionNames)
+
+def _scanFile(fname):
+	try:
+		return (scanScript(fname), None)
+	except (OSError, ValueError) as e: # ScriptFormatError
+		return (None, str(e))
+
+def scanScripts(fnames, maxWorkers = None):
+	"""
+	Scans fnames in parallel (the work is I/O-bound), see scanScript. Returns the list of ScriptInfo, in order.
+	Files that cannot be scanned are skipped with a warning
+	"""
+	ret = []
+	with concurrent.futures.ThreadPoolExecutor(maxWorkers) as executor:
+		for (fname, (info, error)) in zip(fnames, executor.map(_scanFile, fnames)):
+			if error is not None: warnings.warn("{0}: {1}".format(fname, error))
+			else: ret.append(info)
+	return ret
+
+def writeInventoryCSV(infos, out):
+	"""One row per script; the size and number of elements of each standard section get their own columns"""
+	writer = csv.writer(out)
+	writer.writerow(["file", "totalSize"] + [col.format(nm) for nm in sectionNames for col in ("{0}.size", "{0}.nbElems")] + ["functions"])
+	for info in infos:
+		secs = { sec.name: sec for sec in info.sections }
+		row = [info.fileName, info.totalSize]
+		for nm in sectionNames:
+			row += [secs[nm].totalSize, secs[nm].nbElems] if nm in secs else ["", ""]
+		writer.writerow(row + [';'.join(info.functionNames)])
+
+def writeInventoryJSON(infos, out):
+	json.dump([{
+		"file": info.fileName,
+		"totalSize": info.totalSize,
+		"sections": [sec._asdict() for sec in info.sections],
+		"functions": info.functionNames
+	} for info in infos], out, indent = '\t', ensure_ascii = False)
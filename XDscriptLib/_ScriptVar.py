@@ -58,7 +58,7 @@ class ScriptVar(object):
 		elif self.varType == 2:
 			return "{0:.7g}".format(self.value)
 		else:
-			return "{0}(*{1})".format(wellDefinedTypes.get(self._arType, str(self.varType)), hex(self.value))
+			return "{0}(*{1})".format(wellDefinedTypes.get(self.varType, str(self.varType)), hex(self.value))
 
 	def __init__(self, src):
 		self.varType = struct.unpack_from(">h", src)[0]
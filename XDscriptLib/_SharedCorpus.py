@@ -0,0 +1,229 @@
+﻿# See LICENSE for license
+
+import collections
+import json
+import struct
+from array import array
+from multiprocessing import shared_memory
+from XDscriptLib import ScriptCtx, CodeColumns, decodeCodeColumns
+from XDscriptLib._ScriptCtx import _decodeString
+from XDscriptLib._Bulk import mapChunks, mapFiles
+
+SharedSection = collections.namedtuple("SharedSection", "name fileOffset totalSize nbElems valueOffset")
+
+_header = struct.Struct("=4sII")
+_corpusVersion = 1
+
+# block name -> memoryview format
+_blockFormats = {"src": 'B', "positions": 'I', "opcodes": 'B', "subOpcodes": 'B', "parameters": 'h',
+				 "immediateWords": 'I', "immediateTypes": 'B', "functionOffsets": 'I'}
+
+def _dataOffset(indexSize):
+	ret = _header.size + indexSize
+	return ret + (-ret % 8)
+
+class _Immediates(object):
+	"""Sequence of the immediate values of 'ldimm' (see CodeColumns), decoded on access from the shared raw words"""
+	__slots__ = ("words", "types")
+
+	def __init__(self, words, types):
+		self.words = words
+		self.types = types # ldimm type + 1 (0: no immediate)
+
+	def __len__(self):
+		return len(self.types)
+
+	def __getitem__(self, i):
+		t = self.types[i] - 1
+		if t < 0: return None
+		word = self.words[i]
+		if t == 1: return word - 0x100000000 if word & 0x80000000 else word
+		if t == 2: return struct.unpack("=f", struct.pack("=I", word))[0]
+		return word
+
+	def __iter__(self):
+		for i in range(len(self.types)):
+			yield self[i]
+
+class SharedScript(object):
+	"""
+	A script of a SharedCorpus. Its buffers are read-only views of the shared memory segment (no copy):
+		src: the contents of the script file
+		sections: dict mapping section names to SharedSection(name, fileOffset, totalSize, nbElems, valueOffset)
+		functionOffsets: the function offsets listed in HEAD
+		columns: the CodeColumns of CODE (see decodeCodeColumns; immediates are decoded on access)
+		strings: the data of STRG (Shift-JIS strings, see getString), or None
+	The views are released when the corpus is closed.
+	"""
+
+	def __init__(self, fileName, sections, views):
+		self.fileName = fileName
+		self.sections = sections
+		self.src = views["src"]
+		self.functionOffsets = views["functionOffsets"]
+		self.columns = CodeColumns(views["positions"], views["opcodes"], views["subOpcodes"], views["parameters"],
+								   _Immediates(views["immediateWords"], views["immediateTypes"]))
+		strg = sections.get("STRG")
+		self.strings = self.src[strg.fileOffset+0x20:strg.fileOffset+strg.totalSize] if strg is not None else None
+
+	def getString(self, offset):
+		return _decodeString(bytes(self.strings), offset)
+
+	def ctx(self, hardened = False):
+		"""Returns a fully decoded ScriptCtx of the script (this copies and decodes it)"""
+		return ScriptCtx(bytes(self.src), hardened = hardened)
+
+#---------------------Decoding---------------------
+
+def _decodeScript(src):
+	"""Returns (sections, blocks) of the script contents src, blocks mapping block names to their bytes"""
+	ctx = ScriptCtx.fromRawSections(src)
+	ctx.parseHEADSection()
+	cols = decodeCodeColumns(ctx.sections["CODE"])
+	immediateWords = array('I', (0 if value is None else struct.unpack("=I", struct.pack("=f", value))[0] if isinstance(value, float)
+								 else value & 0xffffffff for value in cols.immediates))
+	types = bytes(0 if value is None else subOpcode + 1 if subOpcode < 3 else 4
+				  for (value, subOpcode) in zip(cols.immediates, cols.subOpcodes))
+	sections = [(sec.name, sec.fileOffset, sec.totalSize, sec.nbElems, sec.valueOffset) for sec in ctx.sections.values()]
+	blocks = {"src": src, "positions": cols.positions.tobytes(), "opcodes": cols.opcodes.tobytes(),
+			  "subOpcodes": cols.subOpcodes.tobytes(), "parameters": cols.parameters.tobytes(),
+			  "immediateWords": immediateWords.tobytes(), "immediateTypes": types,
+			  "functionOffsets": array('I', ctx.sections["HEAD"].functionOffsets).tobytes()}
+	return sections, blocks
+
+def _decodeFile(fname, src):
+	return _decodeScript(src)
+
+#---------------------Corpus---------------------
+
+class SharedCorpus(object):
+	"""
+	A set of scripts decoded once into a single shared memory segment (multiprocessing.shared_memory), which worker
+	processes attach to by name without copying nor decoding anything (see SharedScript):
+
+		with SharedCorpus.create(fnames) as corpus:
+			results = corpus.map(countCalls)  # countCalls(script) is called in worker processes
+
+	Layout (native byte order): header { char magic[4] = "SCRP"; u32 version; u32 indexSize; }, then the index
+	(utf-8 JSON: for each script, its file name, section table and block table {name: [offset, size]}),
+	then the blocks (8-byte aligned, offsets relative to the end of the index, aligned), listed in _blockFormats.
+
+	The process which created the corpus owns the segment: leaving the with block (or close() then unlink())
+	frees it. Views obtained from the scripts must not be used after close().
+	"""
+
+	def __init__(self, shm, owner):
+		self._shm = shm
+		self._owner = owner
+		self._views = []
+		self.scripts = []
+		buf = shm.buf
+		magic, version, indexSize = _header.unpack_from(buf)
+		if magic != b'SCRP' or version != _corpusVersion: raise ValueError("Not a script corpus")
+		base = _dataOffset(indexSize)
+		for entry in json.loads(bytes(buf[_header.size:_header.size+indexSize]).decode('utf-8')):
+			views = dict()
+			for (name, (offset, size)) in entry["blocks"].items():
+				view = buf[base+offset:base+offset+size].toreadonly()
+				self._views.append(view)
+				views[name] = view if _blockFormats[name] == 'B' else view.cast(_blockFormats[name])
+				if views[name] is not view: self._views.append(views[name])
+			sections = collections.OrderedDict((sec[0], SharedSection(*sec)) for sec in entry["sections"])
+			self.scripts.append(SharedScript(entry["file"], sections, views))
+			if self.scripts[-1].strings is not None: self._views.append(self.scripts[-1].strings)
+
+	@property
+	def name(self):
+		"""Name of the shared memory segment, see attach"""
+		return self._shm.name
+
+	@classmethod
+	def create(cls, fnames, maxWorkers = None, chunkSize = 16):
+		"""
+		Decodes the script files fnames (in worker processes, chunkSize files per task) into a new shared memory segment.
+		Files that cannot be loaded are skipped with a warning
+		"""
+		# ScriptFormatError, missing HEAD or CODE
+		results = mapFiles(_decodeFile, fnames, maxWorkers, chunkSize, errors = (OSError, ValueError, KeyError, struct.error))
+
+		index = []
+		data = []
+		offset = 0
+		for (fname, (sections, blocks)) in results:
+			table = dict()
+			for (name, block) in blocks.items():
+				table[name] = [offset, len(block)]
+				data.append((offset, block))
+				offset += len(block) + (-len(block) % 8)
+			index.append({"file": fname, "sections": sections, "blocks": table})
+
+		indexData = json.dumps(index, ensure_ascii = False).encode('utf-8')
+		base = _dataOffset(len(indexData))
+		shm = shared_memory.SharedMemory(create = True, size = max(1, base + offset))
+		try:
+			_header.pack_into(shm.buf, 0, b'SCRP', _corpusVersion, len(indexData))
+			shm.buf[_header.size:_header.size+len(indexData)] = indexData
+			for (off, block) in data:
+				shm.buf[base+off:base+off+len(block)] = block
+			return cls(shm, True)
+		except:
+			shm.close()
+			shm.unlink()
+			raise
+
+	@classmethod
+	def attach(cls, name):
+		"""Attaches to the corpus created (by another process) as name"""
+		try:
+			shm = shared_memory.SharedMemory(name, track = False)
+		except TypeError: # Python < 3.13
+			shm = shared_memory.SharedMemory(name)
+		return cls(shm, False)
+
+	def __len__(self):
+		return len(self.scripts)
+
+	def __getitem__(self, i):
+		return self.scripts[i]
+
+	def __iter__(self):
+		return iter(self.scripts)
+
+	def close(self):
+		"""Releases the views of the scripts and detaches from the segment"""
+		for view in reversed(self._views): view.release()
+		self._views = []
+		self.scripts = []
+		self._shm.close()
+
+	def unlink(self):
+		"""Frees the segment (owner only), once every process has closed it"""
+		self._shm.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		if self._owner: self.unlink()
+
+	def map(self, func, maxWorkers = None, chunkSize = 16):
+		"""
+		Returns [func(script) for script in self], computed by worker processes which attach to the corpus once
+		(chunkSize scripts per task). func must be picklable (i.e a module-level function), as well as its results
+		"""
+		if maxWorkers == 1 or len(self) <= chunkSize:
+			return [func(script) for script in self.scripts]
+		ret = []
+		for partial in mapChunks(_mapChunk, range(len(self)), maxWorkers, chunkSize, (func,), _attachWorker, (self.name,)):
+			ret += partial
+		return ret
+
+_workerCorpus = None # corpus attached by the worker processes of SharedCorpus.map
+
+def _attachWorker(name):
+	global _workerCorpus
+	_workerCorpus = SharedCorpus.attach(name)
+
+def _mapChunk(func, indices):
+	return [func(_workerCorpus[i]) for i in indices]
@@ -0,0 +1,211 @@
+﻿# See LICENSE for license
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import warnings
+from array import array
+from XDscriptLib import Instruction, ScriptCtx, ScriptFormatError, codeWordCount
+
+sidecarVersion = 1
+_header = struct.Struct("<4sHHQ20sI")
+_blockEntry = struct.Struct("<4sII")
+
+def sidecarPath(fname):
+	return os.path.splitext(fname)[0] + '.scdx'
+
+def _column(typecode, values):
+	ret = array(typecode, values)
+	if sys.byteorder != 'little': ret.byteswap()
+	return ret.tobytes()
+
+def _view(buf, typecode):
+	# zero-copy on little-endian hosts
+	if sys.byteorder == 'little': return buf.cast(typecode)
+	ret = array(typecode, bytes(buf))
+	ret.byteswap()
+	return memoryview(ret)
+
+def buildSidecar(ctx, src, decodeWarnings = ()):
+	"""Returns the contents of the sidecar file of ctx, which has just been loaded from src"""
+	code = ctx.sections["CODE"]
+	strg = ctx.sections.get("STRG")
+	instrs = [instr for instr in code.instructions if isinstance(instr, Instruction)]
+
+	xrefs = []
+	for (dest, refs) in sorted(ctx.getFixupIndex().items()):
+		xrefs += [dest, len(refs)] + sorted(instr.position for instr in refs)
+	labels = b''.join(struct.pack("<II", pos, len(nm.encode('utf-8'))) + nm.encode('utf-8') for (pos, nm) in sorted(code.labels.items()))
+
+	blocks = [
+		(b'POSN', _column('I', [instr.position for instr in instrs])),
+		(b'NEXT', _column('I', [instr.nextPosition for instr in instrs])),
+		(b'OPCD', bytes(instr.opcode for instr in instrs)),
+		(b'SUBO', bytes(instr.subOpcode for instr in instrs)),
+		(b'PARM', _column('h', [instr.parameter for instr in instrs])),
+		(b'XREF', _column('I', xrefs)),
+		(b'LABL', labels),
+		(b'WARN', '\x00'.join(decodeWarnings).encode('utf-8')),
+	]
+	if strg is not None: blocks.append((b'STRG', strg.stringContents.encode('utf-8')))
+
+	header = _header.pack(b'SCDX', sidecarVersion, 0, len(src), hashlib.sha1(src).digest(), len(blocks))
+	offset = len(header) + _blockEntry.size * len(blocks)
+	directory = []
+	body = []
+	for (tag, data) in blocks:
+		padding = -offset % 4
+		directory.append(_blockEntry.pack(tag, offset + padding, len(data)))
+		body += [b'\x00' * padding, data]
+		offset += padding + len(data)
+	return b''.join([header] + directory + body)
+
+class Sidecar(object):
+	"""
+	Sidecar file (.scdx): pre-decoded CODE and STRG sections of a script, stored next to it.
+	
+	Layout (little-endian):
+		0x00: char magic[4] = "SCDX"
+		0x04: u16 version
+		0x06: u16 padding
+		0x08: u64 size of the script
+		0x10: u8 sha1[20] of the script
+		0x24: u32 nbBlocks
+		0x28: block directory: nbBlocks * { char tag[4]; u32 offset; u32 size; }
+		blocks (4-byte aligned):
+			POSN, NEXT: u32 position and next position of each instruction
+			OPCD, SUBO: u8 opcode and sub-opcode of each instruction
+			PARM: s16 parameter of each instruction
+			XREF: u32 position-fixup index: { destination, n, positions[n] }*
+			LABL: named labels: { u32 position; u32 size; utf-8 name[size] }*
+			STRG: utf-8 decoded contents of STRG (absent if there is no STRG section)
+			WARN: '\\0'-separated utf-8 warnings emitted when the script was decoded
+	
+	A sidecar is fresh if its version is sidecarVersion, and its size and SHA-1 match the script.
+	buf may be memory-mapped; release() must then be called before unmapping it.
+	"""
+
+	def __init__(self, buf):
+		self._buf = memoryview(buf)
+		self._blocks = dict()
+		try:
+			self._load()
+		except:
+			self.release()
+			raise
+
+	def _load(self):
+		buf = self._buf
+		magic, self.version, _, self.sourceSize, self.sourceDigest, nbBlocks = _header.unpack_from(buf)
+		if magic != b'SCDX': raise ValueError("Not a sidecar file")
+		for i in range(nbBlocks):
+			tag, offset, size = _blockEntry.unpack_from(buf, _header.size + i*_blockEntry.size)
+			if offset + size > len(buf): raise ValueError("Truncated sidecar file")
+			self._blocks[tag] = buf[offset:offset+size]
+
+		self.stringContents = bytes(self._blocks[b'STRG']).decode('utf-8') if b'STRG' in self._blocks else None
+		self.warnings = [w for w in bytes(self._blocks[b'WARN']).decode('utf-8').split('\x00') if w]
+		self.labels = dict()
+		labels = self._blocks[b'LABL']
+		pos = 0
+		while pos < len(labels):
+			off, size = struct.unpack_from("<II", labels, pos)
+			self.labels[off] = bytes(labels[pos+8:pos+8+size]).decode('utf-8')
+			pos += 8 + size
+
+	def release(self):
+		for view in self._blocks.values(): view.release()
+		self._blocks.clear()
+		self._buf.release()
+
+	def isFreshFor(self, src):
+		return self.version == sidecarVersion and self.sourceSize == len(src) and self.sourceDigest == hashlib.sha1(src).digest()
+
+	def restoreCODESection(self, ctx):
+		sec = ctx.sections["CODE"]
+		nbWords = codeWordCount(sec)
+		words = list(struct.unpack_from(">{0}I".format(nbWords), sec.data))
+		ints = struct.unpack_from(">{0}i".format(nbWords), sec.data)
+		floats = struct.unpack_from(">{0}f".format(nbWords), sec.data)
+		with _view(self._blocks[b'POSN'], 'I') as positions, _view(self._blocks[b'NEXT'], 'I') as nextPositions,\
+		_view(self._blocks[b'PARM'], 'h') as parameters, _view(self._blocks[b'XREF'], 'I') as xrefs:
+			opcodes = self._blocks[b'OPCD']
+			subOpcodes = self._blocks[b'SUBO']
+			if not len(positions) == len(nextPositions) == len(opcodes) == len(subOpcodes) == len(parameters) or\
+			(len(positions) > 0 and nextPositions[-1] > nbWords):
+				raise ValueError("Inconsistent sidecar file")
+
+			fromDecoded = Instruction.fromDecoded
+			for (pos, nextPos, opcode, subOpcode, parameter) in zip(positions.tolist(), nextPositions.tolist(), opcodes.tolist(),
+																	subOpcodes.tolist(), parameters.tolist()):
+				words[pos] = fromDecoded(ctx, pos, nextPos, opcode, subOpcode, parameter)
+				if nextPos == pos + 2:  # ldimm immediate, see Instruction.check
+					if subOpcode == 1: words[pos+1] = ints[pos+1]
+					elif subOpcode == 2: words[pos+1] = floats[pos+1]
+
+			fixups = dict()
+			fixupTargets = dict()
+			xrefs = xrefs.tolist()
+			i = 0
+			while i < len(xrefs):
+				dest, n = xrefs[i], xrefs[i+1]
+				refs = set(words[pos] for pos in xrefs[i+2:i+2+n])
+				fixups[dest] = refs
+				for instr in refs: fixupTargets[instr] = dest
+				i += 2 + n
+
+		sec.instructions = words
+		sec.labels = dict()
+		sec.fixups = fixups
+		sec.fixupTargets = fixupTargets
+
+def _writeSidecar(fname, data):
+	tmp = fname + '.tmp'
+	try:
+		with open(tmp, "wb") as f:
+			f.write(data)
+		os.replace(tmp, fname)
+	except OSError as e:
+		warnings.warn("cannot write the sidecar file {0} ({1})".format(fname, e))
+
+def loadScript(fname, displayOffsets = False, hardened = False, useSidecar = True, writeSidecar = True):
+	"""
+	Returns the ScriptCtx of the script file fname. If useSidecar is True, it is loaded from its sidecar file
+	when the latter is present and fresh; otherwise, the script is fully decoded, and its sidecar is (re)written
+	if writeSidecar is True. The warnings emitted while decoding the script are stored in the sidecar, and re-emitted
+	"""
+	with open(fname, "rb") as f:
+		src = f.read()
+	scdx = sidecarPath(fname)
+
+	if useSidecar and os.path.exists(scdx):
+		ctx = None
+		try:
+			with open(scdx, "rb") as f:
+				with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buf:
+					sidecar = Sidecar(buf)
+					try:
+						if sidecar.isFreshFor(src):
+							with warnings.catch_warnings():
+								warnings.simplefilter("ignore")
+								ctx = ScriptCtx(src, displayOffsets, hardened, sidecar)
+					finally:
+						sidecar.release()
+		except ScriptFormatError:
+			raise
+		except (ValueError, KeyError, IndexError, struct.error, OSError) as e:
+			warnings.warn("ignoring the invalid sidecar file {0} ({1})".format(scdx, e))
+		if ctx is not None:
+			for msg in sidecar.warnings: warnings.warn(msg)
+			return ctx
+
+	with warnings.catch_warnings(record = True) as caught:
+		warnings.simplefilter("always")
+		ctx = ScriptCtx(src, displayOffsets, hardened)
+	decodeWarnings = [str(w.message) for w in caught]
+	for msg in decodeWarnings: warnings.warn(msg)
+	if writeSidecar:
+		_writeSidecar(scdx, buildSidecar(ctx, src, decodeWarnings))
+	return ctx
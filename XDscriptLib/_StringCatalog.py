@@ -0,0 +1,245 @@
+﻿# See LICENSE for license
+
+import bisect
+import collections
+import csv
+import json
+import os
+import struct
+from XDscriptLib import ScriptCtx, decodeCodeColumns
+from XDscriptLib._Bulk import mapFiles
+
+stringEncoding = 'sjis' # as in ScriptCtx.parseSTRGSection
+
+def _strgStrings(sec):
+	"""Returns the list of (offset, raw bytes) of the strings of a STRG section"""
+	ret = []
+	offset = 0
+	for s in sec.data.rstrip(b'\x00').split(b'\x00'):
+		ret.append((offset, s))
+		offset += len(s) + 1
+	return ret if ret != [(0, b'')] else []
+
+def _stringReferences(ctx):
+	"""Returns the list of (CODE position, string offset) of the 'ldimm str' instructions"""
+	cols = decodeCodeColumns(ctx.sections["CODE"])
+	return [(pos, param & 0xffff) for (pos, opcode, subOpcode, param) in zip(cols.positions, cols.opcodes, cols.subOpcodes, cols.parameters)
+			if opcode == 2 and subOpcode == 3]
+
+def _decode(s):
+	return s.decode(stringEncoding, 'replace')
+
+def extractStrings(src):
+	"""
+	Returns the list of (offset, text) of the strings of the script contents src: every string of STRG, and the
+	string suffixes referenced by 'ldimm str' instructions (offsets in the middle of a string), sorted by offset
+	"""
+	ctx = ScriptCtx.fromRawSections(src)
+	strg = ctx.sections.get("STRG")
+	if strg is None: return []
+	strings = _strgStrings(strg)
+	ret = dict((offset, _decode(s)) for (offset, s) in strings)
+	starts = [offset for (offset, _) in strings]
+	end = starts[-1] + len(strings[-1][1]) + 1 if strings else 0
+	for (_, offset) in _stringReferences(ctx):
+		if offset in ret or not 0 <= offset < end: continue
+		i = bisect.bisect_right(starts, offset) - 1
+		ret[offset] = _decode(strings[i][1][offset - starts[i]:])
+	return sorted(ret.items())
+
+def injectStrings(src, translations):
+	"""
+	Replaces the strings of the script contents src by their translation (translations: dict mapping texts to
+	their translation). Only STRG and the operands of the 'ldimm str' instructions referring to moved strings
+	are rewritten; the rest of the file is kept as is.
+
+	If GVAR or ARRY contain string variables (whose offsets cannot be remapped), the original strings are kept
+	in place and the translated ones are appended.
+	Returns (new contents, number of translated strings). Raises ValueError if a translation cannot be encoded
+	"""
+	ctx = ScriptCtx.fromRawSections(src)
+	strg = ctx.sections.get("STRG")
+	if strg is None: return src, 0
+	ctx.parseGVARSection()
+	ctx.parseARRYSection()
+	pinned = ctx._usedByVariables(3)
+
+	def encode(text):
+		try:
+			return text.encode(stringEncoding)
+		except UnicodeEncodeError as e:
+			raise ValueError("cannot encode {0!r} ({1})".format(text, e)) from None
+
+	strings = _strgStrings(strg)
+	starts = [offset for (offset, _) in strings]
+	end = starts[-1] + len(strings[-1][1]) + 1 if strings else 0
+	newStrings = []
+	newOffsets = dict() # raw bytes -> offset, for the appended strings
+	size = 0
+	def append(s):
+		nonlocal size
+		newStrings.append(s)
+		size += len(s) + 1
+		return size - len(s) - 1
+
+	newStarts = []
+	nbTranslated = 0
+	texts = [_decode(s) for (_, s) in strings]
+	translated = [encode(translations[text]) if text in translations else s for (text, (_, s)) in zip(texts, strings)]
+	for ((offset, s), t) in zip(strings, translated):
+		if t != s: nbTranslated += 1
+		newStarts.append(append(s if pinned else t))
+	if pinned:
+		for (i, ((offset, s), t)) in enumerate(zip(strings, translated)):
+			if t == s: continue
+			if t not in newOffsets: newOffsets[t] = append(t)
+			newStarts[i] = newOffsets[t]
+
+	remap = []
+	for (pos, offset) in _stringReferences(ctx):
+		if not 0 <= offset < end: continue
+		i = bisect.bisect_right(starts, offset) - 1
+		delta = offset - starts[i]
+		if delta == 0:
+			newOffset = newStarts[i]
+		else:
+			suffix = strings[i][1][delta:]
+			text = _decode(suffix)
+			t = encode(translations[text]) if text in translations else suffix
+			if t == suffix and translated[i] == strings[i][1]: newOffset = newStarts[i] + delta
+			elif t in newOffsets: newOffset = newOffsets[t]
+			else:
+				# suffixes of translated strings are stored separately
+				newOffset = newOffsets[t] = append(t)
+				if t != suffix: nbTranslated += 1
+		if newOffset != offset: remap.append((pos, newOffset))
+	if nbTranslated == 0 and len(newStrings) == len(strings): return src, 0
+	if size > 0x10000: raise ValueError("STRG is too large ({0} bytes)".format(size))
+
+	out = bytearray(src)
+	code = ctx.sections["CODE"]
+	for (pos, newOffset) in remap:
+		struct.pack_into(">H", out, code.fileOffset + 0x20 + 4*pos + 2, newOffset)
+	oldSize = strg.totalSize
+	strg.data = b''.join(s + b'\x00' for s in newStrings)
+	strg.nbElems = len(newStrings)
+	out[strg.fileOffset:strg.fileOffset+oldSize] = strg.toBytes()
+	struct.pack_into(">I", out, 4, ctx.totalSize + strg.totalSize - oldSize)
+	return bytes(out), nbTranslated
+
+class CatalogEntry(object):
+	__slots__ = ("text", "translation", "occurrences")
+
+	def __init__(self, text, translation = ""):
+		self.text = text
+		self.translation = translation
+		self.occurrences = [] # (file name, offset)
+
+class StringCatalog(object):
+	"""
+	Translation catalog: the strings of a set of scripts, deduplicated across scripts, each with its translation
+	(empty if not translated yet) and its occurrences (file name, STRG offset).
+
+	Stored as JSON ({"strings": [{"text", "translation", "occurrences": [[fname, offset], ...]}, ...]})
+	or CSV (text, translation, occurrences as 'fname:offset' separated by ';'), depending on the extension
+	"""
+
+	def __init__(self):
+		self.entries = collections.OrderedDict() # text -> CatalogEntry
+
+	def __len__(self):
+		return len(self.entries)
+
+	def add(self, text, fname, offset):
+		entry = self.entries.get(text)
+		if entry is None: entry = self.entries[text] = CatalogEntry(text)
+		entry.occurrences.append((fname, offset))
+
+	def translations(self):
+		"""Returns a dict mapping the translated texts to their translation"""
+		return { entry.text: entry.translation for entry in self.entries.values() if entry.translation and entry.translation != entry.text }
+
+	def mergeTranslations(self, other):
+		"""Copies the translations of the entries of other whose text is in this catalog. Returns their number"""
+		nb = 0
+		for entry in other.entries.values():
+			if entry.translation and entry.text in self.entries:
+				self.entries[entry.text].translation = entry.translation
+				nb += 1
+		return nb
+
+	#---------------------Serialization---------------------
+
+	def toJSON(self):
+		return json.dumps({"strings": [{"text": entry.text, "translation": entry.translation,
+										"occurrences": [list(occ) for occ in entry.occurrences]} for entry in self.entries.values()]},
+						  indent = '\t', ensure_ascii = False)
+
+	@classmethod
+	def fromJSON(cls, text):
+		ret = cls()
+		for item in json.loads(text)["strings"]:
+			entry = ret.entries[item["text"]] = CatalogEntry(item["text"], item.get("translation", ""))
+			entry.occurrences = [tuple(occ) for occ in item.get("occurrences", ())]
+		return ret
+
+	def writeCSV(self, out):
+		writer = csv.writer(out)
+		writer.writerow(["text", "translation", "occurrences"])
+		for entry in self.entries.values():
+			writer.writerow([entry.text, entry.translation, ";".join("{0}:{1}".format(fname, hex(offset)) for (fname, offset) in entry.occurrences)])
+
+	@classmethod
+	def readCSV(cls, f):
+		ret = cls()
+		reader = csv.reader(f)
+		next(reader, None)
+		for row in reader:
+			entry = ret.entries[row[0]] = CatalogEntry(row[0], row[1] if len(row) > 1 else "")
+			for occ in (row[2].split(";") if len(row) > 2 and row[2] else ()):
+				fname, _, offset = occ.rpartition(":")
+				entry.occurrences.append((fname, int(offset, 0)))
+		return ret
+
+	def save(self, fname):
+		with open(fname, "w", newline='', encoding='utf-8') as f:
+			if fname.lower().endswith(".csv"): self.writeCSV(f)
+			else: f.write(self.toJSON() + '\n')
+
+	@classmethod
+	def load(cls, fname):
+		with open(fname, "r", newline='', encoding='utf-8') as f:
+			return cls.readCSV(f) if fname.lower().endswith(".csv") else cls.fromJSON(f.read())
+
+#---------------------Bulk processing---------------------
+
+def _extractFile(fname, src):
+	return extractStrings(src)
+
+def extractCatalog(fnames, maxWorkers = None, chunkSize = 16):
+	"""Returns the StringCatalog of the script files fnames, processed by worker processes (chunkSize files per task)"""
+	catalog = StringCatalog()
+	for (fname, strings) in mapFiles(_extractFile, fnames, maxWorkers, chunkSize):
+		for (offset, text) in strings:
+			catalog.add(text, fname, offset)
+	return catalog
+
+def _injectFile(translations, outFnames, fname, src):
+	out, nbTranslated = injectStrings(src, translations)
+	outFname = outFnames[fname]
+	if out is not src or outFname != fname:
+		tmp = outFname + '.tmp'
+		with open(tmp, "wb") as f:
+			f.write(out)
+		os.replace(tmp, outFname)
+	return nbTranslated
+
+def injectCatalog(catalog, fnames, outFnames = None, maxWorkers = None, chunkSize = 16):
+	"""
+	Applies the translations of catalog (a StringCatalog, or a dict mapping texts to translations) to the script files
+	fnames, writing the results to outFnames (default: in place), in worker processes. Files that cannot be processed
+	are skipped with a warning. Returns the list of (fname, number of translated strings)
+	"""
+	translations = catalog.translations() if isinstance(catalog, StringCatalog) else catalog
+	outFnames = dict(zip(fnames, fnames if outFnames is None else outFnames))
+	return list(mapFiles(_injectFile, fnames, maxWorkers, chunkSize, (translations, outFnames)))
@@ -0,0 +1,288 @@
+﻿# See LICENSE for license
+
+import collections
+import json
+import os
+from XDscriptLib import FunctionInfo, Instruction, ScriptCtx, getCallGraph
+from XDscriptLib._Bulk import mapFiles
+from XDscriptLib._Graph import successors, stronglyConnectedComponents
+
+TaskEntry = collections.namedtuple("TaskEntry", "offset name kinds")
+TaskIssue = collections.namedtuple("TaskIssue", "offset name message")
+TaskCost = collections.namedtuple("TaskCost", "offset name frameCost firstFrameCost yields stackUsage yieldFreeLoops")
+
+_inf = float('inf')
+_none = float('-inf') # no such path
+
+taskParameters = 4 # task signature: 4 ints (or a character, see Instruction)
+stackSize = 256 # entries, per task
+taskCreationFunctions = {(39, 16): "sync", (39, 17): "sync", (39, 18): "async", (39, 19): "async"} # Tasks::create*Task*
+
+def _add(a, b):
+	return _none if _none in (a, b) else a + b
+
+def _signed8(value):
+	value &= 0xff
+	return value - 0x100 if value >= 0x80 else value
+
+#---------------------Per-function analysis---------------------
+
+# Summary of a function, in instructions (_none: no such path, _inf: unbounded):
+#	through: longest yield-free path from the entry to a return
+#	prefix: longest path from the entry to the end of a yield
+#	suffix: longest path from a yield to a return
+#	inner: longest path between two yields (including in the callees)
+_Summary = collections.namedtuple("_Summary", "through prefix suffix inner loops")
+_unknownSummary = _Summary(_inf, _inf, _inf, _inf, ())
+
+def _summarize(instrs, start, summaries, loopIterations):
+	"""Computes the _Summary of the function at start, given the summaries of its callees (by offset)"""
+	# Nodes: the instructions reachable from start (calls do not leave the function)
+	succ = dict()
+	work = [start]
+	while work:
+		pos = work.pop()
+		if pos in succ: continue
+		succ[pos] = successors(instrs, instrs[pos])
+		work += succ[pos]
+
+	passW = dict() # weight when going through the node without yielding (_none if impossible)
+	sinkW = dict() # weight when a segment ends at the node (yield)
+	srcW = dict() # weight of a segment starting at the node
+	inner = _none
+	for pos in succ:
+		instr = instrs[pos]
+		opcode = instr.opcode
+		if opcode == 9 and (instr.subOpcode, instr.parameter) in FunctionInfo.yieldingFunctions:
+			passW[pos], sinkW[pos], srcW[pos] = _none, 1, 0
+		elif opcode == 7 and instr.instructionID < len(instrs):  # call
+			callee = summaries.get(instr.instructionID, _unknownSummary)
+			passW[pos], sinkW[pos], srcW[pos] = _add(1, callee.through), _add(1, callee.prefix), callee.suffix
+			inner = max(inner, callee.inner)
+		else:
+			passW[pos], sinkW[pos], srcW[pos] = 1, _none, _none
+
+	# Yield-free loops are the cycles of the pass-through graph
+	edges = dict((pos, succ[pos] if passW[pos] != _none else ()) for pos in succ)
+	sccs = stronglyConnectedComponents(sorted(succ), edges) # successors before predecessors
+
+	component = dict()
+	weights = []
+	loops = []
+	for (i, scc) in enumerate(sccs):
+		for pos in scc: component[pos] = i
+		if len(scc) > 1 or scc[0] in edges[scc[0]]:
+			loops.append(min(scc))
+			weights.append(_inf if loopIterations is None else sum(passW[pos] for pos in scc) * loopIterations)
+		else:
+			weights.append(None)
+
+	# Longest paths, in topological order, from the entry (fromEntry) and from the yields (fromYield)
+	fromEntry = [_none] * len(sccs)
+	fromYield = [_none] * len(sccs)
+	fromEntry[component[start]] = 0
+	for pos in succ:
+		if srcW[pos] != _none:
+			for nxt in succ[pos]:
+				fromYield[component[nxt]] = max(fromYield[component[nxt]], srcW[pos])
+
+	through = prefix = suffix = _none
+	for i in reversed(range(len(sccs))):
+		for (dist, isEntry) in ((fromEntry, True), (fromYield, False)):
+			if dist[i] == _none: continue
+			loopWeight = weights[i]
+			before = dist[i] if loopWeight is None else _add(dist[i], loopWeight) # conservative within loops
+			for pos in sccs[i]:
+				ends = _add(before, sinkW[pos])
+				returns = _add(before, 1) if not succ[pos] else _none
+				if isEntry:
+					prefix = max(prefix, ends)
+					through = max(through, returns)
+				else:
+					inner = max(inner, ends)
+					suffix = max(suffix, returns)
+				after = _add(before, passW[pos]) if loopWeight is None else before
+				for nxt in edges[pos]:
+					j = component[nxt]
+					if j != i: dist[j] = max(dist[j], after)
+
+	return _Summary(through, prefix, suffix, inner, tuple(sorted(loops)))
+
+#---------------------Script analysis---------------------
+
+class TaskAnalysis(object):
+	"""
+	Analysis of the tasks of a script (see the multitasking model in Instruction):
+
+	entries: list of TaskEntry(offset, name, kinds), kinds being a tuple among
+		"callback" (special callback, see FunctionInfo), "sync"/"async" (passed to a task creation function,
+		by ID or by name) and "reference" (function ID loaded for another purpose, e.g. stored to be started later)
+	issues: list of TaskIssue(offset, name, message): entry points whose parameter or stack usage does not match
+		the task signature (4 ints) or their 'reserve'
+	costs: list of TaskCost, one per entry point:
+		frameCost: estimated worst-case number of instructions executed between two consecutive yields
+			(or from the start of the task to its first yield, or from a yield to its end), callees included
+		firstFrameCost: the same, from the start of the task to its first yield or its end
+		yields: whether the task can yield ('pause', 'yield', 'waitUntil', 'Tasks::sleep')
+		stackUsage: estimated worst-case stack usage (parameters and frames, see CallGraph.maxStackUsages)
+		yieldFreeLoops: positions of the loops without yield in the task's code, callees included
+
+	The bodies of yield-free loops are counted loopIterations times (if loopIterations is None, the costs of the tasks
+	containing such loops are None, i.e. unbounded); calls to recursive functions are unbounded.
+	Costs are in instructions and do not include the time spent in standard functions.
+	"""
+
+	def __init__(self, ctx, commonScript = False, loopIterations = 1, fileName = None):
+		self.fileName = fileName
+		self.loopIterations = loopIterations
+		instrs = ctx.sections["CODE"].instructions
+		entries = self._findEntries(ctx, commonScript)
+		self.entries = [TaskEntry(off, ctx.getLabel(off), tuple(sorted(kinds))) for (off, kinds) in sorted(entries.items())]
+
+		graph = getCallGraph(ctx)
+		stackUsages = graph.maxStackUsages()
+		recursive = set(graph.recursiveFunctions())
+		summaries = dict()
+		for scc in graph.stronglyConnectedComponents():
+			for off in scc:
+				summaries[off] = _unknownSummary if off in recursive else _summarize(instrs, off, summaries, loopIterations)
+
+		self.issues = []
+		self.costs = []
+		for entry in self.entries:
+			summary = summaries.get(entry.offset, _unknownSummary)
+			loops = set()
+			work = [entry.offset]
+			seen = set()
+			while work:
+				off = work.pop()
+				if off in seen or off not in graph.calls: continue
+				seen.add(off)
+				loops.update(summaries[off].loops)
+				work += graph.calls[off]
+
+			def cost(value):
+				return None if value == _inf else max(value, 0)
+			stackUsage = stackUsages.get(entry.offset)
+			if stackUsage is not None: stackUsage += taskParameters
+			self.costs.append(TaskCost(entry.offset, entry.name, cost(max(summary[:4])), cost(max(summary.through, summary.prefix)),
+									   summary.prefix != _none, stackUsage, tuple(sorted(loops))))
+			self._checkEntry(instrs, entry, graph, stackUsage)
+
+	def _findEntries(self, ctx, commonScript):
+		head = ctx.sections["HEAD"]
+		ftbl = ctx.sections.get("FTBL")
+		strg = ctx.sections.get("STRG")
+		instrs = ctx.sections["CODE"].instructions
+		functionOffsets = [off for off in head.functionOffsets if 0 <= off < len(instrs)]
+		names = dict((nm, off) for (off, nm) in ftbl.functionTable) if ftbl is not None else dict()
+		entries = collections.defaultdict(set)
+
+		for (nm, off) in names.items():
+			if nm in FunctionInfo.specialCallbacks: entries[off].add("callback")
+		if commonScript:
+			for i in FunctionInfo.commonScriptCallbacks:
+				if i < len(functionOffsets): entries[functionOffsets[i]].add("callback")
+
+		# The function IDs or names are assumed to be passed to the next standard function called (see Workspace.crossReferences)
+		pending = []
+		for instr in instrs:
+			if not isinstance(instr, Instruction): continue
+			opcode = instr.opcode
+			if opcode == 2 and instr.subOpcode == 1 and instr.nextPosition == instr.position + 2:  # ldimm int
+				index = FunctionInfo.getFunctionIndexFromID(instrs[instr.position + 1] & 0xffffffff)
+				if index is not None and index < len(functionOffsets): pending.append((functionOffsets[index], True))
+			elif opcode == 2 and instr.subOpcode == 3 and strg is not None:  # ldimm str
+				off = names.get(strg.getString(instr.parameter & 0xffff))
+				if off is not None: pending.append((off, False))
+			elif opcode in (8, 9, 15):  # return, callstd, exit
+				key = (instr.subOpcode, instr.parameter)
+				kind = taskCreationFunctions.get(key) if opcode == 9 else None
+				for (off, byID) in pending:
+					if kind is not None: entries[off].add(kind)
+					elif byID and key != FunctionInfo.syncTaskFromLibraryScript: entries[off].add("reference")
+				pending = []
+		return entries
+
+	def _checkEntry(self, instrs, entry, graph, stackUsage):
+		def issue(msg):
+			self.issues.append(TaskIssue(entry.offset, entry.name, msg))
+
+		reserved = graph.frameSizes.get(entry.offset, 1) - 1
+		releases = set()
+		maxParam = 0
+		outside = set()
+		work = [entry.offset]
+		seen = set()
+		while work:
+			pos = work.pop()
+			if pos in seen: continue
+			seen.add(pos)
+			instr = instrs[pos]
+			opcode = instr.opcode
+			if opcode in (3, 4, 5, 17) and instr.subOpcode & 0xf == 1:  # $stack[...]
+				index = _signed8(instr.parameter)
+				if index > 0: maxParam = max(maxParam, index)
+				elif index < 0 and -index - 1 >= reserved: outside.add(-index - 1)
+			elif opcode == 14:  # release
+				releases.add(instr.subOpcode)
+			work += successors(instrs, instr)
+
+		if maxParam > taskParameters:
+			issue("uses {0} parameters, but tasks only receive {1}".format(maxParam, taskParameters))
+		for local in sorted(outside):
+			issue("accesses local variable {0} outside its frame (reserve {1})".format(local, reserved))
+		for n in sorted(releases - {reserved}):
+			issue("releases {0} stack entries, but reserves {1}".format(n, reserved))
+		if stackUsage is None:
+			issue("unbounded stack usage (recursion)")
+		elif stackUsage > stackSize:
+			issue("may overflow the task stack ({0} entries, at most {1})".format(stackUsage, stackSize))
+
+	#---------------------Export---------------------
+
+	def maxFrameCost(self):
+		"""Returns the highest frameCost of the entry points (None if unbounded, 0 if there are none)"""
+		costs = [cost.frameCost for cost in self.costs]
+		return None if None in costs else max(costs + [0])
+
+	def toDict(self):
+		kinds = dict((entry.offset, entry.kinds) for entry in self.entries)
+		return {
+			"file": self.fileName,
+			"maxFrameCost": self.maxFrameCost(),
+			"tasks": [dict(cost._asdict(), kinds = list(kinds[cost.offset]), yieldFreeLoops = list(cost.yieldFreeLoops)) for cost in self.costs],
+			"issues": [issue._asdict() for issue in self.issues]
+		}
+
+	def toJSON(self):
+		return json.dumps(self.toDict(), indent = '\t', ensure_ascii = False)
+
+	def rows(self):
+		"""Yields one row per entry point: file, name, offset, kinds, frameCost, firstFrameCost, yields, stackUsage, yieldFreeLoops, issues"""
+		kinds = dict((entry.offset, entry.kinds) for entry in self.entries)
+		for cost in self.costs:
+			issues = [issue.message for issue in self.issues if issue.offset == cost.offset]
+			yield [self.fileName, cost.name, hex(cost.offset), ';'.join(kinds[cost.offset]), cost.frameCost, cost.firstFrameCost,
+				   cost.yields, cost.stackUsage, ';'.join(hex(pos) for pos in cost.yieldFreeLoops), '; '.join(issues)]
+
+taskCSVHeader = ["file", "task", "offset", "kinds", "frameCost", "firstFrameCost", "yields", "stackUsage", "yieldFreeLoops", "issues"]
+
+def analyzeTasks(ctx, commonScript = False, loopIterations = 1):
+	"""Returns the TaskAnalysis of ctx, which is cached with ctx until CODE is modified (for the default loopIterations)"""
+	if loopIterations != 1: return TaskAnalysis(ctx, commonScript, loopIterations)
+	return ctx.cached("tasks.common" if commonScript else "tasks", lambda ctx: TaskAnalysis(ctx, commonScript))
+
+#---------------------Bulk processing---------------------
+
+def _analyzeFile(commonScriptName, loopIterations, fname, src):
+	commonScript = os.path.splitext(os.path.basename(fname))[0] == commonScriptName
+	return TaskAnalysis(ScriptCtx(src), commonScript, loopIterations, fname)
+
+def analyzeTaskFiles(fnames, maxWorkers = None, chunkSize = 16, loopIterations = 1, commonScriptName = "common_script"):
+	"""
+	Yields the TaskAnalysis of each script file of fnames, in order, computed by worker processes (chunkSize files per task).
+	The script named commonScriptName is analyzed as the common script. Files that cannot be loaded are skipped with a warning
+	"""
+	for (fname, analysis) in mapFiles(_analyzeFile, fnames, maxWorkers, chunkSize, (commonScriptName, loopIterations)):
+		yield analysis
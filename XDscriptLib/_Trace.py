@@ -0,0 +1,133 @@
+﻿# See LICENSE for license
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# The tracer the hooks report to (None: tracing disabled). Process-wide, see Tracer
+activeTracer = None
+
+class TraceEvent(object):
+	"""A completed phase: name, start and duration (seconds), item count, net allocated bytes, nesting depth, thread"""
+	__slots__ = ("name", "start", "duration", "items", "allocated", "depth", "threadID")
+
+	def __init__(self, name, start, depth, threadID):
+		self.name = name
+		self.start = start
+		self.duration = 0.0
+		self.items = None
+		self.allocated = None
+		self.depth = depth
+		self.threadID = threadID
+
+class Tracer(object):
+	"""
+	Records the phases of script processing (section splitting, section decoding, label discovery, validation, rendering),
+	with their wall time, item count and, if trackAllocations is True, net allocated memory (tracemalloc).
+
+	Used as a context manager: the hooks report to the innermost active tracer, for every thread.
+	callback(event) is called when a phase ends. When no tracer is active, each hook costs one global lookup.
+
+		with Tracer() as tracer:
+			ctx = ScriptCtx(src)
+			str(ctx)
+		tracer.writeChromeTrace("trace.json") # chrome://tracing, Perfetto
+	"""
+
+	def __init__(self, callback = None, trackAllocations = False):
+		self.callback = callback
+		self.trackAllocations = trackAllocations
+		self.events = []
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		self._origin = time.perf_counter()
+		self._startedTracemalloc = False
+		self._previous = None
+
+	def __enter__(self):
+		global activeTracer
+		if self.trackAllocations and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self._startedTracemalloc = True
+		self._previous = activeTracer
+		activeTracer = self
+		return self
+
+	def __exit__(self, *exc):
+		global activeTracer
+		activeTracer = self._previous
+		if self._startedTracemalloc:
+			tracemalloc.stop()
+			self._startedTracemalloc = False
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Context manager recording the phase name; the yielded TraceEvent's items can be set"""
+		depth = getattr(self._local, "depth", 0)
+		self._local.depth = depth + 1
+		event = TraceEvent(name, time.perf_counter() - self._origin, depth, threading.get_ident())
+		mem = tracemalloc.get_traced_memory()[0] if self.trackAllocations else None
+		try:
+			yield event
+		finally:
+			event.duration = time.perf_counter() - self._origin - event.start
+			if mem is not None: event.allocated = tracemalloc.get_traced_memory()[0] - mem
+			self._local.depth = depth
+			with self._lock:
+				self.events.append(event)
+			if self.callback is not None: self.callback(event)
+
+	#---------------------Export---------------------
+
+	def summary(self):
+		"""Returns a dict mapping each phase name to its totals: {"count", "time", "items", "allocated"}"""
+		ret = dict()
+		for event in self.events:
+			entry = ret.setdefault(event.name, {"count": 0, "time": 0.0, "items": 0, "allocated": 0})
+			entry["count"] += 1
+			entry["time"] += event.duration
+			entry["items"] += event.items or 0
+			entry["allocated"] += event.allocated or 0
+		return ret
+
+	def toChromeTrace(self):
+		"""Returns the events in the Chrome trace-event format (JSON), as complete ('X') events"""
+		pid = os.getpid()
+		events = []
+		for event in sorted(self.events, key = lambda event: event.start):
+			args = dict()
+			if event.items is not None: args["items"] = event.items
+			if event.allocated is not None: args["allocatedBytes"] = event.allocated
+			events.append({"name": event.name, "cat": "XDscript", "ph": "X", "pid": pid, "tid": event.threadID,
+						   "ts": round(event.start * 1e6, 3), "dur": round(event.duration * 1e6, 3), "args": args})
+		return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+	def writeChromeTrace(self, fname):
+		with open(fname, "w") as f:
+			f.write(self.toChromeTrace())
+
+def tracePhase(name):
+	"""Context manager recording the phase name with the active tracer (a null context if there is none)"""
+	tracer = activeTracer
+	return contextlib.nullcontext() if tracer is None else tracer.phase(name)
+
+def traced(name, items = None):
+	"""
+	Method decorator recording each call as the phase name. items(self) is the number of items
+	processed by the phase, evaluated after the call
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self, *args, **kwargs):
+			tracer = activeTracer
+			if tracer is None: return func(self, *args, **kwargs)
+			with tracer.phase(name) as event:
+				ret = func(self, *args, **kwargs)
+				if items is not None: event.items = items(self)
+			return ret
+		return wrapper
+	return decorator
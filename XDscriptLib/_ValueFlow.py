@@ -0,0 +1,381 @@
+﻿# See LICENSE for license
+
+import collections
+import hashlib
+import json
+import threading
+from XDscriptLib import FunctionInfo, ScriptCtx, getCallGraph
+from XDscriptLib._Bulk import mapFiles
+from XDscriptLib._Graph import reachable, successors
+from XDscriptLib._Emulator import operatorImplementations, ScriptRuntimeError
+
+Condition = collections.namedtuple("Condition", "index op value") # $globals[index] <op> value (op: equ, neq, gt, ge, lt, le)
+GlobalWrite = collections.namedtuple("GlobalWrite", "position index value coordinate conditions")
+Gate = collections.namedtuple("Gate", "position condition target")
+FunctionFlow = collections.namedtuple("FunctionFlow", "offset name writes gates reads")
+
+_negated = {"equ": "neq", "neq": "equ", "gt": "le", "le": "gt", "ge": "lt", "lt": "ge"}
+_swapped = {"equ": "equ", "neq": "neq", "gt": "lt", "lt": "gt", "ge": "le", "le": "ge"}
+_symbols = {"equ": "==", "neq": "!=", "gt": ">", "ge": ">=", "lt": "<", "le": "<="}
+_operatorInfo = { entry.index: entry for entry in FunctionInfo.operators if isinstance(entry, FunctionInfo.OperatorInfo) }
+_scalarTypes = (int, float, str)
+maxTrackedStackDepth = 256 # size of the stack of a task
+
+def conditionText(cond):
+	return "$globals[{0}] {1} {2!r}".format(cond.index, _symbols[cond.op], cond.value)
+
+def _conditionKey(cond):
+	return (cond.index, cond.op, repr(cond.value))
+
+#---------------------Abstract values---------------------
+
+# Abstract values: None (unknown), ("c", value) (constant), ("g", index) (unknown value of $globals[index]),
+# ("cmp", index, op, value) (result of the comparison $globals[index] <op> value)
+
+def _truth(value):
+	"""Returns the Condition under which value is true and the one under which it is false (None if unknown)"""
+	if value is None or value[0] == "c": return None, None
+	if value[0] == "g": return Condition(value[1], "neq", 0), Condition(value[1], "equ", 0)
+	_, index, op, v = value
+	return Condition(index, op, v), Condition(index, _negated[op], v)
+
+def _constantTruth(value):
+	"""Returns True/False if value is a known int or float constant, otherwise None"""
+	if value is not None and value[0] == "c" and type(value[1]) in (int, float): return bool(value[1])
+	return None
+
+def _operator(name, operands):
+	if all(value is not None and value[0] == "c" for value in operands):
+		try:
+			return ("c", operatorImplementations[name](*(value[1] for value in operands)))
+		except (ScriptRuntimeError, ArithmeticError, TypeError, ValueError):
+			return None
+	if name == "not" and operands[0] is not None:
+		truth, falsehood = _truth(operands[0])
+		if falsehood is not None: return ("cmp",) + tuple(falsehood)
+	elif name in _negated and len(operands) == 2:
+		a, b = operands
+		if a is not None and b is not None and a[0] == "g" and b[0] == "c" and type(b[1]) in _scalarTypes:
+			return ("cmp", a[1], name, b[1])
+		if a is not None and b is not None and a[0] == "c" and b[0] == "g" and type(a[1]) in _scalarTypes:
+			return ("cmp", b[1], _swapped[name], a[1])
+	return None
+
+def _joinValues(a, b):
+	return a if a == b else None
+
+def _joinStates(a, b):
+	# stacks of different heights join to None (height unknown, nothing tracked), so that loops pushing or popping
+	# values reach the fixpoint
+	stackA, localsA, globalsA, condsA = a
+	stackB, localsB, globalsB, condsB = b
+	if stackA is None or stackB is None or len(stackA) != len(stackB): stack = None
+	else: stack = tuple(_joinValues(x, y) for (x, y) in zip(stackA, stackB))
+	return (stack, localsA & localsB, globalsA & globalsB, condsA & condsB)
+
+def _frozenStack(stack):
+	return None if stack is None or len(stack) > maxTrackedStackDepth else tuple(stack)
+
+#---------------------Per-function analysis---------------------
+
+class _FunctionAnalyzer(object):
+	"""Constant propagation over the stack machine, for a single function (see FunctionFlow)"""
+
+	def __init__(self, ctx, start, positions):
+		self.instrs = ctx.sections["CODE"].instructions
+		self.strg = ctx.sections.get("STRG")
+		self.vect = ctx.sections.get("VECT")
+		self.start = start
+		self.positions = positions
+
+	def immediate(self, instr):
+		t, param = instr.subOpcode, instr.parameter
+		if t in (1, 2) and instr.nextPosition == instr.position + 2: return ("c", self.instrs[instr.position + 1])
+		if t == 3 and self.strg is not None: return ("c", self.strg.getString(param & 0xffff))
+		if t == 4 and self.vect is not None and 0 <= param < len(self.vect.vectors): return ("c", tuple(self.vect.vectors[param]))
+		return None
+
+	def key(self):
+		"""Digest of the function, independent of its position in CODE (immediates and string/vector operands resolved)"""
+		tokens = []
+		for pos in self.positions:
+			instr = self.instrs[pos]
+			param = instr.instructionID - self.start if instr.opcode in (7, 10, 11, 12) else instr.parameter
+			tokens.append((pos - self.start, instr.opcode, instr.subOpcode, param, self.immediate(instr) if instr.opcode == 2 else None))
+		return hashlib.sha1(repr(tokens).encode('utf-8')).digest()
+
+	def step(self, instr, state, record):
+		"""Returns the list of (successor, state) of instr. Writes, gates and reads are passed to record if it is not None"""
+		stack, localVars, globalVars, conds = state
+		stack = None if stack is None else list(stack)
+		opcode, sub = instr.opcode, instr.subOpcode
+
+		def pop(n = 1):
+			if stack is None: return [None] * n
+			return [stack.pop() if stack else None for i in range(n)]
+
+		def push(value):
+			if stack is not None: stack.append(value)
+
+		nexts = successors(self.instrs, instr)
+		if opcode == 1:  # operator
+			info = _operatorInfo.get(sub)
+			if info is None or info.name not in operatorImplementations:
+				push(None)
+			else:
+				operands = pop(info.nbOperands)
+				push(_operator(info.name, list(reversed(operands))))
+		elif opcode == 2:  # ldimm
+			push(self.immediate(instr))
+		elif opcode in (3, 17):  # ldvar, ldncpvar
+			level = sub & 0xf
+			if level == 0:
+				if record is not None: record("read", instr.parameter)
+				push(dict(globalVars).get(instr.parameter, ("g", instr.parameter)))
+			elif level == 1:
+				push(dict(localVars).get(instr.parameter))
+			else:
+				push(None)
+		elif opcode in (4, 5):  # setvar, setvector
+			value = pop()[0]
+			level = sub & 0xf
+			coordinate = sub >> 4 if opcode == 5 else None
+			if level == 0:
+				index = instr.parameter
+				if record is not None: record("write", index, value, coordinate, conds)
+				globalVars = frozenset(item for item in globalVars if item[0] != index)
+				if opcode == 4 and value is not None and value[0] == "c": globalVars |= {(index, value)}
+			elif level == 1:
+				localVars = frozenset(item for item in localVars if item[0] != instr.parameter)
+				if opcode == 4 and value is not None: localVars |= {(instr.parameter, value)}
+		elif opcode == 6:  # pop
+			pop(sub)
+		elif opcode == 7 or (opcode == 9 and (sub, instr.parameter) in FunctionInfo.yieldingFunctions):
+			# the callee, or the other tasks, may modify the globals
+			globalVars = frozenset()
+		elif opcode in (10, 11):  # jmptrue, jmpfalse
+			value = pop()[0]
+			truth, falsehood = _truth(value)
+			known = _constantTruth(value)
+			taken, notTaken = (truth, falsehood) if opcode == 10 else (falsehood, truth)
+			takenKnown = None if known is None else (known if opcode == 10 else not known)
+			ret = []
+			state = (_frozenStack(stack), localVars, globalVars, conds)
+			for (succ, cond, feasible) in ((instr.nextPosition, notTaken, takenKnown is not True), (instr.instructionID, taken, takenKnown is not False)):
+				if succ not in nexts or not feasible: continue
+				if cond is not None and record is not None: record("gate", cond, succ)
+				ret.append((succ, state if cond is None else (state[0], localVars, globalVars, conds | {cond})))
+			return ret
+		state = (_frozenStack(stack), localVars, globalVars, conds)
+		return [(succ, state) for succ in nexts]
+
+	def run(self):
+		"""Returns (writes, gates, reads), positions being relative to the start of the function"""
+		states = { self.start: ((), frozenset(), frozenset(), frozenset()) }
+		work = [self.start]
+		while work:
+			pos = work.pop()
+			for (succ, state) in self.step(self.instrs[pos], states[pos], None):
+				old = states.get(succ)
+				new = state if old is None else _joinStates(old, state)
+				if new != old:
+					states[succ] = new
+					work.append(succ)
+
+		writes, gates, reads = [], [], set()
+		for pos in sorted(states):
+			rel = pos - self.start
+			def record(kind, *args):
+				if kind == "read":
+					reads.add(args[0])
+				elif kind == "write":
+					index, value, coordinate, conds = args
+					value = value[1] if value is not None and value[0] == "c" and type(value[1]) in _scalarTypes else None
+					writes.append(GlobalWrite(rel, index, value, coordinate, tuple(sorted(conds, key = _conditionKey))))
+				else:
+					cond, target = args
+					gates.append(Gate(rel, cond, target - self.start))
+			self.step(self.instrs[pos], states[pos], record)
+		return writes, gates, sorted(reads)
+
+_functionFlows = collections.OrderedDict() # digest -> (writes, gates, reads), relative to the start of the function
+_functionFlowsLock = threading.Lock()
+maxCachedFunctionFlows = 8192
+
+def _rebase(flow, start, name):
+	writes, gates, reads = flow
+	return FunctionFlow(start, name, [write._replace(position = write.position + start) for write in writes],
+						[gate._replace(position = gate.position + start, target = gate.target + start) for gate in gates], reads)
+
+def functionFlow(ctx, start):
+	"""
+	Returns the FunctionFlow of the function at start. Results are cached by contents (positions being relative
+	to the function, moving a function does not invalidate them), keeping the maxCachedFunctionFlows most recently used
+	"""
+	analyzer = _FunctionAnalyzer(ctx, start, reachable(ctx.sections["CODE"].instructions, start))
+	key = analyzer.key()
+	with _functionFlowsLock:
+		flow = _functionFlows.get(key)
+		if flow is not None: _functionFlows.move_to_end(key)
+	if flow is None:
+		flow = analyzer.run()
+		with _functionFlowsLock:
+			_functionFlows[key] = flow
+			while len(_functionFlows) > maxCachedFunctionFlows:
+				_functionFlows.popitem(last = False)
+	return _rebase(flow, start, ctx.getLabel(start))
+
+#---------------------Script analysis---------------------
+
+class ScriptValueFlow(object):
+	"""
+	Value flow of the global variables of a script: constants are propagated through the stack machine
+	(operand stack, local variables, and globals until the next call or yield), within each function.
+
+	functions: list of FunctionFlow(offset, name, writes, gates, reads), one per function (see CallGraph):
+		writes: GlobalWrite(position, index, value, coordinate, conditions) for each 'setvar'/'setvector' to $globals[index];
+			value is the constant written (None if unknown), coordinate the vector coordinate (None for setvar),
+			and conditions the Conditions on globals under which the write is reached (conditions of the enclosing branches)
+		gates: Gate(position, condition, target): the branch at position goes to target only if condition holds
+		reads: the sorted indices of the globals read
+	Branches on constants are resolved: the code they skip is not analyzed.
+	"""
+
+	def __init__(self, ctx = None, fileName = None):
+		self.fileName = fileName
+		self.digest = None # SHA-1 of the script file, see buildFlagMap
+		self.functions = [] if ctx is None else [functionFlow(ctx, off) for off in sorted(getCallGraph(ctx).functions)]
+
+	def toDict(self):
+		return {
+			"file": self.fileName,
+			"sha1": self.digest,
+			"functions": [{
+				"offset": flow.offset, "name": flow.name, "reads": flow.reads,
+				"writes": [[write.position, write.index, write.value, write.coordinate, [list(cond) for cond in write.conditions]] for write in flow.writes],
+				"gates": [[gate.position, list(gate.condition), gate.target] for gate in flow.gates]
+			} for flow in self.functions]
+		}
+
+	@classmethod
+	def fromDict(cls, d):
+		ret = cls(None, d["file"])
+		ret.digest = d.get("sha1")
+		for f in d["functions"]:
+			writes = [GlobalWrite(pos, index, value, coordinate, tuple(Condition(*cond) for cond in conds))
+					  for (pos, index, value, coordinate, conds) in f["writes"]]
+			gates = [Gate(pos, Condition(*cond), target) for (pos, cond, target) in f["gates"]]
+			ret.functions.append(FunctionFlow(f["offset"], f["name"], writes, gates, f["reads"]))
+		return ret
+
+def getValueFlow(ctx):
+	"""Returns the ScriptValueFlow of ctx, which is cached with ctx until CODE is modified (unchanged functions are not reanalyzed)"""
+	return ctx.cached("valueFlow", ScriptValueFlow)
+
+#---------------------Story flag map---------------------
+
+FlagUse = collections.namedtuple("FlagUse", "file function position detail")
+
+class FlagMap(object):
+	"""
+	Story flag dependency map: the value flows of a set of scripts (dict mapping file names to ScriptValueFlow),
+	and, for each global variable, its writes, gates and reads across scripts.
+	A flag B depends on a flag A if B is written under a condition on A.
+	"""
+
+	def __init__(self):
+		self.scripts = collections.OrderedDict()
+
+	def add(self, flow):
+		self.scripts[flow.fileName] = flow
+
+	def writes(self):
+		"""Returns a dict mapping each global index to the list of FlagUse (detail: GlobalWrite)"""
+		ret = collections.defaultdict(list)
+		for flow in self.scripts.values():
+			for f in flow.functions:
+				for write in f.writes: ret[write.index].append(FlagUse(flow.fileName, f.name, write.position, write))
+		return ret
+
+	def gates(self):
+		"""Returns a dict mapping each global index to the list of FlagUse (detail: Gate)"""
+		ret = collections.defaultdict(list)
+		for flow in self.scripts.values():
+			for f in flow.functions:
+				for gate in f.gates: ret[gate.condition.index].append(FlagUse(flow.fileName, f.name, gate.position, gate))
+		return ret
+
+	def readers(self):
+		"""Returns a dict mapping each global index to the sorted list of (file, function) reading it"""
+		ret = collections.defaultdict(set)
+		for flow in self.scripts.values():
+			for f in flow.functions:
+				for index in f.reads: ret[index].add((flow.fileName, f.name))
+		return dict((index, sorted(users)) for (index, users) in ret.items())
+
+	def dependencies(self):
+		"""Returns a dict mapping each global index B to the Counter {A: number of writes to B under a condition on A}"""
+		ret = collections.defaultdict(collections.Counter)
+		for (index, uses) in self.writes().items():
+			for use in uses:
+				for a in set(cond.index for cond in use.detail.conditions):
+					ret[index][a] += 1
+		return ret
+
+	#---------------------Export---------------------
+
+	def toDict(self):
+		writes, gates, readers, deps = self.writes(), self.gates(), self.readers(), self.dependencies()
+		flags = sorted(set(writes) | set(gates) | set(readers))
+		return {
+			"flags": [{
+				"index": index,
+				"writes": [{"file": use.file, "function": use.function, "position": use.position, "value": use.detail.value,
+							"coordinate": use.detail.coordinate, "conditions": [conditionText(cond) for cond in use.detail.conditions]}
+						   for use in writes.get(index, ())],
+				"gates": [{"file": use.file, "function": use.function, "position": use.position, "target": use.detail.target,
+						   "condition": conditionText(use.detail.condition)} for use in gates.get(index, ())],
+				"readers": [{"file": fname, "function": name} for (fname, name) in readers.get(index, ())],
+				"dependsOn": sorted(deps.get(index, ()))
+			} for index in flags],
+			"scripts": [flow.toDict() for flow in self.scripts.values()]
+		}
+
+	def toJSON(self):
+		return json.dumps(self.toDict(), indent = '\t', ensure_ascii = False)
+
+	@classmethod
+	def fromJSON(cls, text):
+		ret = cls()
+		for d in json.loads(text)["scripts"]:
+			ret.add(ScriptValueFlow.fromDict(d))
+		return ret
+
+	def toDOT(self):
+		"""Graph of the dependencies between flags (A -> B: B is written under a condition on A)"""
+		lines = ['digraph flags {']
+		for (b, counter) in sorted(self.dependencies().items()):
+			for (a, n) in sorted(counter.items()):
+				lines.append('\t"$globals[{0}]" -> "$globals[{1}]" [label="{2}"];'.format(a, b, n))
+		lines.append('}')
+		return '\n'.join(lines) + '\n'
+
+def _analyzeFile(digests, fname, src):
+	digest = hashlib.sha1(src).hexdigest()
+	if digests.get(fname) == digest: return None
+	flow = getValueFlow(ScriptCtx(src))
+	flow.fileName = fname
+	flow.digest = digest
+	return flow
+
+def buildFlagMap(fnames, previous = None, maxWorkers = None, chunkSize = 16):
+	"""
+	Returns the FlagMap of the script files fnames, analyzed by worker processes (chunkSize files per task).
+	The results of previous (a FlagMap) are reused for the files which have not changed since (same SHA-1).
+	Files that cannot be loaded are skipped with a warning
+	"""
+	digests = dict() if previous is None else dict((fname, flow.digest) for (fname, flow) in previous.scripts.items())
+	ret = FlagMap()
+	for (fname, flow) in mapFiles(_analyzeFile, fnames, maxWorkers, chunkSize, (digests,)):
+		ret.add(previous.scripts[fname] if flow is None else flow)
+	return ret
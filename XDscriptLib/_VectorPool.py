@@ -0,0 +1,71 @@
+﻿# See LICENSE for license
+
+import sys
+from array import array
+
+class VectorPool(object):
+	"""
+	Vector constants (VECT section), stored as a packed float32 array (3 floats per vector).
+	On big-endian hosts, the array is a zero-copy view over the section data; otherwise it is
+	converted once (bulk byteswap). The text of each vector is formatted on first use, and cached.
+
+	Behaves like a sequence of (x, y, z) tuples.
+	"""
+
+	def __init__(self, data = b'', nbVectors = None):
+		nbVectors = len(data) // 12 if nbVectors is None else max(0, min(nbVectors, len(data) // 12))
+		if sys.byteorder == 'big':
+			self._floats = memoryview(data)[:12*nbVectors].cast('f')
+		else:
+			self._floats = array('f', bytes(data[:12*nbVectors]))
+			self._floats.byteswap()
+		self._texts = [None]*nbVectors
+		self.modified = False
+
+	def _mutable(self):
+		if isinstance(self._floats, memoryview):
+			self._floats = array('f', self._floats)
+
+	def __len__(self):
+		return len(self._texts)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0: index += len(self)
+		if not 0 <= index < len(self): raise IndexError("vector index out of range")
+		return tuple(self._floats[3*index:3*index+3])
+
+	def __setitem__(self, index, vector):
+		self._mutable()
+		if index < 0: index += len(self)
+		if not 0 <= index < len(self): raise IndexError("vector index out of range")
+		self._floats[3*index:3*index+3] = array('f', vector)
+		self._texts[index] = None
+		self.modified = True
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def append(self, vector):
+		"""Appends vector; returns its index"""
+		self._mutable()
+		self._floats.extend(array('f', vector))
+		self._texts.append(None)
+		self.modified = True
+		return len(self) - 1
+
+	def text(self, index):
+		"""Returns the text of the vector #index: '<x, y, z>'"""
+		ret = self._texts[index]
+		if ret is None:
+			ret = self._texts[index] = "<{0}, {1}, {2}>".format(*self[index])
+		return ret
+
+	def toBytes(self):
+		if sys.byteorder == 'big':
+			return bytes(self._floats)
+		ret = array('f', self._floats)
+		ret.byteswap()
+		return ret.tobytes()
@@ -0,0 +1,66 @@
+﻿# See LICENSE for license
+
+import hashlib
+import os
+import time
+import warnings
+from XDscriptLib import ScriptCache
+
+class ScriptWatcher(object):
+	"""
+	Polls a set of script files, and calls onChange(fname, ctx) for every new or modified one.
+
+	listFiles is a callable returning the current list of files (called on each poll, so that new files are picked up).
+	Files are only read when their mtime or size changes, and only re-parsed when their contents do; parsed
+	scripts are kept in cache (a ScriptCache, keyed by contents), so reverting a file is free.
+	"""
+
+	def __init__(self, listFiles, onChange, cache = None, interval = 0.5):
+		self.listFiles = listFiles
+		self.onChange = onChange
+		self.cache = ScriptCache() if cache is None else cache
+		self.interval = interval
+		self._stats = dict()
+		self._digests = dict()
+
+	def poll(self):
+		"""Checks the files once. Returns the list of the files for which onChange has been called"""
+		changed = []
+		fnames = self.listFiles()
+		for fname in set(self._stats) - set(fnames):
+			del self._stats[fname]
+			self._digests.pop(fname, None)
+
+		for fname in fnames:
+			try:
+				st = os.stat(fname)
+				if self._stats.get(fname) == (st.st_mtime_ns, st.st_size): continue
+				with open(fname, "rb") as f:
+					src = f.read()
+			except OSError as e: # e.g. the file is being replaced by an editor
+				warnings.warn("{0}: {1}".format(fname, e))
+				continue
+			self._stats[fname] = (st.st_mtime_ns, st.st_size)
+
+			digest = hashlib.sha1(src).digest()
+			if self._digests.get(fname) == digest: continue
+			self._digests[fname] = digest
+			try:
+				ctx = self.cache.getFromBytes(src)
+			except ValueError as e: # ScriptFormatError
+				warnings.warn("{0}: {1}".format(fname, e))
+				continue
+			self.onChange(fname, ctx)
+			changed.append(fname)
+		return changed
+
+	def run(self, callback = None):
+		"""Polls the files until interrupted (KeyboardInterrupt). callback(changed) is called after each poll"""
+		try:
+			while True:
+				start = time.monotonic()
+				changed = self.poll()
+				if callback is not None: callback(changed)
+				time.sleep(max(0, self.interval - (time.monotonic() - start)))
+		except KeyboardInterrupt:
+			pass
@@ -0,0 +1,130 @@
+﻿# See LICENSE for license
+
+import collections
+import hashlib
+import os
+from XDscriptLib import FunctionInfo, Instruction, ScriptCtx
+
+FunctionRef = collections.namedtuple("FunctionRef", "scriptName index name")
+CrossReference = collections.namedtuple("CrossReference", "scriptName position functionID target")
+
+class Workspace(object):
+	"""
+	A set of scripts (typically, the common script and every map script of a game dump) analyzed together.
+
+	Function IDs (see FunctionInfo) are resolved across scripts: IDs passed to syncTaskFromLibraryScript,
+	and common script IDs, refer to the common script (the script named commonScriptName); other IDs refer
+	to the script they appear in.
+
+	Memory scales with unique content rather than with the number of files: identical files share the same
+	ScriptCtx, and the section data, function names, labels and strings of every script go through a
+	single interning pool. The operator and standard function tables (FunctionInfo) are module-level,
+	hence shared by construction.
+	"""
+
+	def __init__(self, commonScriptName = "common_script", hardened = False):
+		self.commonScriptName = commonScriptName
+		self.hardened = hardened
+		self.scripts = collections.OrderedDict()
+		self._byHash = dict()
+		self._pool = dict()
+
+	def intern(self, obj):
+		"""Returns the pooled object equal to obj (obj must be hashable)"""
+		return self._pool.setdefault(obj, obj)
+
+	def _internCtx(self, ctx):
+		for sec in ctx.sections.values():
+			sec.data = self.intern(sec.data)
+			sec.header = self.intern(sec.header)
+		code = ctx.sections["CODE"]
+		code.labels = dict((pos, self.intern(lbl)) for (pos, lbl) in code.labels.items())
+		ftbl = ctx.sections.get("FTBL")
+		if ftbl is not None:
+			ftbl.functionTable = [(off, self.intern(nm)) for (off, nm) in ftbl.functionTable]
+		strg = ctx.sections.get("STRG")
+		if strg is not None:
+			strg.stringContents = self.intern(strg.stringContents)
+		giri = ctx.sections.get("GIRI")
+		if giri is not None:
+			giri.characters = [self.intern(character) for character in giri.characters]
+
+	def addFromBytes(self, name, src):
+		"""Adds the script src under the name name; returns its ScriptCtx"""
+		key = hashlib.sha1(src).digest()
+		ctx = self._byHash.get(key)
+		if ctx is None:
+			ctx = ScriptCtx(src, hardened = self.hardened)
+			self._internCtx(ctx)
+			self._byHash[key] = ctx
+		self.scripts[name] = ctx
+		return ctx
+
+	def add(self, fname):
+		"""Adds the script file fname, under its base name without extension; returns its ScriptCtx"""
+		with open(fname, "rb") as f:
+			return self.addFromBytes(os.path.splitext(os.path.basename(fname))[0], f.read())
+
+	@property
+	def commonScript(self):
+		return self.scripts.get(self.commonScriptName)
+
+	@property
+	def nbUniqueScripts(self):
+		return len(self._byHash)
+
+	#-------------------------------------------------
+
+	def functionRef(self, scriptName, index):
+		"""Returns the FunctionRef of the function #index (in HEAD) of scriptName, or None"""
+		ctx = self.scripts.get(scriptName)
+		if ctx is None: return None
+		head = ctx.sections["HEAD"]
+		if not 0 <= index < len(head.functionOffsets): return None
+		off = head.functionOffsets[index]
+		return FunctionRef(scriptName, index, ctx.getLabel(off))
+
+	def resolveFunctionID(self, scriptName, functionID, library = False):
+		"""
+		Returns the FunctionRef of the function referred to by functionID, used in scriptName, or None.
+		library must be True if functionID is passed to syncTaskFromLibraryScript
+		"""
+		index = FunctionInfo.getCommonScriptFunctionIndexFromID(functionID)
+		if index is not None:
+			return self.functionRef(self.commonScriptName, index)
+		index = FunctionInfo.getFunctionIndexFromID(functionID)
+		if index is not None:
+			return self.functionRef(self.commonScriptName if library else scriptName, index)
+		return None
+
+	def crossReferences(self, scriptName):
+		"""
+		Returns the list of CrossReference of scriptName: every 'ldimm int' of a function ID, and the function
+		it resolves to (target, None if unresolved). An ID is considered to be passed to syncTaskFromLibraryScript
+		if it is the next standard function called.
+		"""
+		ctx = self.scripts[scriptName]
+		instrs = ctx.sections["CODE"].instructions
+		ret = []
+		pending = []
+		for instr in instrs:
+			if not isinstance(instr, Instruction): continue
+			if instr.opcode == 2 and instr.subOpcode == 1 and instr.nextPosition == instr.position + 2:  # ldimm int, with its immediate
+				functionID = instrs[instr.position + 1] & 0xffffffff
+				if FunctionInfo.getFunctionIndexFromID(functionID) is not None or\
+				FunctionInfo.getCommonScriptFunctionIndexFromID(functionID) is not None:
+					pending.append((instr.position, functionID))
+			elif instr.opcode == 9 or instr.opcode in (8, 15):  # callstd, return, exit
+				library = instr.opcode == 9 and (instr.subOpcode, instr.parameter) == FunctionInfo.syncTaskFromLibraryScript
+				ret += [CrossReference(scriptName, pos, functionID, self.resolveFunctionID(scriptName, functionID, library))
+						for (pos, functionID) in pending]
+				pending = []
+		ret += [CrossReference(scriptName, pos, functionID, self.resolveFunctionID(scriptName, functionID)) for (pos, functionID) in pending]
+		return ret
+
+	def allCrossReferences(self):
+		"""Returns the cross references of every script, see crossReferences"""
+		ret = []
+		for name in self.scripts:
+			ret += self.crossReferences(name)
+		return ret
@@ -1,5 +1,27 @@
 ﻿# See LICENSE for license
 
+from XDscriptLib._Trace import Tracer, TraceEvent, tracePhase, traced
 from XDscriptLib._Instruction import Instruction
 from XDscriptLib._ScriptVar import ScriptVar, parseScriptArray
-from XDscriptLib._ScriptCtx import ScriptCtx, ScriptSection
+from XDscriptLib._VectorPool import VectorPool
+from XDscriptLib._ScriptCtx import ScriptCtx, ScriptSection, ScriptFormatError, parseFunctionTable, codeWordCount, CodeColumns, decodeCodeColumns, instructionColumns
+from XDscriptLib._Sidecar import Sidecar, buildSidecar, loadScript, sidecarPath
+from XDscriptLib._ScriptCache import ScriptCache, CacheStats
+from XDscriptLib._DeadCode import DeadCodeInfo, findReachable, findDeadCode, stripDeadCode
+from XDscriptLib._Peephole import OptimizationReport, PeepholeOptimizer, optimizeScript
+from XDscriptLib._ScriptScan import ScriptInfo, SectionInfo, scanScript, scanScripts, writeInventoryCSV, writeInventoryJSON
+from XDscriptLib._CallGraph import CallGraph, getCallGraph
+from XDscriptLib._Workspace import Workspace, FunctionRef, CrossReference
+from XDscriptLib._Output import ListingFormatter, HTMLFormatter, JSONFormatter, OutputBackend, DirectoryBackend, StreamBackend, ZipBackend, SQLiteBackend, openBackend, outputNames, listScriptFiles
+from XDscriptLib._Watch import ScriptWatcher
+from XDscriptLib._AnalysisDB import AnalysisDB, extractRows
+from XDscriptLib._OpcodeStats import OpcodeStats, collectStats
+from XDscriptLib._Pattern import Pattern, PatternMatch
+from XDscriptLib._Emulator import ScriptEmulator, CompiledScript, Handle, ScriptRuntimeError, StepLimitExceeded, compileScript
+from XDscriptLib._StringCatalog import StringCatalog, CatalogEntry, extractStrings, injectStrings, extractCatalog, injectCatalog
+from XDscriptLib._Tasks import TaskAnalysis, TaskEntry, TaskIssue, TaskCost, analyzeTasks, analyzeTaskFiles, taskCSVHeader
+from XDscriptLib._SharedCorpus import SharedCorpus, SharedScript, SharedSection
+from XDscriptLib._ValueFlow import ScriptValueFlow, FunctionFlow, GlobalWrite, Gate, Condition, FlagMap, FlagUse, functionFlow, getValueFlow, buildFlagMap, conditionText
+from XDscriptLib._ExecutionTrace import TraceRecorder, ExecutionTrace, TraceStep, TraceStdCall, TraceCall, TraceReturn, TraceAbort, TraceInvocation, TraceDivergence, replayTrace
+from XDscriptLib._FunctionHash import FunctionIndex, FunctionFingerprint, SimilarFunction, NameSuggestion, normalizedTokens, shingles, minHash, estimatedSimilarity, fingerprintFunction, fingerprintScript, buildFunctionIndex
+from XDscriptLib._Bulk import mapChunks, mapFiles
@@ -0,0 +1,26 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Builds an inventory of XD script files, reading only their section headers")
+	parser.add_argument("files", help="XD script files (or directories containing .scd files) to scan", nargs='+', type=str)
+	parser.add_argument("--format", help="Output format", choices=("csv", "json"), default="csv")
+	parser.add_argument("-o", "--output", help="Output file (default: stdout)", type=str)
+	parser.add_argument("-j", "--jobs", help="Number of worker threads", type=int)
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+
+	infos = scanScripts(fnames, args.jobs)
+	out = open(args.output, "w", newline='', encoding='utf-8') if args.output else sys.stdout
+	try:
+		(writeInventoryCSV if args.format == "csv" else writeInventoryJSON)(infos, out)
+	finally:
+		if out is not sys.stdout: out.close()
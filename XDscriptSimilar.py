@@ -0,0 +1,55 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import csv
+import json
+import sys
+import os
+
+
+def functionDict(f):
+	return {"file": f.file, "offset": f.offset, "name": f.name, "size": f.size, "digest": f.digest}
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Finds the identical and similar functions of XD script files (normalized hashes, MinHash/LSH), and infers the names of unnamed functions")
+	parser.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='+', type=str)
+	parser.add_argument("--mode", help="clusters: groups of similar functions; duplicates: groups of identical functions; names: names inferred from the common script (CSV)",
+						choices=("clusters", "duplicates", "names"), default="clusters")
+	parser.add_argument("-t", "--threshold", help="Minimum estimated similarity (0-1)", type=float, default=0.8)
+	parser.add_argument("--min-size", help="Minimum function size (normalized instructions)", type=int, default=6)
+	parser.add_argument("-i", "--index", help="Index file (JSON): the scripts that have not changed since are not analyzed again, and the index is updated", type=str)
+	parser.add_argument("-o", "--output", help="Output file (default: stdout)", type=str)
+	parser.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	parser.add_argument("--common-script", help="Name of the common script (source of the inferred names)", type=str, default="common_script")
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+
+	previous = None
+	if args.index and os.path.exists(args.index):
+		with open(args.index, "r", encoding='utf-8') as f:
+			previous = FunctionIndex.fromJSON(f.read())
+
+	index = buildFunctionIndex(fnames, previous, args.jobs)
+	if args.index:
+		with open(args.index, "w", encoding='utf-8') as f:
+			f.write(index.toJSON() + '\n')
+
+	out = open(args.output, "w", newline='', encoding='utf-8') if args.output else sys.stdout
+	try:
+		if args.mode == "names":
+			sources = [fname for fname in index.digests if os.path.splitext(os.path.basename(fname))[0] == args.common_script]
+			writer = csv.writer(out)
+			writer.writerow(["file", "offset", "function", "inferred name", "similarity", "source"])
+			for suggestion in index.inferNames(sources, args.threshold, args.min_size):
+				writer.writerow([suggestion.function.file, hex(suggestion.function.offset), suggestion.function.name, suggestion.name,
+								 "{0:.2f}".format(suggestion.similarity), suggestion.source.file])
+		else:
+			groups = index.duplicates(args.min_size) if args.mode == "duplicates" else index.clusters(args.threshold, args.min_size)
+			out.write(json.dumps([[functionDict(f) for f in group] for group in groups], indent = '\t', ensure_ascii = False) + '\n')
+	finally:
+		if out is not sys.stdout: out.close()
@@ -0,0 +1,27 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Computes opcode, ldimm type, operator, standard function and variable level usage statistics over XD script files")
+	parser.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='+', type=str)
+	parser.add_argument("--format", help="Output format", choices=("csv", "json"), default="json")
+	parser.add_argument("-o", "--output", help="Output file (default: stdout)", type=str)
+	parser.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+
+	stats = collectStats(fnames, args.jobs)
+	out = open(args.output, "w", newline='', encoding='utf-8') if args.output else sys.stdout
+	try:
+		if args.format == "csv": stats.writeCSV(out)
+		else: out.write(stats.toJSON() + '\n')
+	finally:
+		if out is not sys.stdout: out.close()
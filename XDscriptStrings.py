@@ -0,0 +1,48 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Extracts the strings of XD script files to a translation catalog, and injects the translated strings back")
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.required = True
+
+	extract = subparsers.add_parser("extract", help="Extracts the strings (deduplicated across files) to a catalog")
+	extract.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='+', type=str)
+	extract.add_argument("-o", "--output", help="Catalog file (.json or .csv)", type=str, required=True)
+	extract.add_argument("-m", "--merge", help="Existing catalog whose translations are kept", type=str)
+	extract.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+
+	inject = subparsers.add_parser("inject", help="Replaces the strings of the files by their translation")
+	inject.add_argument("catalog", help="Catalog file (.json or .csv)", type=str)
+	inject.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='+', type=str)
+	group = inject.add_mutually_exclusive_group(required=True)
+	group.add_argument("-o", "--output", help="Output directory", type=str)
+	group.add_argument("--in-place", help="Modify the files in place", action="store_true")
+	inject.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+	if args.command == "extract":
+		catalog = extractCatalog(fnames, args.jobs)
+		if args.merge:
+			nb = catalog.mergeTranslations(StringCatalog.load(args.merge))
+			print("{0} translations kept".format(nb), file=sys.stderr)
+		catalog.save(args.output)
+		print("{0} strings ({1} files)".format(len(catalog), len(fnames)), file=sys.stderr)
+	else:
+		catalog = StringCatalog.load(args.catalog)
+		outFnames = None
+		if args.output:
+			outFnames = [os.path.join(args.output, name + ".scd") for name in outputNames(fnames)]
+			for fname in outFnames:
+				os.makedirs(os.path.dirname(fname) or ".", exist_ok=True)
+		results = injectCatalog(catalog, fnames, outFnames, args.jobs)
+		print("{0} strings translated ({1} files)".format(sum(nb for (_, nb) in results), len(results)), file=sys.stderr)
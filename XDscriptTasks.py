@@ -0,0 +1,43 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import csv
+import json
+import sys
+
+
+def costKey(cost):
+	# unbounded costs first
+	return float('inf') if cost is None else cost
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Finds the task entry points of XD script files, checks their signatures, and estimates their worst-case number of instructions per frame")
+	parser.add_argument("files", help="XD script files (or directories containing .scd files)", nargs='+', type=str)
+	parser.add_argument("--format", help="Output format", choices=("csv", "json"), default="csv")
+	parser.add_argument("-o", "--output", help="Output file (default: stdout)", type=str)
+	parser.add_argument("-j", "--jobs", help="Number of worker processes", type=int)
+	parser.add_argument("-l", "--loop-iterations", help="Number of times the yield-free loops are counted (0: unbounded)", type=int, default=1)
+	parser.add_argument("--common-script", help="Name of the common script", type=str, default="common_script")
+	args = parser.parse_args()
+
+	fnames = listScriptFiles(args.files)
+
+	analyses = list(analyzeTaskFiles(fnames, args.jobs, loopIterations = args.loop_iterations or None, commonScriptName = args.common_script))
+	out = open(args.output, "w", newline='', encoding='utf-8') if args.output else sys.stdout
+	try:
+		if args.format == "csv":
+			# the most expensive tasks first
+			rows = [row for analysis in analyses for row in analysis.rows()]
+			rows.sort(key = lambda row: costKey(row[4]), reverse = True)
+			writer = csv.writer(out)
+			writer.writerow(taskCSVHeader)
+			writer.writerows(rows)
+		else:
+			analyses.sort(key = lambda analysis: costKey(analysis.maxFrameCost()), reverse = True)
+			out.write(json.dumps([analysis.toDict() for analysis in analyses], indent = '\t', ensure_ascii = False) + '\n')
+	finally:
+		if out is not sys.stdout: out.close()
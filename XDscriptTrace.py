@@ -0,0 +1,74 @@
+﻿""" See LICENSE for license"""
+
+from XDscriptLib import *
+import argparse
+import sys
+import os
+
+
+def parseArgument(text):
+	for conv in (int, float):
+		try:
+			return conv(text, 0) if conv is int else conv(text)
+		except ValueError:
+			pass
+	return text
+
+if __name__ == '__main__':
+	if sys.version_info[0] < 3:
+		raise RuntimeError("Python 3 required")
+
+	parser = argparse.ArgumentParser(description="Records, inspects and replays execution traces of XD script functions (headless: standard functions return 0)")
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.required = True
+
+	record = subparsers.add_parser("record", help="Runs a function and records its trace")
+	record.add_argument("file", help="XD script file", type=str)
+	record.add_argument("function", help="Function name (FTBL) or index (HEAD)", type=str)
+	record.add_argument("args", help="Arguments (int, float or str)", nargs='*', type=str)
+	record.add_argument("-o", "--output", help="Trace file (default: <file>.xdtr)", type=str)
+	record.add_argument("-n", "--max-steps", help="Maximum number of instructions executed", type=int, default=1000000)
+
+	show = subparsers.add_parser("show", help="Prints the steps of a trace")
+	show.add_argument("trace", help="Trace file", type=str)
+	show.add_argument("-s", "--start", help="First step", type=int, default=0)
+	show.add_argument("-c", "--count", help="Number of steps", type=int, default=100)
+	show.add_argument("-f", "--function", help="Only show the invocations of this function (name or offset)", type=str)
+
+	replay = subparsers.add_parser("replay", help="Replays a trace and checks that the execution matches it")
+	replay.add_argument("file", help="XD script file", type=str)
+	replay.add_argument("trace", help="Trace file", type=str)
+	args = parser.parse_args()
+
+	if args.command == "record":
+		with open(args.file, "rb") as f:
+			ctx = ScriptCtx(f.read())
+		function = int(args.function) if args.function.isdigit() else args.function
+		with TraceRecorder(args.output or os.path.splitext(args.file)[0] + ".xdtr") as recorder:
+			emulator = ScriptEmulator(ctx, maxSteps = args.max_steps, tracer = recorder)
+			try:
+				print("result:", repr(emulator.call(function, *[parseArgument(arg) for arg in args.args])))
+			except ScriptRuntimeError as e:
+				print("interrupted:", e, file=sys.stderr)
+		print("{0} steps".format(recorder.nbSteps), file=sys.stderr)
+	elif args.command == "show":
+		with ExecutionTrace(args.trace) as trace:
+			if args.function is not None:
+				function = int(args.function, 0) if args.function[:1].isdigit() else args.function
+				ranges = [(inv.firstStep, min(inv.endStep, inv.firstStep + args.count)) for inv in trace.invocations(function)]
+			else:
+				ranges = [(args.start, args.start + args.count)]
+			for (start, stop) in ranges:
+				for event in trace.events(start, stop):
+					if type(event) is TraceStep:
+						print("{0:>10} {1:>8} {2}: {3!r}".format(event.step, hex(event.position), trace.functions.get(event.position, ""), list(event.stack)))
+					elif type(event) is TraceStdCall:
+						print("{0:>10} {1:>8} {2}({3}) = {4!r}".format("", "callstd", FunctionInfo.getStdFunctionName(event.clsID, event.funcID),
+																		", ".join(repr(arg) for arg in event.args), event.result))
+					else:
+						print("{0:>10} {1!r}".format("", event))
+	else:
+		with open(args.file, "rb") as f:
+			ctx = ScriptCtx(f.read())
+		with ExecutionTrace(args.trace) as trace:
+			print("{0} steps replayed".format(replayTrace(trace, ctx)))
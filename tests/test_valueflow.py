@@ -0,0 +1,40 @@
+﻿# See LICENSE for license
+
+import os
+import unittest
+import warnings
+from XDscriptLib import *
+
+commonScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common_script.scd")
+
+def loadCommonScript():
+	with open(commonScript, "rb") as f:
+		src = f.read()
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore")
+		return ScriptCtx(src)
+
+class ConditionalWriteTest(unittest.TestCase):
+	def test_gatedWrite(self):
+		# ldvar $globals[3]; jmpfalse end; ldimm int 5; setvar $globals[7]; end: return
+		ctx = loadCommonScript()
+		start = len(ctx.sections["CODE"].instructions)
+		ctx.insertFunction([Instruction(0x03000003), Instruction(0x0b000000 | (start + 5)), Instruction(0x02010000), 5,
+							Instruction(0x04000007), Instruction(0x08000000)])
+		flow = functionFlow(ctx, start)
+		set3, unset3 = Condition(3, "neq", 0), Condition(3, "equ", 0)
+		self.assertEqual(flow.writes, [GlobalWrite(start + 4, 7, 5, None, (set3,))])
+		self.assertEqual(flow.gates, [Gate(start + 1, set3, start + 2), Gate(start + 1, unset3, start + 5)])
+		self.assertEqual(flow.reads, [3])
+
+class UnbalancedLoopTest(unittest.TestCase):
+	def test_growingStack(self):
+		# loop: ldimm int 1; ldimm int 2; jmp loop (leaves two more values on the stack at each iteration)
+		ctx = loadCommonScript()
+		start = len(ctx.sections["CODE"].instructions)
+		ctx.insertFunction([Instruction(0x02010000), 1, Instruction(0x02010000), 2, Instruction(0x0c000000 | start)])
+		flow = functionFlow(ctx, start)
+		self.assertEqual((flow.writes, flow.gates, flow.reads), ([], [], []))
+
+if __name__ == '__main__':
+	unittest.main()